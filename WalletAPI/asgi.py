@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'WalletAPI.settings')
+os.environ.setdefault('WALLET_ASGI', 'true')
 
 application = get_asgi_application()
@@ -0,0 +1,12 @@
+"""WalletAPI ASGI URL Configuration
+
+Used instead of ``WalletAPI.urls`` when the project is served by
+``WalletAPI.asgi``: the API routes point at the async views.
+"""
+from django.contrib import admin
+from django.urls import path, include
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('api/', include('app.async_urls'))
+]
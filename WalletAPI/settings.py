@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,10 +47,19 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'app.User'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication'
+        'app.authentication.TokenAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
     )
 }
 
+# API tokens issued by /api/login/. Validated tokens are cached in-process
+# for WALLET_TOKEN_CACHE_TTL seconds, so a deleted token may keep working
+# for up to that long on nodes that have already seen it.
+
+WALLET_TOKEN_TTL = config('WALLET_TOKEN_TTL', default=24 * 60 * 60, cast=int)
+WALLET_TOKEN_CACHE_SIZE = config('WALLET_TOKEN_CACHE_SIZE', default=10000, cast=int)
+WALLET_TOKEN_CACHE_TTL = config('WALLET_TOKEN_CACHE_TTL', default=60, cast=int)
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -59,7 +69,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'WalletAPI.urls'
+# WalletAPI.asgi sets WALLET_ASGI, which routes the API to the async views.
+WALLET_ASGI = config('WALLET_ASGI', default=False, cast=bool)
+
+ROOT_URLCONF = 'WalletAPI.asgi_urls' if WALLET_ASGI else 'WalletAPI.urls'
 
 TEMPLATES = [
     {
@@ -82,13 +95,60 @@ WSGI_APPLICATION = 'WalletAPI.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# DATABASE_URL selects the database, e.g.
+# postgres://wallet:wallet@db:5432/wallet; without it the SQLite file below
+# is used. CONN_MAX_AGE keeps each thread's connection open for that many
+# seconds instead of reconnecting on every request; 0 closes it after each
+# request. Set DATABASE_POOLED when DATABASE_URL points at a transaction-
+# pooling PgBouncer, which cannot keep server-side cursors open.
+
 DATABASES = {
+    'default': dj_database_url.config(
+        default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}",
+        conn_max_age=config('CONN_MAX_AGE', default=0, cast=int),
+        # Heroku Postgres (where DYNO is set) only accepts TLS connections.
+        ssl_require=config('DATABASE_SSL_REQUIRE', default='DYNO' in os.environ, cast=bool),
+    )
+}
+DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = config(
+    'DATABASE_POOLED', default=False, cast=bool)
+
+# Applied to every new SQLite connection, which also starts transactions
+# with BEGIN IMMEDIATE (see app/sqlite.py). WALLET_SQLITE_TUNING=False keeps
+# SQLite's defaults. WAL is opt-in (WALLET_SQLITE_WAL=True) because the
+# journal mode is stored in the database file itself and outlives the
+# setting: switch it back with PRAGMA journal_mode = DELETE.
+
+WALLET_SQLITE_PRAGMAS = {
+    'busy_timeout': 5000,           # ms to wait for a lock before failing
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,       # negative: KiB rather than pages
+    'temp_store': 'MEMORY',
+} if config('WALLET_SQLITE_TUNING', default=True, cast=bool) else {}
+if config('WALLET_SQLITE_WAL', default=False, cast=bool):
+    # synchronous=NORMAL is only crash-safe in WAL mode.
+    WALLET_SQLITE_PRAGMAS.update(journal_mode='WAL', synchronous='NORMAL')
+WALLET_SQLITE_BEGIN = 'IMMEDIATE' if WALLET_SQLITE_PRAGMAS else None
+
+# Cache
+# Wallet summaries, history pages, reports and their ETag validators are
+# cached per wallet and invalidated on every write, which is only correct
+# when every process serving the API shares the cache. So the read cache is
+# off (DummyCache) unless WALLET_CACHE_BACKEND names a shared backend such
+# as django.core.cache.backends.memcached.MemcachedCache. LocMemCache is
+# per process: only use it with a single server process.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': config('WALLET_CACHE_BACKEND',
+                          default='django.core.cache.backends.dummy.DummyCache'),
+        'LOCATION': config('WALLET_CACHE_LOCATION', default='wallet-api'),
     }
 }
 
+WALLET_CACHE_ALIAS = 'default'
+WALLET_CACHE_TIMEOUT = config('WALLET_CACHE_TIMEOUT', default=300, cast=int)
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -126,4 +186,60 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = 'static'
 
-django_heroku.settings(locals())
+# Wallet / transaction ids
+# Every process writing to the same database needs a distinct worker id
+# (0-1023): WALLET_WORKER_ID is this host's base, and each gunicorn worker
+# adds its slot (1, 2, ...; see gunicorn.conf.py). Space the bases of hosts
+# or containers sharing a database further apart than twice their worker
+# count.
+
+WALLET_ID_GENERATOR = config('WALLET_ID_GENERATOR', default='app.ids.SnowflakeGenerator')
+WALLET_WORKER_ID = config('WALLET_WORKER_ID', default=0, cast=int)
+
+# How add/spend/transfer serialize on a wallet: 'locking' reads the wallet
+# with SELECT ... FOR UPDATE first; 'conditional' applies a single guarded
+# UPDATE (balance = balance - x WHERE balance >= x) and never waits on a
+# read lock, which suits very hot wallets.
+
+WALLET_POSTING_MODE = config('WALLET_POSTING_MODE', default='locking')
+
+# Postings aborted by a lock conflict (deadlock, serialization failure,
+# SQLite busy timeout) are retried up to WALLET_LOCK_RETRIES times, starting
+# after about WALLET_LOCK_RETRY_BACKOFF_MS and doubling.
+
+WALLET_LOCK_RETRIES = config('WALLET_LOCK_RETRIES', default=3, cast=int)
+WALLET_LOCK_RETRY_BACKOFF_MS = config('WALLET_LOCK_RETRY_BACKOFF_MS', default=10, cast=float)
+
+# Group commit for add_money: deposits are queued and posted by a background
+# thread in batches of up to WALLET_GROUP_COMMIT_MAX_BATCH, each batch taking
+# whatever arrives within WALLET_GROUP_COMMIT_MAX_DELAY_MS of its first
+# deposit, as one transaction. Requests still wait for their batch to commit,
+# for up to WALLET_GROUP_COMMIT_TIMEOUT_MS before answering 503.
+
+WALLET_GROUP_COMMIT = config('WALLET_GROUP_COMMIT', default=False, cast=bool)
+WALLET_GROUP_COMMIT_MAX_BATCH = config('WALLET_GROUP_COMMIT_MAX_BATCH', default=500, cast=int)
+WALLET_GROUP_COMMIT_MAX_DELAY_MS = config('WALLET_GROUP_COMMIT_MAX_DELAY_MS', default=5, cast=float)
+WALLET_GROUP_COMMIT_TIMEOUT_MS = config('WALLET_GROUP_COMMIT_TIMEOUT_MS', default=10000, cast=float)
+
+# Responses to add/spend/transfer requests sent with an Idempotency-Key
+# header are stored, so retries get the original response instead of posting
+# again. The most recent WALLET_IDEMPOTENCY_CACHE_SIZE are also held in
+# memory per process; purge_idempotency_keys deletes stored keys older than
+# WALLET_IDEMPOTENCY_TTL seconds.
+
+WALLET_IDEMPOTENCY_CACHE_SIZE = config('WALLET_IDEMPOTENCY_CACHE_SIZE', default=10000, cast=int)
+WALLET_IDEMPOTENCY_TTL = config('WALLET_IDEMPOTENCY_TTL', default=24 * 60 * 60, cast=int)
+
+# Under ASGI the async views run their database work in a pool of this many
+# threads per process, which also bounds the process's database connections.
+
+WALLET_ASYNC_DB_THREADS = config('WALLET_ASYNC_DB_THREADS', default=16, cast=int)
+
+# DATABASES is configured above, from the same DATABASE_URL.
+django_heroku.settings(locals(), databases=False)
+
+if WALLET_ASGI:
+    # WhiteNoise's middleware is sync-only; under ASGI it would push every
+    # request through Django's single sync thread. Serve static files from
+    # the proxy instead.
+    MIDDLEWARE = [name for name in MIDDLEWARE if not name.startswith('whitenoise.')]
@@ -5,7 +5,8 @@ from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
 
-from app.models import User, Transaction, Wallet
+from app.models import (ArchivedTransaction, LedgerArchive, MonthlyBalance, User,
+                        Transaction, Wallet, WalletShard, WalletTotals)
 
 
 class UserCreationForm(forms.ModelForm):
@@ -75,4 +76,9 @@ class UserAdmin(BaseUserAdmin):
 admin.site.register(User, UserAdmin)
 admin.site.register(Transaction)
 admin.site.register(Wallet)
+admin.site.register(WalletTotals)
+admin.site.register(MonthlyBalance)
+admin.site.register(WalletShard)
 admin.site.unregister(Group)
+admin.site.register(ArchivedTransaction)
+admin.site.register(LedgerArchive)
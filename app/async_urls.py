@@ -0,0 +1,15 @@
+"""WalletAPI.app async URL Configuration
+
+The same routes as ``app.urls``, with every view wrapped by
+``app.async_views.async_view`` for use under ASGI.
+"""
+
+from django.urls import path
+
+from app import urls
+from app.async_views import async_view
+
+urlpatterns = [
+    path(str(pattern.pattern), async_view(pattern.callback), name=pattern.name)
+    for pattern in urls.urlpatterns
+]
@@ -0,0 +1,178 @@
+"""
+Async wrappers around the wallet API views, routed by ``app.async_urls`` when
+the project is served through ``WalletAPI.asgi``.
+
+Django 3.1 has no async ORM, and under ASGI it runs plain sync views one at a
+time on a single thread. Here each view runs in a bounded pool of
+``WALLET_ASYNC_DB_THREADS`` threads instead. The event loop keeps accepting
+connections while requests wait on the database, and the pool size caps how
+many database connections the process opens.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from queue import Full, Queue
+from threading import Event, Lock
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# Streamed bodies are handed to the event loop in batches of about this many
+# bytes, with at most STREAM_QUEUE_SIZE batches buffered per response.
+STREAM_BATCH_BYTES = 64 * 1024
+STREAM_QUEUE_SIZE = 16
+
+_executor = None
+_executor_lock = Lock()
+_end_of_stream = object()
+
+
+def get_executor():
+    """
+    Return the process-wide pool that database work is handed to.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.WALLET_ASYNC_DB_THREADS,
+                    thread_name_prefix='wallet-db',
+                )
+    return _executor
+
+
+def shutdown_executor():
+    """
+    Stop the pool; the next request starts a fresh one sized from settings.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+def _with_connection(func, *args, **kwargs):
+    # Pool threads live across requests, so apply CONN_MAX_AGE here the way
+    # the request_started/request_finished signals do for request threads.
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """
+    Await ``func(*args, **kwargs)`` run in the database thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), partial(_with_connection, func, *args, **kwargs))
+
+
+class _Stream:
+    """
+    Carries a streamed body from the pool thread producing it to the event
+    loop. Django 3.1's ASGI handler iterates streaming responses
+    synchronously on the loop, where the ORM refuses to run, so the thread
+    that ran the view keeps iterating the body (on its own connection) and
+    the loop only takes finished batches off the queue.
+    """
+
+    def __init__(self, on_first_batch):
+        self.batches = Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.abandoned = Event()
+        # Called once the first batch is queued, so the loop never waits on
+        # the query that starts the stream.
+        self.on_first_batch = on_first_batch
+
+    def put(self, item):
+        while not self.abandoned.is_set():
+            try:
+                self.batches.put(item, timeout=1)
+            except Full:
+                continue
+            if self.on_first_batch is not None:
+                self.on_first_batch, ready = None, self.on_first_batch
+                ready()
+            return True
+        return False
+
+    def produce(self, chunks):
+        pending, size = [], 0
+        try:
+            for chunk in chunks:
+                pending.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_BATCH_BYTES:
+                    if not self.put(b''.join(pending)):
+                        return
+                    pending, size = [], 0
+            if pending:
+                self.put(b''.join(pending))
+            self.put(_end_of_stream)
+        except Exception as e:
+            self.put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.batches.get()
+                if item is _end_of_stream:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.abandoned.set()
+
+
+def _resolve(loop, future, response=None, error=None):
+    def settle():
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
+    loop.call_soon_threadsafe(settle)
+
+
+def _serve(loop, future, view, request, args, kwargs):
+    close_old_connections()
+    try:
+        try:
+            response = view(request, *args, **kwargs)
+            if not response.streaming:
+                if hasattr(response, 'render') and not response.is_rendered:
+                    response.render()
+                _resolve(loop, future, response)
+                return
+
+            stream = _Stream(partial(_resolve, loop, future, response))
+            chunks = iter(response.streaming_content)
+            response.streaming_content = stream
+        except Exception as e:
+            _resolve(loop, future, error=e)
+            return
+
+        stream.produce(chunks)
+    finally:
+        close_old_connections()
+
+
+def async_view(view):
+    """
+    Turn a synchronous view into a coroutine that runs it, and renders its
+    response, in the database thread pool.
+    """
+    @wraps(view)
+    async def wrapped(request, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        get_executor().submit(_serve, loop, future, view, request, args, kwargs)
+        return await future
+    return wrapped
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from app.models import AuthToken, hash_token
+
+
+class TokenCache:
+    """
+    Small thread-safe LRU of validated token hashes. Entries expire at the
+    token's own expiry or after ``ttl`` seconds, whichever comes first.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, valid_until = entry
+            if valid_until <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, key, user, expires_at):
+        valid_until = min(expires_at, time.time() + self.ttl)
+        with self._lock:
+            self._entries[key] = (user, valid_until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache(settings.WALLET_TOKEN_CACHE_SIZE,
+                         settings.WALLET_TOKEN_CACHE_TTL)
+
+
+class TokenAuthentication(BaseAuthentication):
+    """
+    Authenticate ``Authorization: Token <key>`` headers against tokens
+    issued by ``api_login``. Unlike BasicAuthentication this never runs the
+    password hasher, and repeat requests are served from ``token_cache``.
+    """
+    keyword = 'Token'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed('Invalid token header.')
+        return self.authenticate_credentials(key), key
+
+    def authenticate_credentials(self, key):
+        key_hash = hash_token(key)
+        user = token_cache.get(key_hash)
+        if user is not None:
+            return user
+
+        try:
+            token = AuthToken.objects.select_related('user').get(key=key_hash)
+        except AuthToken.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+        if token.expires_at <= timezone.now():
+            raise AuthenticationFailed('Token has expired.')
+        if not token.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+
+        token_cache.set(key_hash, token.user, token.expires_at.timestamp())
+        return token.user
+
+    def authenticate_header(self, request):
+        return self.keyword
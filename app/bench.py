@@ -0,0 +1,48 @@
+"""
+Helpers shared by the ``bench_*`` management commands.
+"""
+import json
+import threading
+import time
+
+ENDPOINTS = ['stream', 'summary', 'transactions', 'add']
+ENDPOINT_HELP = ("'stream' reads the uncached NDJSON history; summary and "
+                 "transactions are mostly read-cache hits; add posts deposits.")
+
+
+def build_request(endpoint, wallet_id, token):
+    """
+    Return (method, path, body, Authorization header) for one benchmark call.
+    """
+    if endpoint == 'add':
+        method, path = 'POST', '/api/wallet/add/'
+        body = json.dumps({'wallet_id': wallet_id, 'amount': '0.01'}).encode()
+    elif endpoint == 'stream':
+        method, path, body = 'GET', f'/api/wallet/{wallet_id}/transactions/?stream=true', b''
+    else:
+        method, path, body = 'GET', f'/api/wallet/{wallet_id}/{endpoint}/', b''
+    return method, path, body, f'Token {token}'
+
+
+def run_threads(target, count):
+    """
+    Run ``target`` in ``count`` threads at once; returns the seconds taken.
+    """
+    workers = [threading.Thread(target=target) for _ in range(count)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def summarize(latencies, elapsed, unit='req/s'):
+    """
+    Format the rate and the p50/p99 latencies of calls that took
+    ``latencies`` seconds each, ``elapsed`` seconds in all.
+    """
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    return f'{len(latencies) / elapsed:9,.1f} {unit}  p50 {p50:8.2f} ms  p99 {p99:8.2f} ms'
@@ -0,0 +1,121 @@
+"""
+Read-through cache for the per-wallet read endpoints.
+
+Cached responses are keyed by the wallet's version number, which every
+posting path bumps once its database transaction commits, so a response is
+never served after the wallet has changed. Versions live in the cache
+itself, so every process serving the API must share it (e.g. Memcached or
+Redis). With the default ``DummyCache`` nothing is cached: reads are built
+every time and writes skip invalidation.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import transaction
+
+GENERATION_KEY = 'wallet-version:*'
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[settings.WALLET_CACHE_ALIAS]
+
+
+def enabled():
+    return not isinstance(get_cache(), DummyCache)
+
+
+def version_key(wallet_id):
+    return f'wallet-version:{wallet_id}'
+
+
+def _fresh_version():
+    # A value no earlier version can have had, so entries written under a
+    # version that was evicted from the cache can never be served again.
+    return time.time_ns()
+
+
+def _current_version(cache, key, versions):
+    version = versions.get(key)
+    if version is None:
+        cache.add(key, _fresh_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def cached(wallet_id, name, build):
+    """
+    Return the cached value of ``name`` for the wallet, calling ``build``
+    to compute (and cache) it on a miss. Exceptions raised by ``build`` are
+    not cached.
+    """
+    if not enabled():
+        return build()
+    cache = get_cache()
+    wallet_key = version_key(wallet_id)
+    versions = cache.get_many([GENERATION_KEY, wallet_key])
+    key = 'wallet:{}:{}:{}:{}'.format(
+        wallet_id,
+        _current_version(cache, GENERATION_KEY, versions),
+        _current_version(cache, wallet_key, versions),
+        name,
+    )
+
+    value = cache.get(key)
+    if value is not None:
+        _count('hits')
+        return value
+
+    _count('misses')
+    value = build()
+    cache.set(key, value, settings.WALLET_CACHE_TIMEOUT)
+    return value
+
+
+def invalidate_wallets(wallet_ids):
+    """
+    Bump the wallets' versions once the current transaction commits.
+    """
+    if not enabled():
+        return
+    keys = {version_key(wallet_id) for wallet_id in wallet_ids}
+    transaction.on_commit(lambda: _bump(keys))
+
+
+def invalidate_all():
+    """
+    Bump the version shared by every wallet, e.g. after a rebuild.
+    """
+    if not enabled():
+        return
+    transaction.on_commit(lambda: _bump([GENERATION_KEY]))
+
+
+def _bump(keys):
+    cache = get_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), None)
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def stats():
+    """Return this process's hit and miss counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats['hits'] = _stats['misses'] = 0
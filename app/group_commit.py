@@ -0,0 +1,152 @@
+"""
+Group commit for deposits (``WALLET_GROUP_COMMIT``).
+
+Instead of each ``add_money`` request committing its own transaction, the
+request thread queues its deposit and waits. A single background thread
+per process takes deposits off the queue in micro-batches, up to
+``WALLET_GROUP_COMMIT_MAX_BATCH`` of them or whatever arrived within
+``WALLET_GROUP_COMMIT_MAX_DELAY_MS`` of the first, and posts each batch with
+``Wallet.objects.post_batch``: one transaction, one ledger INSERT, each
+wallet locked once. Callers return once their batch has committed, so a
+successful response still means the deposit is durable. If a batch fails,
+its deposits are posted one by one so that only the bad one fails, and a
+caller waits at most ``WALLET_GROUP_COMMIT_TIMEOUT_MS`` for its outcome.
+"""
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from queue import Empty, Queue
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from app.locking import with_retries
+from app.models import Wallet
+
+_stop = object()
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class DepositTimeout(Exception):
+    pass
+
+
+class DepositQueue:
+    def __init__(self, max_batch, max_delay):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = {'batches': 0, 'deposits': 0}
+        self._pending = Queue()
+        self._thread = threading.Thread(target=self._run, name='wallet-group-commit',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, wallet_id, amount):
+        """
+        Queue a deposit and return a future for its ``post_batch`` outcome.
+        """
+        future = Future()
+        self._pending.put((str(wallet_id), amount, future))
+        return future
+
+    def stop(self):
+        """Flush what is queued, then stop the background thread."""
+        self._pending.put(_stop)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                item = self._pending.get()
+                if item is _stop:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._pending.get(timeout=max(deadline - time.monotonic(), 0))
+                    except Empty:
+                        break
+                    if item is _stop:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._flush(batch)
+        finally:
+            connection.close()
+
+    def _flush(self, batch):
+        # This thread outlives requests, so apply CONN_MAX_AGE and drop
+        # broken connections the way the request signals would.
+        close_old_connections()
+        # Deposits whose callers gave up waiting are dropped.
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if batch:
+            self._post(batch)
+
+    def _post(self, batch):
+        try:
+            outcomes = with_retries(lambda: Wallet.objects.post_batch(
+                [(wallet_id, 'D', amount) for wallet_id, amount, _ in batch]))
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            for item in batch:
+                self._post([item])
+            return
+        self.stats['batches'] += 1
+        self.stats['deposits'] += len(batch)
+        for (_, _, future), outcome in zip(batch, outcomes):
+            future.set_result(outcome)
+
+
+def get_queue():
+    """
+    Return this process's deposit queue, starting it on first use (so that
+    forked server workers each start their own).
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = DepositQueue(
+                    settings.WALLET_GROUP_COMMIT_MAX_BATCH,
+                    settings.WALLET_GROUP_COMMIT_MAX_DELAY_MS / 1000,
+                )
+    return _queue
+
+
+def shutdown_queue():
+    """
+    Flush and stop the queue; the next deposit starts a fresh one sized
+    from settings.
+    """
+    global _queue
+    with _queue_lock:
+        queue, _queue = _queue, None
+    if queue is not None:
+        queue.stop()
+
+
+def deposit(wallet_id, amount):
+    """
+    Deposit through the queue and wait for the batch to commit. Returns
+    ``{'transaction': ..., 'balance': ...}`` or ``{'error': ...}``, or
+    raises ``DepositTimeout`` if the deposit was not posted in time.
+    """
+    timeout = settings.WALLET_GROUP_COMMIT_TIMEOUT_MS / 1000
+    future = get_queue().submit(wallet_id, amount)
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        if future.cancel():
+            raise DepositTimeout('Deposit was not posted')
+    # Its batch is already being posted: give it one more timeout to finish.
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        raise DepositTimeout('Deposit may still be posted')
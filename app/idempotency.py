@@ -0,0 +1,126 @@
+"""
+``Idempotency-Key`` support for the money-movement views.
+
+The first request with a given key runs the view and stores its response
+in the same database transaction as the posting, so either both commit or
+neither does; a lock conflict re-runs the two together. Later requests with the key get the stored response back
+without running the view: from an in-process LRU of recent keys when this
+process has seen the key, otherwise with one primary-key lookup. Keys are
+scoped to the authenticated user.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from app.locking import with_retries
+from app.models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+class ResponseCache:
+    """
+    Small thread-safe LRU of stored ``(fingerprint, status_code,
+    response)`` entries. Stored responses never change, so entries only
+    leave by eviction.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache(settings.WALLET_IDEMPOTENCY_CACHE_SIZE)
+
+
+def idempotent(view):
+    """
+    Honour an ``Idempotency-Key`` header on a DRF view (apply it below
+    ``api_view``). Responses with a 5xx status are neither stored nor
+    committed, so those requests can be retried with the same key.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        header = request.headers.get(HEADER)
+        if header is None:
+            return view(request, *args, **kwargs)
+        if not header or len(header) > MAX_KEY_LENGTH:
+            return Response({"error": f"Invalid {HEADER} header"}, status=400)
+
+        key = _scoped_key(request.user, header)
+        fingerprint = _fingerprint(request)
+        stored = response_cache.get(key) or IdempotencyKey.objects.lookup(key)
+        if stored is None:
+            def post():
+                with transaction.atomic():
+                    response = view(request, *args, **kwargs)
+                    if response.status_code >= 500:
+                        transaction.set_rollback(True)
+                        return response, None
+                    IdempotencyKey.objects.create(
+                        key=key, fingerprint=fingerprint,
+                        status_code=response.status_code, response=response.data)
+                return response, (fingerprint, response.status_code, response.data)
+
+            try:
+                # The view runs inside this transaction, where it cannot
+                # retry a lock conflict itself.
+                response, stored = with_retries(post)
+            except IntegrityError:
+                # A concurrent request with the same key committed first;
+                # this one's posting has been rolled back.
+                stored = IdempotencyKey.objects.lookup(key)
+                if stored is None:
+                    return Response({"error": f"A request with this {HEADER} is in progress"},
+                                    status=409)
+            else:
+                if stored is not None:
+                    response_cache.set(key, stored)
+                return response
+
+        response_cache.set(key, stored)
+        stored_fingerprint, status_code, data = stored
+        if stored_fingerprint != fingerprint:
+            return Response({"error": f"{HEADER} was already used for a different request"},
+                            status=422)
+        response = Response(data, status=status_code)
+        response['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapped
+
+
+def _scoped_key(user, header):
+    owner = user.pk if user.is_authenticated else ''
+    return hashlib.sha256(f'{owner}:{header}'.encode()).hexdigest()
+
+
+def _fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, cls=JSONEncoder)
+    return hashlib.sha256(f'{request.path}:{body}'.encode()).hexdigest()
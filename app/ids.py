@@ -0,0 +1,117 @@
+"""
+Unique, roughly time-ordered identifiers for wallets and transactions.
+
+The default generator is Snowflake-style: a 64-bit integer made of the
+milliseconds since ``EPOCH_MS``, a worker id and a per-millisecond sequence,
+so each process can hand out 4096 ids per millisecond without coordinating
+with the database. Every process sharing a database needs its own worker id:
+a process's id is ``WALLET_WORKER_ID`` (the host's base, 0 by default) plus
+the slot gunicorn.conf.py gives each worker it forks (``set_worker_slot``).
+Slots start at 1, so the base itself is left to one process that is not a
+gunicorn worker, such as a management command.
+
+A different generator can be plugged in with the ``WALLET_ID_GENERATOR``
+setting (dotted path to a class whose instances have a ``next_id()`` method
+returning a string of at most 20 characters).
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+# 2021-01-01T00:00:00Z, which leaves room for ~69 years of 41-bit timestamps.
+EPOCH_MS = 1609459200000
+
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'Worker id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_int(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+            # Never go backwards, even if the wall clock does.
+            if now <= self._last_ms:
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond.
+                    now = self._wait_past(self._last_ms)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS)) | \
+                (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+    def next_id(self):
+        return str(self.next_int())
+
+    @staticmethod
+    def _wait_past(last_ms):
+        now = int(time.time() * 1000)
+        while now <= last_ms:
+            time.sleep(0.0001)
+            now = int(time.time() * 1000)
+        return now
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+_worker_slot = 0
+
+
+def default_worker_id():
+    worker_id = int(getattr(settings, 'WALLET_WORKER_ID', None) or 0) + _worker_slot
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ImproperlyConfigured(
+            f'Worker id {worker_id} (WALLET_WORKER_ID plus worker slot {_worker_slot}) '
+            f'must be between 0 and {MAX_WORKER_ID}')
+    return worker_id
+
+
+def set_worker_slot(slot):
+    """
+    Make this process's worker id ``WALLET_WORKER_ID + slot``. gunicorn
+    calls this in every worker it forks with a slot no live worker holds.
+    """
+    global _generator, _worker_slot
+    with _generator_lock:
+        _worker_slot = slot
+        _generator = None
+    default_worker_id()
+
+
+def get_generator():
+    """
+    Return the process-wide id generator, creating a fresh one after a fork
+    so that pre-forked workers do not share a worker id and sequence.
+    """
+    global _generator, _generator_pid
+    pid = os.getpid()
+    if _generator is None or _generator_pid != pid:
+        with _generator_lock:
+            if _generator is None or _generator_pid != pid:
+                path = getattr(settings, 'WALLET_ID_GENERATOR',
+                               'app.ids.SnowflakeGenerator')
+                _generator = import_string(path)(default_worker_id())
+                _generator_pid = pid
+    return _generator
+
+
+def next_id():
+    """Return a new unique id as a string."""
+    return get_generator().next_id()
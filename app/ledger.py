@@ -0,0 +1,149 @@
+"""
+Queries over a wallet's ledger: the live ``Transaction`` table and the
+``ArchivedTransaction`` rows moved out of it. Both tables use
+``LedgerQuerySet`` as their manager, so deposits, withdrawals, row count
+and net always come from one conditional-aggregation query.
+"""
+
+from decimal import Decimal
+
+from django.db import models
+from django.db.models import Count, DateField, Max, Q, Sum
+from django.db.models.functions import Trunc
+
+# Sums are added to ZERO, which keeps two decimal places whatever the
+# backend returns.
+ZERO = Decimal('0.00')
+
+TOTALS = {
+    'total_deposited': Sum('value', filter=Q(type='D')),
+    'total_withdrawn': Sum('value', filter=Q(type='W')),
+    'transaction_count': Count('id'),
+    'last_transaction_at': Max('created_at'),
+}
+
+
+class LedgerQuerySet(models.QuerySet):
+    def totals(self):
+        """
+        Return the rows' deposits, withdrawals, count, net and latest
+        posting time, computed in a single ``aggregate`` query.
+        """
+        return _with_net(self.aggregate(**TOTALS))
+
+    def totals_by(self, *fields):
+        """
+        ``totals()`` grouped by ``fields``, as ``values()`` rows. The sums
+        are ``None`` for groups with no rows of that type.
+        """
+        return self.order_by().values(*fields).annotate(**TOTALS)
+
+    def net_by_wallet(self):
+        """
+        Each wallet's net over the rows, as a ``{wallet_id: net}`` dict
+        read from one grouped query.
+        """
+        return {row['wallet_id']: _with_net(row)['net']
+                for row in self.totals_by('wallet_id').iterator()}
+
+    def totals_by_period(self, granularity):
+        """
+        ``totals()`` grouped by the ``day``/``week``/``month``/``year`` the
+        rows were posted in (local time), keyed by the period's first day.
+        """
+        rows = self.annotate(
+            period=Trunc('created_at', granularity, output_field=DateField())
+        ).totals_by('period')
+        return {row['period']: _with_net(row) for row in rows}
+
+    def after(self, cursor):
+        """
+        The rows after a ``(created_at, id)`` keyset cursor (all of them
+        when ``cursor`` is ``None``), oldest first.
+        """
+        rows = self.order_by('created_at', 'id')
+        if cursor is None:
+            return rows
+        created_at, tx_id = cursor
+        return rows.filter(Q(created_at__gt=created_at) |
+                           Q(created_at=created_at, id__gt=tx_id))
+
+
+def _with_net(row):
+    totals = dict(row)
+    totals['total_deposited'] = ZERO + (totals['total_deposited'] or ZERO)
+    totals['total_withdrawn'] = ZERO + (totals['total_withdrawn'] or ZERO)
+    totals['net'] = totals['total_deposited'] - totals['total_withdrawn']
+    return totals
+
+
+def ledgers(wallet, since=None):
+    """
+    The wallet's ledger tables holding rows from ``since`` (or from the
+    start) onwards, oldest first: its archive, when some of the archived
+    rows are that recent, then the live ledger. Fetch the wallet with
+    ``select_related('archive')`` to avoid a query.
+    """
+    archive = getattr(wallet, 'archive', None)
+    if archive is not None and (since is None or since < archive.archived_before):
+        return [wallet.archived_transactions.all(), wallet.transaction_set.all()]
+    return [wallet.transaction_set.all()]
+
+
+def history(wallet, after=None):
+    """
+    The wallet's ledger rows after the ``after`` cursor, oldest first, as
+    ``(id, type, value, created_at)`` querysets to read in turn.
+    """
+    since = after[0] if after is not None else None
+    return [ledger.after(after).values_list('id', 'type', 'value', 'created_at')
+            for ledger in ledgers(wallet, since)]
+
+
+def chunked(rows, size):
+    """
+    Read ``history()`` rows ``size`` at a time, each chunk picking up after
+    the last row of the one before. Unlike ``iterator()`` this keeps memory
+    flat without a server-side cursor, which a transaction-pooling
+    PgBouncer (``DATABASE_POOLED``) cannot keep open.
+    """
+    cursor = None
+    while True:
+        chunk = list(rows.after(cursor)[:size])
+        yield chunk
+        if len(chunk) < size:
+            return
+        tx_id, _, _, created_at = chunk[-1]
+        cursor = (created_at, tx_id)
+
+
+def totals_between(wallet, start, end, granularity=None):
+    """
+    The wallet's ledger totals for ``start <= created_at < end`` across
+    both tables, with one query per table: a ``totals()`` dict, or with a
+    ``granularity`` a ``totals_by_period()`` dict.
+    """
+    merged = {}
+    for ledger in ledgers(wallet, start):
+        rows = ledger.filter(created_at__gte=start, created_at__lt=end)
+        if granularity is None:
+            found = {None: rows.totals()}
+        else:
+            found = rows.totals_by_period(granularity)
+        for period, totals in found.items():
+            if period in merged:
+                totals = _merge(merged[period], totals)
+            merged[period] = totals
+    return merged[None] if granularity is None else merged
+
+
+def _merge(first, second):
+    latest = [moment for moment in (first['last_transaction_at'],
+                                    second['last_transaction_at']) if moment]
+    return {
+        'total_deposited': first['total_deposited'] + second['total_deposited'],
+        'total_withdrawn': first['total_withdrawn'] + second['total_withdrawn'],
+        'transaction_count': first['transaction_count'] + second['transaction_count'],
+        'net': first['net'] + second['net'],
+        'last_transaction_at': max(latest) if latest else None,
+    }
@@ -0,0 +1,63 @@
+"""
+Retrying money movements that lose a lock conflict.
+
+Wallets are always locked in id order (``Wallet.objects.lock``), so postings
+cannot deadlock on each other. Transactions can still be aborted by the
+database, e.g. by a serialization failure, a deadlock with some other
+writer, or SQLite's "database is locked" when the busy timeout runs out.
+``with_retries`` re-runs the whole transaction when that happens, with
+jittered exponential backoff.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+# serialization_failure, deadlock_detected
+RETRYABLE_SQLSTATES = {'40001', '40P01'}
+
+_stats = {'retries': 0}
+_stats_lock = threading.Lock()
+
+
+def is_retryable(error):
+    """Whether re-running the transaction that raised ``error`` may succeed."""
+    if getattr(error.__cause__, 'pgcode', None) in RETRYABLE_SQLSTATES:
+        return True
+    return 'database is locked' in str(error)
+
+
+def with_retries(func, attempts=None, backoff=None):
+    """
+    Call ``func``, which should run its own transaction, and call it again
+    on a retryable error, up to ``attempts`` times in all, sleeping about
+    ``backoff`` seconds before the first retry and doubling after each.
+    Inside an outer transaction nothing is retried: the error has already
+    aborted the caller's transaction.
+    """
+    if attempts is None:
+        attempts = settings.WALLET_LOCK_RETRIES + 1
+    if backoff is None:
+        backoff = settings.WALLET_LOCK_RETRY_BACKOFF_MS / 1000
+    for attempt in range(attempts):
+        try:
+            return func()
+        except OperationalError as e:
+            if attempt + 1 == attempts or connection.in_atomic_block or not is_retryable(e):
+                raise
+        with _stats_lock:
+            _stats['retries'] += 1
+        time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def stats():
+    """Return this process's retry counter."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats['retries'] = 0
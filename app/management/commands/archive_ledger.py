@@ -0,0 +1,39 @@
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from app.models import LedgerArchive
+
+
+class Command(BaseCommand):
+    help = ('Move ledger rows older than a cutoff into the archive table, '
+            'carrying their totals forward. History endpoints still page '
+            'into the archive.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_ids', nargs='*',
+                            help='Only process these wallets (default: all).')
+        cutoff = parser.add_mutually_exclusive_group(required=True)
+        cutoff.add_argument('--before', help='Archive rows created before this date (YYYY-MM-DD).')
+        cutoff.add_argument('--older-than-days', type=int,
+                            help='Archive rows older than this many days.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows moved per database transaction.')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            day = parse_date(options['before'])
+            if day is None:
+                raise CommandError(f"Invalid date: {options['before']}")
+            before = timezone.make_aware(datetime.combine(day, time.min))
+        else:
+            before = timezone.now() - timedelta(days=options['older_than_days'])
+        if before > timezone.now():
+            raise CommandError('The cutoff must be in the past.')
+
+        archived = LedgerArchive.objects.archive(
+            before, options['wallet_ids'] or None, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {archived} transaction(s) created before {before:%Y-%m-%d %H:%M}.'))
@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import time
+from queue import Empty, Queue
+
+from django.conf import settings
+from django.core.exceptions import SynchronousOnlyOperation
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from app.async_views import shutdown_executor
+from app.bench import ENDPOINT_HELP, ENDPOINTS, build_request, run_threads, summarize
+from app.ids import next_id
+from app.models import AuthToken, User, Wallet
+
+URLCONFS = {
+    'wsgi': 'WalletAPI.urls',
+    'asgi-sync': 'WalletAPI.urls',
+    'asgi': 'WalletAPI.asgi_urls',
+}
+
+
+
+class Command(BaseCommand):
+    help = ('Compare request throughput of the WSGI deployment, plain sync '
+            'views under ASGI and the async views under ASGI, driving each '
+            'application in-process with concurrent connections. Writes to '
+            'the configured database; the benchmark rows are deleted '
+            'afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=64,
+                            help='Concurrent client connections.')
+        parser.add_argument('--requests', type=int, default=20,
+                            help='Requests per connection.')
+        parser.add_argument('--threads', type=int, default=16,
+                            help='WSGI worker threads (and async DB threads).')
+        parser.add_argument('--endpoint', choices=ENDPOINTS, default='stream',
+                            help=ENDPOINT_HELP)
+        parser.add_argument('--db-latency', type=float, default=2.0,
+                            help='Milliseconds added to every query, standing '
+                                 'in for the round trip to a networked database.')
+        parser.add_argument('--target', choices=['all', *URLCONFS], default='all')
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(f'bench-asgi-{next_id()}@example.com', 'bench-password')
+        wallet = Wallet.objects.create(id=next_id(), name='Benchmark (asgi)')
+        wallet.deposit(1)
+        token = AuthToken.objects.issue(user)
+        self.request = build_request(options['endpoint'], wallet.id, token)
+
+        latency = options['db_latency'] / 1000
+        receiver = self.slow_queries(latency) if latency else None
+        if receiver:
+            connection_created.connect(receiver, weak=False)
+            connections.close_all()
+        try:
+            targets = list(URLCONFS) if options['target'] == 'all' else [options['target']]
+            for target in targets:
+                with override_settings(ROOT_URLCONF=URLCONFS[target],
+                                       WALLET_ASYNC_DB_THREADS=options['threads']):
+                    self.run(target, options['connections'], options['requests'],
+                             options['threads'])
+        finally:
+            if receiver:
+                connection_created.disconnect(receiver)
+            user.delete()
+            wallet.delete()
+
+    @staticmethod
+    def slow_queries(latency):
+        def sleep_then_execute(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def receiver(sender, connection, **kwargs):
+            if sleep_then_execute not in connection.execute_wrappers:
+                connection.execute_wrappers.append(sleep_then_execute)
+        return receiver
+
+    def run(self, target, clients, count, threads):
+        # Connections made under another configuration may still be open in
+        # this thread; start each target from a clean slate.
+        connections.close_all()
+
+        if target == 'wsgi':
+            latencies, errors, elapsed = self.run_wsgi(clients, count, threads)
+        else:
+            # As WalletAPI.settings does under ASGI, drop the sync-only
+            # WhiteNoise middleware.
+            middleware = [name for name in settings.MIDDLEWARE
+                          if not name.startswith('whitenoise.')]
+            with override_settings(MIDDLEWARE=middleware):
+                latencies, errors, elapsed = asyncio.run(self.run_asgi(clients, count))
+            shutdown_executor()
+
+        self.stdout.write(f'{target:>9}: {summarize(latencies, elapsed)}  errors {errors}')
+
+    def run_wsgi(self, clients, count, threads):
+        # A threaded WSGI server: `threads` workers take requests from the
+        # connections in turn; the rest wait in the accept queue.
+        handler = WSGIHandler()
+        method, path, body, authorization = self.request
+        factory = RequestFactory()
+        queue = Queue()
+        for _ in range(clients * count):
+            queue.put(None)
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def work():
+            mine, failed = [], 0
+            try:
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        break
+                    environ = factory.generic(
+                        method, path, body, 'application/json',
+                        HTTP_AUTHORIZATION=authorization).environ
+                    status = []
+                    started = time.perf_counter()
+                    response = handler(environ, lambda s, h: status.append(s))
+                    b''.join(response)
+                    response.close()
+                    mine.append(time.perf_counter() - started)
+                    if not status[0].startswith('2'):
+                        failed += 1
+            finally:
+                connections.close_all()
+            with lock:
+                latencies.extend(mine)
+                errors.append(failed)
+
+        elapsed = run_threads(work, threads)
+        return latencies, sum(errors), elapsed
+
+    async def run_asgi(self, clients, count):
+        application = ASGIHandler()
+        method, path, body, authorization = self.request
+        latencies, errors = [], 0
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+            'method': method, 'path': path, 'root_path': '', 'query_string': query.encode(),
+            'headers': [(b'authorization', authorization.encode()),
+                        (b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode()),
+                        (b'host', b'testserver')],
+        }
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def connection():
+            nonlocal errors
+            for _ in range(count):
+                status = []
+
+                async def send(message):
+                    if message['type'] == 'http.response.start':
+                        status.append(message['status'])
+
+                started = time.perf_counter()
+                try:
+                    await application(dict(scope), receive, send)
+                except SynchronousOnlyOperation:
+                    # Sync views' streamed bodies are read on the event loop.
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                if not 200 <= status[0] < 300:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connection() for _ in range(clients)))
+        return latencies, errors, time.perf_counter() - started
@@ -0,0 +1,43 @@
+import base64
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from app import views
+from app.authentication import token_cache
+from app.models import AuthToken, User, Wallet
+
+
+class Command(BaseCommand):
+    help = ('Compare requests/sec of the wallet summary endpoint under Basic '
+            'and token authentication. Uses throwaway rows that are rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20,
+                            help='Requests per scheme.')
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        factory = APIRequestFactory()
+        with transaction.atomic():
+            user = User.objects.create_user('bench-auth@example.com', 'bench-password')
+            wallet = Wallet.objects.create(id='bench-auth', name='Benchmark')
+            token = AuthToken.objects.issue(user)
+            basic = base64.b64encode(b'bench-auth@example.com:bench-password').decode()
+            token_cache.clear()
+
+            for scheme, header in (('basic', f'Basic {basic}'),
+                                   ('token', f'Token {token}')):
+                started = time.perf_counter()
+                for _ in range(count):
+                    request = factory.get('/', HTTP_AUTHORIZATION=header)
+                    response = views.wallet_summary(request, wallet_id=wallet.id)
+                    assert response.status_code == 200, response.data
+                    assert response.renderer_context['request'].user == user
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{scheme:>5}: {count / elapsed:10,.1f} req/s '
+                                  f'({elapsed / count * 1000:.2f} ms/request)')
+
+            transaction.set_rollback(True)
@@ -0,0 +1,69 @@
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+from app.bench import ENDPOINT_HELP, ENDPOINTS, build_request, run_threads, summarize
+from app.ids import next_id
+from app.models import AuthToken, User, Wallet
+
+
+class Command(BaseCommand):
+    help = ('Load a running server over HTTP with concurrent keep-alive '
+            'connections and report requests/sec and latency. The server must '
+            'use the same database as this command; the benchmark rows are '
+            'deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--connections', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per connection.')
+        parser.add_argument('--endpoint', choices=ENDPOINTS, default='summary',
+                            help=ENDPOINT_HELP)
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(f'bench-http-{next_id()}@example.com', 'bench-password')
+        wallet = Wallet.objects.create(id=next_id(), name='Benchmark (http)')
+        wallet.deposit(1)
+        token = AuthToken.objects.issue(user)
+        try:
+            self.run(urlsplit(options['url']), options['connections'], options['requests'],
+                     build_request(options['endpoint'], wallet.id, token))
+        finally:
+            user.delete()
+            wallet.delete()
+
+    def run(self, url, clients, count, request):
+        method, path, body, authorization = request
+        headers = {'Authorization': authorization, 'Content-Type': 'application/json'}
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def work():
+            mine, failed = [], 0
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+            try:
+                for _ in range(count):
+                    started = time.perf_counter()
+                    try:
+                        conn.request(method, path, body or None, headers)
+                        response = conn.getresponse()
+                        response.read()
+                    except (OSError, http.client.HTTPException):
+                        failed += 1
+                        conn.close()
+                        continue
+                    mine.append(time.perf_counter() - started)
+                    if response.status >= 300:
+                        failed += 1
+            finally:
+                conn.close()
+            with lock:
+                latencies.extend(mine)
+                errors.append(failed)
+
+        elapsed = run_threads(work, clients)
+        self.stdout.write(f'{summarize(latencies, elapsed)}  errors {sum(errors)}')
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.ids import get_generator
+
+
+class Command(BaseCommand):
+    help = 'Generate ids from many threads and report throughput and collisions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--count', type=int, default=50000,
+                            help='Ids generated per thread.')
+
+    def handle(self, *args, **options):
+        generator = get_generator()
+        threads, count = options['threads'], options['count']
+        results = [None] * threads
+
+        def work(slot):
+            results[slot] = [generator.next_id() for _ in range(count)]
+
+        workers = [threading.Thread(target=work, args=(slot,))
+                   for slot in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        total = threads * count
+        unique = len({id_ for ids in results for id_ in ids})
+        out_of_order = sum(
+            1 for ids in results
+            for previous, current in zip(ids, ids[1:])
+            if int(current) <= int(previous)
+        )
+        self.stdout.write(f'{total} ids from {threads} threads in {elapsed:.3f}s '
+                          f'({total / elapsed:,.0f} ids/s)')
+        self.stdout.write(f'collisions: {total - unique}, '
+                          f'non-monotonic within a thread: {out_of_order}')
+        if total != unique or out_of_order:
+            self.stdout.write(self.style.ERROR('FAILED'))
+        else:
+            self.stdout.write(self.style.SUCCESS('OK'))
@@ -0,0 +1,101 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+from django.test.utils import override_settings
+
+from app import group_commit
+from app.bench import run_threads, summarize
+from app.ids import next_id
+from app.models import Wallet
+
+
+def post_locking(wallet_id, amount):
+    with transaction.atomic():
+        wallet = Wallet.objects.select_for_update().get(id=wallet_id)
+        wallet.deposit(amount)
+
+
+def post_conditional(wallet_id, amount):
+    Wallet.objects.post_conditional([(wallet_id, 'D', amount)])
+
+
+def post_group(wallet_id, amount):
+    outcome = group_commit.deposit(wallet_id, amount)
+    if 'error' in outcome:
+        raise Wallet.DoesNotExist(outcome['error'])
+
+
+MODES = {'locking': post_locking, 'conditional': post_conditional, 'group': post_group}
+
+
+class Command(BaseCommand):
+    help = ('Hammer one wallet with concurrent deposits and report throughput '
+            'and latency per posting mode; group commit is run once per '
+            '--max-delay-ms value. Writes to the configured database; the '
+            'benchmark wallet is deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--ops', type=int, default=200,
+                            help='Deposits per thread.')
+        parser.add_argument('--mode', choices=['all', *MODES], default='all')
+        parser.add_argument('--max-batch', type=int,
+                            default=settings.WALLET_GROUP_COMMIT_MAX_BATCH)
+        parser.add_argument('--max-delay-ms', type=float, nargs='+',
+                            default=[settings.WALLET_GROUP_COMMIT_MAX_DELAY_MS])
+
+    def handle(self, *args, **options):
+        modes = list(MODES) if options['mode'] == 'all' else [options['mode']]
+        self.stdout.write(f'database: {connection.vendor}')
+        for mode in modes:
+            if mode != 'group':
+                self.run(mode, mode, options['threads'], options['ops'])
+                continue
+            for delay in options['max_delay_ms']:
+                with override_settings(WALLET_GROUP_COMMIT_MAX_BATCH=options['max_batch'],
+                                       WALLET_GROUP_COMMIT_MAX_DELAY_MS=delay):
+                    group_commit.shutdown_queue()
+                    queue = group_commit.get_queue()
+                    self.run(mode, f'group {delay:g}ms', options['threads'], options['ops'])
+                    group_commit.shutdown_queue()
+                if queue.stats['batches']:
+                    self.stdout.write(
+                        f'{"":>13}{queue.stats["batches"]} commits, '
+                        f'{queue.stats["deposits"] / queue.stats["batches"]:.1f} deposits each')
+
+    def run(self, mode, label, threads, ops):
+        post = MODES[mode]
+        wallet = Wallet.objects.create(id=next_id(), name=f'Benchmark ({mode})')
+        amount = Decimal('1.00')
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def work():
+            mine, failed = [], 0
+            try:
+                for _ in range(ops):
+                    started = time.perf_counter()
+                    try:
+                        post(wallet.id, amount)
+                    except OperationalError:
+                        failed += 1
+                        continue
+                    mine.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+            with lock:
+                latencies.extend(mine)
+                errors.append(failed)
+
+        elapsed = run_threads(work, threads)
+
+        wallet.refresh_from_db()
+        expected = amount * len(latencies)
+        self.stdout.write(
+            f'{label:>11}: {summarize(latencies, elapsed, "ops/s")}  errors {sum(errors)}  '
+            f'balance {"ok" if wallet.balance == expected else "MISMATCH"}')
+        wallet.delete()
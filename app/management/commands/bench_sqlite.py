@@ -0,0 +1,100 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+from django.test.utils import override_settings
+
+from app.ids import next_id
+from app.models import Transaction, Wallet
+
+# SQLite's own defaults, which the journal mode has to be switched back to
+# explicitly because it is stored in the database file.
+DEFAULT_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+
+class Command(BaseCommand):
+    help = ('Run a mixed read/write load against SQLite with its default '
+            'settings and with WALLET_SQLITE_PRAGMAS, and report throughput '
+            'and the rate of "database is locked" errors. Writes to the '
+            'configured database; the benchmark wallets are deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=5.0,
+                            help='Duration of each run.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError(f'Needs SQLite, not {connection.vendor}')
+
+        wallets = [Wallet.objects.create(id=next_id(), name='Benchmark (sqlite)')
+                   for _ in range(options['writers'])]
+        for wallet in wallets:
+            wallet.deposit(Decimal('1.00'))
+        try:
+            # Tuned last, so the database file is left in its configured mode.
+            for name, pragmas in (('default', DEFAULT_PRAGMAS),
+                                  ('tuned', settings.WALLET_SQLITE_PRAGMAS)):
+                begin = settings.WALLET_SQLITE_BEGIN if name == 'tuned' else None
+                with override_settings(WALLET_SQLITE_PRAGMAS=pragmas,
+                                       WALLET_SQLITE_BEGIN=begin):
+                    connections.close_all()
+                    self.run(name, wallets, options['readers'], options['seconds'])
+        finally:
+            connections.close_all()
+            Wallet.objects.filter(id__in=[wallet.id for wallet in wallets]).delete()
+
+    def run(self, name, wallets, readers, seconds):
+        stop = threading.Event()
+        counts = {'reads': 0, 'writes': 0, 'read errors': 0, 'write errors': 0}
+        lock = threading.Lock()
+
+        def read(wallet):
+            Wallet.objects.get(id=wallet.id)
+            list(Transaction.objects.filter(wallet=wallet)
+                 .order_by('-created_at', '-id')[:20])
+
+        def write(wallet):
+            with transaction.atomic():
+                Wallet.objects.select_for_update().get(id=wallet.id).deposit(Decimal('1.00'))
+
+        def work(operation, kind, wallet):
+            done = failed = 0
+            try:
+                while not stop.is_set():
+                    try:
+                        operation(wallet)
+                        done += 1
+                    except OperationalError:
+                        failed += 1
+            finally:
+                connections.close_all()
+            with lock:
+                counts[kind + 's'] += done
+                counts[kind + ' errors'] += failed
+
+        threads = [threading.Thread(target=work, args=(write, 'write', wallet))
+                   for wallet in wallets]
+        threads += [threading.Thread(target=work, args=(read, 'read', wallets[n % len(wallets)]))
+                    for n in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            mode = cursor.fetchone()[0]
+        attempts = sum(counts.values())
+        errors = counts['read errors'] + counts['write errors']
+        self.stdout.write(
+            f'{name:>7} ({mode}): {counts["reads"] / seconds:9,.1f} reads/s  '
+            f'{counts["writes"] / seconds:8,.1f} writes/s  '
+            f'locked {errors / attempts if attempts else 0:6.1%} '
+            f'({counts["read errors"]} reads, {counts["write errors"]} writes)')
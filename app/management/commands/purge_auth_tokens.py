@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.models import AuthToken
+
+
+class Command(BaseCommand):
+    help = 'Delete expired API tokens. They no longer authenticate anyone.'
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        purged = AuthToken.objects.purge(now)
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {purged} token(s) that expired before {now:%Y-%m-%d %H:%M}.'))
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = ('Delete stored Idempotency-Key responses older than '
+            'WALLET_IDEMPOTENCY_TTL seconds. Retries with a purged key post again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-seconds', type=int,
+                            default=settings.WALLET_IDEMPOTENCY_TTL)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(seconds=options['older_than_seconds'])
+        purged = IdempotencyKey.objects.purge(before)
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {purged} idempotency key(s) stored before {before:%Y-%m-%d %H:%M}.'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app.models import MonthlyBalance
+
+
+class Command(BaseCommand):
+    help = 'Back-fill the per-wallet monthly balance rollups from the ledger.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_ids', nargs='*',
+                            help='Only process these wallets (default: all).')
+
+    def handle(self, *args, **options):
+        written = MonthlyBalance.objects.rebuild(options['wallet_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {written} monthly balance row(s).'))
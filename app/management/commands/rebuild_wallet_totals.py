@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Sum
+
+from app.models import WalletShard, WalletTotals
+
+
+class Command(BaseCommand):
+    help = 'Rebuild (or verify) the per-wallet running totals from the ledger.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_ids', nargs='*',
+                            help='Only process these wallets (default: all).')
+        parser.add_argument('--verify', action='store_true',
+                            help='Report mismatches without writing anything.')
+
+    def handle(self, *args, **options):
+        wallet_ids = options['wallet_ids'] or None
+
+        if not options['verify']:
+            totals = WalletTotals.objects.rebuild(wallet_ids)
+            self.stdout.write(self.style.SUCCESS(
+                f'Rebuilt totals for {len(totals)} wallet(s).'))
+            return
+
+        computed = WalletTotals.objects.from_ledger(wallet_ids)
+        stored = WalletTotals.objects.all()
+        if wallet_ids is not None:
+            stored = stored.filter(wallet_id__in=wallet_ids)
+        stored = {totals.wallet_id: totals for totals in stored}
+
+        # Deposits held in sharded wallets' shards are not folded in yet.
+        pending = WalletShard.objects.filter(pending_count__gt=0)
+        if wallet_ids is not None:
+            pending = pending.filter(wallet_id__in=wallet_ids)
+        pending = pending.order_by().values('wallet_id').annotate(
+            deposited=Sum('pending_deposited'),
+            count=Sum('pending_count'),
+            last_transaction_at=Max('last_transaction_at'),
+        )
+        for row in pending:
+            totals = stored.get(row['wallet_id'])
+            if totals is None:
+                continue
+            totals.total_deposited += row['deposited']
+            totals.transaction_count += row['count']
+            if totals.last_transaction_at is None or \
+                    row['last_transaction_at'] > totals.last_transaction_at:
+                totals.last_transaction_at = row['last_transaction_at']
+
+        fields = ('total_deposited', 'total_withdrawn', 'transaction_count',
+                  'last_transaction_at')
+        mismatches = 0
+        for wallet_id in sorted(set(computed) | set(stored)):
+            expected = computed.get(wallet_id) or WalletTotals(
+                wallet_id=wallet_id, total_deposited=0, total_withdrawn=0)
+            actual = stored.get(wallet_id)
+            if actual is None:
+                mismatches += 1
+                self.stdout.write(f'{wallet_id}: totals missing')
+                continue
+            for field in fields:
+                want, have = getattr(expected, field), getattr(actual, field)
+                if want != have:
+                    mismatches += 1
+                    self.stdout.write(
+                        f'{wallet_id}: {field} is {have}, ledger says {want}')
+
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f'{mismatches} mismatch(es).'))
+        else:
+            self.stdout.write(self.style.SUCCESS('All wallet totals match the ledger.'))
@@ -0,0 +1,57 @@
+import csv
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import reconcile
+
+
+class Command(BaseCommand):
+    help = ("Check wallets' stored balances against their ledgers. An interrupted run "
+            'is resumed; after a finished run, only wallets with ledger activity since '
+            'it started are checked.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Check every wallet, ignoring earlier runs.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Abandon an unfinished run instead of resuming it.')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Worker processes checking chunks in parallel.')
+        parser.add_argument('--chunk-size', type=int, default=reconcile.CHUNK_SIZE,
+                            help='Wallets checked per chunk (and per checkpoint).')
+        parser.add_argument('--overlap-seconds', type=int,
+                            default=int(reconcile.OVERLAP.total_seconds()),
+                            help='How far before the previous run started to look for activity.')
+        parser.add_argument('--output', help='Also write the mismatch report to this CSV file.')
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--processes and --chunk-size must be at least 1.')
+
+        run = reconcile.start(options['full'], options['restart'],
+                              timedelta(seconds=options['overlap_seconds']))
+        scope = 'every wallet' if run.since is None else \
+            f'wallets with activity since {run.since:%Y-%m-%d %H:%M:%S}'
+        if run.checked_through:
+            scope += f', resuming after wallet {run.checked_through}'
+        self.stdout.write(f'Run {run.pk}: checking {scope}.')
+
+        reconcile.run(run, options['processes'], options['chunk_size'])
+
+        for wallet_id, stored, derived in run.mismatches:
+            self.stdout.write(f'{wallet_id}: stored balance is {stored}, ledger says {derived}')
+        if options['output']:
+            with open(options['output'], 'w', newline='') as report:
+                writer = csv.writer(report)
+                writer.writerow(['wallet_id', 'stored_balance', 'derived_balance', 'difference'])
+                for wallet_id, stored, derived in run.mismatches:
+                    writer.writerow([wallet_id, stored, derived, Decimal(stored) - Decimal(derived)])
+
+        if run.mismatches:
+            self.stdout.write(self.style.ERROR(
+                f'{len(run.mismatches)} mismatch(es) in {run.wallets_checked} wallet(s) checked.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'All {run.wallets_checked} wallet(s) checked match the ledger.'))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from app.models import Wallet, WalletShard, month_of
+
+
+class Command(BaseCommand):
+    help = ('Spread a hot wallet\'s deposits over N sub-balance shards '
+            '(0 folds the shards back and unshards the wallet).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_id')
+        parser.add_argument('shards', type=int)
+
+    def handle(self, *args, **options):
+        shards = options['shards']
+        if not 0 <= shards <= 256:
+            raise CommandError('Shard count must be between 0 and 256.')
+
+        with transaction.atomic():
+            try:
+                wallet = Wallet.objects.select_for_update().get(id=options['wallet_id'])
+            except Wallet.DoesNotExist:
+                raise CommandError(f'Wallet {options["wallet_id"]} not found.')
+
+            WalletShard.objects.collect(wallet)
+            WalletShard.objects.filter(wallet=wallet).delete()
+            month = month_of(timezone.now())
+            WalletShard.objects.bulk_create(
+                WalletShard(wallet=wallet, index=index, month=month)
+                for index in range(shards)
+            )
+            wallet.shard_count = shards
+            wallet.save(update_fields=['shard_count'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Wallet {wallet.id} now has {shards} shard(s).'))
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_auto_20210211_1121'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletTotals',
+            fields=[
+                ('wallet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='totals', serialize=False, to='app.wallet')),
+                ('total_deposited', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('total_withdrawn', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('transaction_count', models.PositiveIntegerField(default=0)),
+                ('last_transaction_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'wallet totals',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_wallettotals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('total_deposited', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('total_withdrawn', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('closing_balance', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_balances', to='app.wallet')),
+            ],
+            options={
+                'ordering': ['month'],
+                'unique_together': {('wallet', 'month')},
+            },
+        ),
+    ]
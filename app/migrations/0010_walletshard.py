@@ -0,0 +1,35 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_authtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='WalletShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('month', models.DateField()),
+                ('pending_deposited', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('pending_count', models.PositiveIntegerField(default=0)),
+                ('last_transaction_at', models.DateTimeField(blank=True, null=True)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='app.wallet')),
+            ],
+            options={
+                'unique_together': {('wallet', 'index')},
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_walletshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerArchive',
+            fields=[
+                ('wallet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='app.wallet')),
+                ('archived_before', models.DateTimeField()),
+                ('total_deposited', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('total_withdrawn', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('transaction_count', models.PositiveIntegerField(default=0)),
+                ('last_transaction_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('type', models.CharField(choices=[('D', 'Deposit'), ('W', 'Withdraw')], max_length=20)),
+                ('value', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('created_at', models.DateTimeField()),
+                ('wallet', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_transactions', to='app.wallet')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['wallet', 'created_at', 'id'], name='archived_wallet_created'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('since', models.DateTimeField(blank=True, null=True)),
+                ('checked_through', models.CharField(blank=True, default='', max_length=20)),
+                ('wallets_checked', models.PositiveIntegerField(default=0)),
+                ('mismatches', models.JSONField(default=list)),
+            ],
+            options={
+                'get_latest_by': 'started_at',
+            },
+        ),
+    ]
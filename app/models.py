@@ -1,7 +1,59 @@
-import time
+import hashlib
+import random
+import secrets
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
 
+from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, TruncMonth
+from django.utils import timezone
+
+from app import cache as wallet_cache
+from app.ids import next_id
+from app.ledger import ZERO, LedgerQuerySet
+
+
+# Wallets per bulk UPDATE of running totals and rollups: each one adds a
+# few parameters per column, and older SQLite builds allow 999 in all.
+BULK_UPDATE_CHUNK = 100
+
+AMOUNT = models.DecimalField(max_digits=20, decimal_places=2)
+# The largest amount or balance accepted. AMOUNT columns hold up to 18
+# integer digits, but SQLite stores decimals as floats, which only keep 15
+# significant digits exact.
+MAX_AMOUNT = Decimal('9' * 13 + '.99')
+
+
+def _chunks(keys, size=BULK_UPDATE_CHUNK):
+    keys = list(keys)
+    for start in range(0, len(keys), size):
+        yield keys[start:start + size]
+
+
+def _by_wallet(values, output_field, key='wallet_id'):
+    """
+    An UPDATE expression worth ``values[wallet_id]`` in each wallet's row
+    (matched on ``key``), with one CASE branch per distinct value.
+    """
+    wallets_by_value = {}
+    for wallet_id, value in values.items():
+        wallets_by_value.setdefault(value, []).append(wallet_id)
+    if len(wallets_by_value) == 1:
+        return Value(next(iter(wallets_by_value)), output_field=output_field)
+    return Case(*[When(**{f'{key}__in': wallet_ids},
+                       then=Value(value, output_field=output_field))
+                  for value, wallet_ids in wallets_by_value.items()],
+                output_field=output_field)
+
+
+def _held(wallet):
+    """What a sharded wallet's shards hold; zero for an unsharded one."""
+    if not wallet.shard_count:
+        return ZERO
+    return WalletShard.objects.pending(wallet)['balance']
 
 
 class UserManager(BaseUserManager):
@@ -62,6 +114,74 @@ class User(AbstractBaseUser):
         return self.is_admin
 
 
+class AuthTokenManager(models.Manager):
+    def issue(self, user):
+        """
+        Create a token for ``user`` and return its key. Only a hash of the
+        key is stored.
+        """
+        key = secrets.token_urlsafe(32)
+        self.create(
+            key=hash_token(key),
+            user=user,
+            expires_at=timezone.now() + timedelta(seconds=settings.WALLET_TOKEN_TTL),
+        )
+        return key
+
+    def purge(self, before):
+        """Delete tokens that expired before ``before``; returns how many."""
+        return self.filter(expires_at__lt=before).delete()[0]
+
+
+class AuthToken(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    user = models.ForeignKey(to='User', on_delete=models.CASCADE,
+                             related_name='auth_tokens')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    objects = AuthTokenManager()
+
+    def __str__(self):
+        return f'Token for {self.user} (expires {self.expires_at})'
+
+
+def hash_token(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class IdempotencyKeyManager(models.Manager):
+    def lookup(self, key):
+        """
+        Return the stored ``(fingerprint, status_code, response)`` for
+        ``key``, or ``None``.
+        """
+        return self.filter(key=key).values_list(
+            'fingerprint', 'status_code', 'response').first()
+
+    def purge(self, before):
+        """Delete keys stored before ``before``; returns how many."""
+        return self.filter(created_at__lt=before).delete()[0]
+
+
+class IdempotencyKey(models.Model):
+    """
+    The response a request sent with an ``Idempotency-Key`` header got.
+    ``key`` hashes the caller and the header value; ``fingerprint`` hashes
+    the request, so a key reused for a different request can be refused.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = IdempotencyKeyManager()
+
+    def __str__(self):
+        return f'Idempotency key {self.key} ({self.status_code})'
+
+
 class Transaction(models.Model):
     TRANSACTION_TYPE = [
         ('D', 'Deposit'),
@@ -69,16 +189,274 @@ class Transaction(models.Model):
     ]
 
     id = models.CharField(max_length=20, primary_key=True)
-    wallet = models.ForeignKey(to='Wallet', on_delete=models.CASCADE)
+    # Wallet lookups are served by the composite indexes below.
+    wallet = models.ForeignKey(to='Wallet', on_delete=models.CASCADE,
+                               db_index=False)
     type = models.CharField(choices=TRANSACTION_TYPE, max_length=20)
     value = models.DecimalField(decimal_places=2, max_digits=20)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = LedgerQuerySet.as_manager()
+
     def __str__(self):
         return f'{self.created_at} Reference No. {self.id}'
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # History pages and date ranges: keyset order is (created_at, id).
+            models.Index(fields=['wallet', 'created_at', 'id'],
+                         name='transaction_wallet_created'),
+            # Per-type totals over a date range.
+            models.Index(fields=['wallet', 'type', 'created_at'],
+                         name='transaction_wallet_type'),
+        ]
+
+
+class ArchivedTransaction(models.Model):
+    """
+    A ledger row moved out of ``Transaction`` by
+    ``LedgerArchive.objects.archive``, with its original posting time.
+    """
+    id = models.CharField(max_length=20, primary_key=True)
+    wallet = models.ForeignKey(to='Wallet', on_delete=models.CASCADE,
+                               db_index=False,
+                               related_name='archived_transactions')
+    type = models.CharField(choices=Transaction.TRANSACTION_TYPE, max_length=20)
+    value = models.DecimalField(decimal_places=2, max_digits=20)
+    created_at = models.DateTimeField()
+
+    objects = LedgerQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.created_at} Reference No. {self.id} (archived)'
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['wallet', 'created_at', 'id'],
+                         name='archived_wallet_created'),
+        ]
+
+
+class InsufficientBalance(Exception):
+    def __init__(self, wallet_id, balance):
+        super().__init__(f'Insufficient balance in wallet {wallet_id}')
+        self.wallet_id = wallet_id
+        self.balance = balance
+
+
+class BalanceLimitExceeded(Exception):
+    def __init__(self, wallet_id):
+        super().__init__(f'Balance limit exceeded in wallet {wallet_id}')
+        self.wallet_id = wallet_id
+
+
+class WalletManager(models.Manager):
+    def lock(self, wallet_ids):
+        """
+        Lock the wallets with a single ``SELECT ... FOR UPDATE`` ordered by
+        id, so that transactions locking overlapping wallets always queue
+        in the same order and cannot deadlock. Returns the wallets found by
+        id. Must run inside a transaction.
+        """
+        wallet_ids = sorted({str(wallet_id) for wallet_id in wallet_ids})
+        return {wallet.id: wallet for wallet in
+                self.select_for_update().filter(id__in=wallet_ids).order_by('id')}
+
+    def post(self, entries):
+        """
+        Record ``(wallet, type, amount)`` entries in the ledger and apply
+        them to the wallets' balances with one INSERT for all ledger rows
+        and one ``balance = balance +/- x`` UPDATE per wallet. Callers are
+        expected to hold the wallets' row locks; in-memory balances are
+        kept in step. Raises ``BalanceLimitExceeded`` (rolling back) if a
+        credit would take a wallet past ``MAX_AMOUNT``. Returns the new
+        ledger rows.
+        """
+        ledger_rows = [Transaction(id=next_id(), wallet=wallet, type=tx_type,
+                                   value=amount)
+                       for wallet, tx_type, amount in entries]
+        wallets, deltas = {}, {}
+        for wallet, tx_type, amount in entries:
+            delta = amount if tx_type == 'D' else -amount
+            wallets[wallet.pk] = wallet
+            deltas[wallet.pk] = deltas.get(wallet.pk, 0) + delta
+
+        with transaction.atomic(savepoint=False):
+            Transaction.objects.bulk_create(ledger_rows)
+            for wallet_id, delta in deltas.items():
+                rows = self.filter(pk=wallet_id)
+                if delta > 0:
+                    rows = rows.filter(balance__lte=MAX_AMOUNT - delta - _held(wallets[wallet_id]))
+                if not rows.update(balance=F('balance') + delta) and delta > 0:
+                    raise BalanceLimitExceeded(wallet_id)
+            for wallet, tx_type, amount in entries:
+                wallet.balance += amount if tx_type == 'D' else -amount
+            WalletTotals.objects.record_many(ledger_rows)
+            MonthlyBalance.objects.record_many(ledger_rows)
+            wallet_cache.invalidate_wallets(deltas)
+        return ledger_rows
+
+    def post_conditional(self, entries):
+        """
+        Lock-free alternative to ``post`` for ``(wallet_id, type, amount)``
+        entries: each wallet's balance is changed by a single conditional
+        UPDATE (``... WHERE balance >= x`` when debiting), in wallet id
+        order, without reading or locking the row first. Raises
+        ``Wallet.DoesNotExist``, ``InsufficientBalance`` or
+        ``BalanceLimitExceeded`` (rolling back every change) if any wallet
+        cannot be updated.
+
+        Returns the new ledger rows and the resulting balances by wallet id.
+        """
+        entries = [(str(wallet_id), tx_type, amount)
+                   for wallet_id, tx_type, amount in entries]
+        deltas = {}
+        for wallet_id, tx_type, amount in entries:
+            delta = amount if tx_type == 'D' else -amount
+            deltas[wallet_id] = deltas.get(wallet_id, 0) + delta
+
+        with transaction.atomic():
+            for wallet_id in sorted(deltas):
+                delta = deltas[wallet_id]
+                wallets = self.filter(pk=wallet_id)
+                if delta < 0:
+                    wallets = wallets.filter(balance__gte=-delta)
+                elif delta > 0:
+                    wallets = wallets.filter(balance__lte=MAX_AMOUNT - delta)
+                if not wallets.update(balance=F('balance') + delta):
+                    wallet = self.filter(pk=wallet_id).first()
+                    if wallet is None:
+                        raise self.model.DoesNotExist(f'Wallet {wallet_id} not found')
+                    if delta > 0:
+                        raise BalanceLimitExceeded(wallet_id)
+                    if wallet.shard_count:
+                        # Part of the balance may still sit in its shards.
+                        WalletShard.objects.collect(wallet)
+                        if wallets.update(balance=F('balance') + delta):
+                            continue
+                    raise InsufficientBalance(wallet_id, wallet.balance)
+
+            ledger_rows = [Transaction(id=next_id(), wallet_id=wallet_id,
+                                       type=tx_type, value=amount)
+                           for wallet_id, tx_type, amount in entries]
+            Transaction.objects.bulk_create(ledger_rows)
+            WalletTotals.objects.record_many(ledger_rows)
+            MonthlyBalance.objects.record_many(ledger_rows)
+            wallet_cache.invalidate_wallets(deltas)
+            balances = dict(self.filter(pk__in=deltas).values_list('id', 'balance'))
+        return ledger_rows, balances
+
+    def fan_out(self, source_id, credits):
+        """
+        Move money from one wallet to many in a single transaction.
+        ``credits`` are ``(wallet_id, amount)`` pairs; a wallet may appear
+        more than once. Every wallet is locked in one ordered query, the
+        source is debited once for the total, the ledger rows go in with
+        one INSERT, and balances, running totals and rollups are updated
+        ``BULK_UPDATE_CHUNK`` wallets per UPDATE. Raises
+        ``Wallet.DoesNotExist``, ``InsufficientBalance`` or
+        ``BalanceLimitExceeded`` (when a recipient would pass
+        ``MAX_AMOUNT``) without changing anything.
+
+        Returns the ledger rows (the debit first) and the wallets by id.
+        """
+        with transaction.atomic():
+            wallets = self.lock([source_id, *(wallet_id for wallet_id, _ in credits)])
+            source = wallets.get(str(source_id))
+            if source is None or any(str(wallet_id) not in wallets
+                                     for wallet_id, _ in credits):
+                raise self.model.DoesNotExist('Wallet not found')
+            WalletShard.objects.collect(source)
+
+            total = sum(amount for _, amount in credits)
+            if source.balance < total:
+                raise InsufficientBalance(source.id, source.balance)
+            ledger_rows = [Transaction(id=next_id(), wallet=source, type='W', value=total)]
+            deltas = {source.id: -total}
+            for wallet_id, amount in credits:
+                wallet = wallets[str(wallet_id)]
+                ledger_rows.append(Transaction(id=next_id(), wallet=wallet,
+                                               type='D', value=amount))
+                deltas[wallet.id] = deltas.get(wallet.id, 0) + amount
+            for wallet_id, delta in deltas.items():
+                wallet = wallets[wallet_id]
+                if delta > 0 and wallet.balance + _held(wallet) + delta > MAX_AMOUNT:
+                    raise BalanceLimitExceeded(wallet_id)
+
+            Transaction.objects.bulk_create(ledger_rows)
+            for chunk in _chunks(deltas):
+                self.filter(id__in=chunk).update(balance=F('balance') + _by_wallet(
+                    {wallet_id: deltas[wallet_id] for wallet_id in chunk}, AMOUNT, 'id'))
+            for wallet_id, delta in deltas.items():
+                wallets[wallet_id].balance += delta
+            WalletTotals.objects.record_many(ledger_rows)
+            MonthlyBalance.objects.record_many(ledger_rows)
+            wallet_cache.invalidate_wallets(wallets)
+        return ledger_rows, wallets
+
+    def post_batch(self, operations):
+        """
+        Apply ``(wallet_id, type, amount)`` operations, in order, in a single
+        database transaction. Wallets are locked once, in id order, and the
+        ledger rows and balances are written in bulk. Sharded wallets that
+        are only credited are not locked: their deposits go to their shards
+        (``WalletShard.objects.deposit``) instead.
+
+        Returns one entry per operation: ``{'transaction': ..., 'balance':
+        ...}`` when it was applied, or ``{'error': ...}`` when it was not.
+        """
+        wallet_ids = {wallet_id for wallet_id, _, _ in operations}
+        debited = {wallet_id for wallet_id, tx_type, _ in operations if tx_type == 'W'}
+        sharded = {wallet.id: wallet for wallet in
+                   self.filter(id__in=wallet_ids - debited, shard_count__gt=0)}
+        results, ledger_rows, touched = [], [], {}
+
+        with transaction.atomic():
+            wallets = self.lock(wallet_ids - set(sharded))
+            for wallet in wallets.values():
+                WalletShard.objects.collect(wallet)
+            for wallet_id, tx_type, amount in operations:
+                if wallet_id in sharded:
+                    wallet = sharded[wallet_id]
+                    try:
+                        ledger_row = WalletShard.objects.deposit(wallet, amount)
+                    except BalanceLimitExceeded:
+                        results.append({'error': 'Balance limit exceeded'})
+                        continue
+                    results.append({'transaction': ledger_row,
+                                    'balance': wallet.available_balance()})
+                    continue
+                wallet = wallets.get(wallet_id)
+                if wallet is None:
+                    results.append({'error': 'Wallet not found'})
+                    continue
+                if tx_type == 'W':
+                    if wallet.balance < amount:
+                        results.append({'error': 'Insufficient balance'})
+                        continue
+                    wallet.balance -= amount
+                else:
+                    if wallet.balance + amount > MAX_AMOUNT:
+                        results.append({'error': 'Balance limit exceeded'})
+                        continue
+                    wallet.balance += amount
+
+                ledger_row = Transaction(id=next_id(), wallet=wallet,
+                                         type=tx_type, value=amount)
+                ledger_rows.append(ledger_row)
+                touched[wallet.id] = wallet
+                results.append({'transaction': ledger_row,
+                                'balance': wallet.balance})
+
+            Transaction.objects.bulk_create(ledger_rows)
+            self.bulk_update(touched.values(), ['balance'])
+            WalletTotals.objects.record_many(ledger_rows)
+            MonthlyBalance.objects.record_many(ledger_rows)
+            wallet_cache.invalidate_wallets(touched)
+
+        return results
 
 
 class Wallet(models.Model):
@@ -86,24 +464,723 @@ class Wallet(models.Model):
     # user = models.ForeignKey(to='User', on_delete=models.CASCADE)
     balance = models.DecimalField(decimal_places=2, default=0, max_digits=20)
     name = models.CharField(max_length=255)
+    # Number of sub-balance shards deposits are spread over (0: unsharded).
+    shard_count = models.PositiveSmallIntegerField(default=0)
+
+    objects = WalletManager()
+
+    def available_balance(self):
+        """
+        The wallet's balance including deposits held in its shards.
+        """
+        if not self.shard_count:
+            return self.balance
+        return self.balance + WalletShard.objects.pending(self)['balance']
 
     def withdraw(self, amount):
-        self.balance -= amount
-        transaction_id = int(round(time.time() * 1000))
-        transaction = Transaction.objects.create(id=transaction_id,
-                                                 wallet=self, type='W',
-                                                 value=amount)
-        self.save()
-        transaction.save()
+        return Wallet.objects.post([(self, 'W', amount)])[0]
 
     def deposit(self, amount):
-        self.balance += amount
-        transaction_id = int(round(time.time() * 1000))
-        transaction = Transaction.objects.create(id=transaction_id,
-                                                 wallet=self, type='D',
-                                                 value=amount)
-        self.save()
-        transaction.save()
+        return Wallet.objects.post([(self, 'D', amount)])[0]
+
+    def transfer_to(self, to_wallet, amount):
+        return Wallet.objects.post([(self, 'W', amount), (to_wallet, 'D', amount)])
 
     def __str__(self):
         return f'({self.id}) {self.name}'
+
+
+class WalletTotalsManager(models.Manager):
+    def record(self, ledger_row):
+        """
+        Fold a freshly inserted ledger row into its wallet's running totals.
+        Must run in the same database transaction as the insert.
+        """
+        self.record_many([ledger_row])
+
+    def record_many(self, ledger_rows):
+        """
+        Fold freshly inserted ledger rows into running totals (see
+        ``apply``). Must run in the same database transaction as the
+        inserts.
+        """
+        changes = {}
+        for row in ledger_rows:
+            change = changes.setdefault(row.wallet_id, {
+                'total_deposited': Decimal('0.00'),
+                'total_withdrawn': Decimal('0.00'),
+                'transaction_count': 0,
+                'last_transaction_at': row.created_at,
+            })
+            field = 'total_deposited' if row.type == 'D' else 'total_withdrawn'
+            change[field] += row.value
+            change['transaction_count'] += 1
+            change['last_transaction_at'] = max(change['last_transaction_at'],
+                                                row.created_at)
+
+        self.apply(changes)
+
+    def apply(self, changes):
+        """
+        Add ``{wallet_id: {'total_deposited': ..., 'total_withdrawn': ...,
+        'transaction_count': ..., 'last_transaction_at': ...}}`` to the
+        running totals, one UPDATE per ``BULK_UPDATE_CHUNK`` wallets. The
+        ledger must already contain the rows being counted.
+        """
+        missing = []
+        for chunk in _chunks(changes):
+            def column(name, output_field):
+                return _by_wallet({wallet_id: changes[wallet_id][name]
+                                   for wallet_id in chunk}, output_field)
+
+            last = column('last_transaction_at', models.DateTimeField())
+            updated = self.filter(wallet_id__in=chunk).update(
+                total_deposited=F('total_deposited') + column('total_deposited', AMOUNT),
+                total_withdrawn=F('total_withdrawn') + column('total_withdrawn', AMOUNT),
+                transaction_count=F('transaction_count') + column(
+                    'transaction_count', models.IntegerField()),
+                last_transaction_at=Coalesce(Greatest('last_transaction_at', last), last),
+            )
+            if updated < len(chunk):
+                found = set(self.filter(wallet_id__in=chunk)
+                            .values_list('wallet_id', flat=True))
+                missing += [wallet_id for wallet_id in chunk if wallet_id not in found]
+        if missing:
+            # Wallets that predate the totals table are seeded from the
+            # ledger, which already contains the new rows.
+            self.rebuild(missing)
+
+    def for_wallet(self, wallet):
+        """
+        Return the wallet's totals, seeding them from the ledger if missing.
+        Fetch the wallet with ``select_related('totals')`` to avoid a query.
+        """
+        try:
+            totals = wallet.totals
+        except self.model.DoesNotExist:
+            totals = self.rebuild([wallet.id])[0]
+        if wallet.shard_count:
+            pending = WalletShard.objects.pending(wallet)
+            totals.total_deposited += pending['deposited']
+            totals.transaction_count += pending['count']
+            if pending['last_transaction_at'] and (
+                    totals.last_transaction_at is None or
+                    pending['last_transaction_at'] > totals.last_transaction_at):
+                totals.last_transaction_at = pending['last_transaction_at']
+        return totals
+
+    def from_ledger(self, wallet_ids=None):
+        """
+        Compute totals for the given wallets (or all wallets) straight from
+        the ledger in a single grouped query, plus what archiving carried
+        forward. Wallets without transactions are not included.
+        """
+        ledger = Transaction.objects.all()
+        archives = LedgerArchive.objects.all()
+        if wallet_ids is not None:
+            ledger = ledger.filter(wallet_id__in=wallet_ids)
+            archives = archives.filter(wallet_id__in=wallet_ids)
+        rows = ledger.totals_by('wallet_id')
+        computed = {
+            row['wallet_id']: self.model(
+                wallet_id=row['wallet_id'],
+                total_deposited=ZERO + (row['total_deposited'] or ZERO),
+                total_withdrawn=ZERO + (row['total_withdrawn'] or ZERO),
+                transaction_count=row['transaction_count'],
+                last_transaction_at=row['last_transaction_at'],
+            )
+            for row in rows
+        }
+        for archive in archives:
+            totals = computed.setdefault(archive.wallet_id, self.model(
+                wallet_id=archive.wallet_id,
+                total_deposited=Decimal('0.00'),
+                total_withdrawn=Decimal('0.00'),
+                # Archived rows all predate the live ones.
+                last_transaction_at=archive.last_transaction_at,
+            ))
+            totals.total_deposited += archive.total_deposited
+            totals.total_withdrawn += archive.total_withdrawn
+            totals.transaction_count += archive.transaction_count
+        return computed
+
+    def rebuild(self, wallet_ids=None):
+        """
+        Recompute and store totals from the ledger, returning the rows.
+        """
+        wallets = Wallet.objects.all()
+        if wallet_ids is not None:
+            wallets = wallets.filter(id__in=wallet_ids)
+        wallet_ids = list(wallets.values_list('id', flat=True))
+        with transaction.atomic():
+            WalletShard.objects.fold(
+                WalletShard.objects.filter(wallet_id__in=wallet_ids))
+            computed = self.from_ledger(wallet_ids)
+            empty = {'total_deposited': Decimal('0.00'),
+                     'total_withdrawn': Decimal('0.00')}
+            totals = [computed.get(wallet_id) or
+                      self.model(wallet_id=wallet_id, **empty)
+                      for wallet_id in wallet_ids]
+            self.filter(wallet_id__in=wallet_ids).delete()
+            self.bulk_create(totals)
+            wallet_cache.invalidate_wallets(wallet_ids)
+        return totals
+
+
+class WalletTotals(models.Model):
+    """
+    Running per-wallet totals maintained alongside the ledger so that
+    summaries do not have to re-aggregate every transaction.
+    """
+    wallet = models.OneToOneField(to='Wallet', on_delete=models.CASCADE,
+                                  primary_key=True, related_name='totals')
+    total_deposited = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+    total_withdrawn = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+    transaction_count = models.PositiveIntegerField(default=0)
+    last_transaction_at = models.DateTimeField(null=True, blank=True)
+
+    objects = WalletTotalsManager()
+
+    @property
+    def net(self):
+        return self.total_deposited - self.total_withdrawn
+
+    def __str__(self):
+        return f'Totals for wallet {self.wallet_id}'
+
+    class Meta:
+        verbose_name_plural = 'wallet totals'
+
+
+class MonthlyBalanceManager(models.Manager):
+    def record(self, ledger_row):
+        """
+        Fold a freshly inserted ledger row into its wallet's rollup for the
+        month. Must run in the same database transaction as the insert.
+        """
+        self.record_many([ledger_row])
+
+    def record_many(self, ledger_rows):
+        """
+        Fold freshly inserted ledger rows into the monthly rollups with one
+        UPDATE per month and ``BULK_UPDATE_CHUNK`` wallets, creating the
+        rollups that do not exist yet in bulk. Must run in the same
+        database transaction as the inserts.
+        """
+        changes, pks = {}, {}
+        for row in ledger_rows:
+            change = changes.setdefault(month_of(row.created_at), {}).setdefault(
+                row.wallet_id, {'deposited': Decimal('0.00'), 'withdrawn': Decimal('0.00')})
+            change['deposited' if row.type == 'D' else 'withdrawn'] += row.value
+            pks.setdefault(row.wallet_id, []).append(row.pk)
+
+        seeded = set()
+        for month in sorted(changes):
+            # Rebuilt wallets already include these rows, in every month.
+            wallets = {wallet_id: change for wallet_id, change in changes[month].items()
+                       if wallet_id not in seeded}
+            for chunk in _chunks(wallets):
+                def column(name):
+                    return _by_wallet({wallet_id: wallets[wallet_id][name]
+                                       for wallet_id in chunk}, AMOUNT)
+
+                deposited, withdrawn = column('deposited'), column('withdrawn')
+                rollups = self.filter(wallet_id__in=chunk, month=month)
+                updated = rollups.update(
+                    total_deposited=F('total_deposited') + deposited,
+                    total_withdrawn=F('total_withdrawn') + withdrawn,
+                    closing_balance=F('closing_balance') + deposited - withdrawn,
+                )
+                if updated < len(chunk):
+                    found = set(rollups.values_list('wallet_id', flat=True))
+                    seeded |= self._start_month(
+                        month, {wallet_id: wallets[wallet_id] for wallet_id in chunk
+                                if wallet_id not in found}, pks)
+
+    def _start_month(self, month, changes, pks):
+        """
+        Create the rollups for ``month`` of wallets that have none yet,
+        opening at the previous month's closing balance. Wallets with
+        ledger history from before rollups were kept are rebuilt instead;
+        returns their ids.
+        """
+        previous = self.filter(wallet_id=OuterRef('pk'), month__lt=month).order_by('-month')
+        openings = dict(Wallet.objects.filter(id__in=changes).annotate(
+            opening=Subquery(previous.values('closing_balance')[:1])
+        ).values_list('id', 'opening'))
+
+        unopened = [wallet_id for wallet_id in changes if openings.get(wallet_id) is None]
+        new_pks = [pk for wallet_id in unopened for pk in pks[wallet_id]]
+        legacy = set(Transaction.objects.filter(wallet_id__in=unopened)
+                     .exclude(pk__in=new_pks).values_list('wallet_id', flat=True)
+                     .distinct()) if unopened else set()
+        legacy |= set(LedgerArchive.objects.filter(wallet_id__in=unopened)
+                      .values_list('wallet_id', flat=True)) if unopened else set()
+        if legacy:
+            # The wallets have history from before rollups were kept.
+            self.rebuild(sorted(legacy))
+
+        self.bulk_create([
+            self.model(
+                wallet_id=wallet_id,
+                month=month,
+                total_deposited=change['deposited'],
+                total_withdrawn=change['withdrawn'],
+                closing_balance=(openings.get(wallet_id) or Decimal('0.00'))
+                + change['deposited'] - change['withdrawn'],
+            )
+            for wallet_id, change in changes.items() if wallet_id not in legacy
+        ])
+        return legacy
+
+    def add_late(self, wallet_id, month, deposited):
+        """
+        Add deposits made during ``month`` that are being folded in after
+        the fact, carrying them into the closing balance of later months.
+        """
+        updated = self.filter(wallet_id=wallet_id, month=month).update(
+            total_deposited=F('total_deposited') + deposited,
+            closing_balance=F('closing_balance') + deposited,
+        )
+        if not updated:
+            if not self.filter(wallet_id=wallet_id).exists():
+                # No rollups yet: the ledger already holds these deposits.
+                self.rebuild([wallet_id])
+                return
+            previous = self.filter(wallet_id=wallet_id,
+                                   month__lt=month).order_by('-month').first()
+            opening = previous.closing_balance if previous else Decimal('0.00')
+            self.create(
+                wallet_id=wallet_id,
+                month=month,
+                total_deposited=deposited,
+                total_withdrawn=Decimal('0.00'),
+                closing_balance=opening + deposited,
+            )
+        self.filter(wallet_id=wallet_id, month__gt=month).update(
+            closing_balance=F('closing_balance') + deposited)
+
+    def for_year(self, wallet, year):
+        """
+        Return the balance carried into ``year`` and the wallet's rollups
+        for that year keyed by month number, seeding rollups from the
+        ledger for wallets that predate them.
+        """
+        opening, rollups = self.for_range(wallet, date(year, 1, 1), date(year, 12, 1))
+        return opening, {month.month: rollup for month, rollup in rollups.items()}
+
+    def for_range(self, wallet, first_month, last_month):
+        """
+        Return the balance carried into ``first_month`` and the wallet's
+        rollups from ``first_month`` to ``last_month`` (both first days of
+        months) keyed by month, seeding rollups from the ledger for wallets
+        that predate them.
+        """
+        rollups = list(self.filter(wallet=wallet, month__gte=first_month,
+                                   month__lte=last_month))
+        previous = self.filter(wallet=wallet, month__lt=first_month) \
+            .order_by('-month').first()
+        end = start_of(next_month(last_month))
+        if not rollups and previous is None and (Transaction.objects.filter(
+                wallet=wallet, created_at__lt=end).exists() or
+                ArchivedTransaction.objects.filter(
+                    wallet=wallet, created_at__lt=end).exists()):
+            self.rebuild([wallet.id])
+            return self.for_range(wallet, first_month, last_month)
+
+        opening = previous.closing_balance if previous else Decimal('0.00')
+        rollups = {rollup.month: rollup for rollup in rollups}
+        if wallet.shard_count:
+            for month, deposited in WalletShard.objects.pending(wallet)['by_month'].items():
+                if month < first_month:
+                    opening += deposited
+                elif month <= last_month:
+                    rollup = rollups.setdefault(month, self.model(
+                        wallet=wallet, month=month,
+                        total_deposited=Decimal('0.00'),
+                        total_withdrawn=Decimal('0.00')))
+                    rollup.total_deposited += deposited
+        return opening, rollups
+
+    def rebuild(self, wallet_ids=None, batch_size=1000):
+        """
+        Recompute and store the monthly rollups from the ledger and its
+        archive using a single grouped query. Returns the number of rows
+        written.
+        """
+        ledgers = [Transaction.objects.all(), ArchivedTransaction.objects.all()]
+        rollups = self.all()
+        if wallet_ids is not None:
+            ledgers = [ledger.filter(wallet_id__in=wallet_ids) for ledger in ledgers]
+            rollups = rollups.filter(wallet_id__in=wallet_ids)
+        live, archived = [
+            ledger.annotate(
+                month=TruncMonth('created_at', output_field=models.DateField())
+            ).totals_by('wallet_id', 'month')
+            for ledger in ledgers
+        ]
+        # The month archiving stopped in can have rows in both tables; the
+        # ordering puts them next to each other.
+        rows = live.union(archived, all=True).order_by('wallet_id', 'month')
+
+        written = 0
+        with transaction.atomic():
+            shards = WalletShard.objects.all()
+            if wallet_ids is not None:
+                shards = shards.filter(wallet_id__in=wallet_ids)
+            WalletShard.objects.fold(shards)
+            rollups.delete()
+            batch = []
+            wallet_id, balance = None, Decimal('0.00')
+            for row in rows.iterator():
+                deposited = row['total_deposited'] or Decimal('0.00')
+                withdrawn = row['total_withdrawn'] or Decimal('0.00')
+                if row['wallet_id'] != wallet_id:
+                    wallet_id, balance = row['wallet_id'], Decimal('0.00')
+                balance += deposited - withdrawn
+                if batch and (batch[-1].wallet_id, batch[-1].month) == \
+                        (wallet_id, row['month']):
+                    batch[-1].total_deposited += deposited
+                    batch[-1].total_withdrawn += withdrawn
+                    batch[-1].closing_balance = balance
+                    continue
+                if len(batch) >= batch_size:
+                    written += len(self.bulk_create(batch))
+                    batch = []
+                batch.append(self.model(
+                    wallet_id=wallet_id,
+                    month=row['month'],
+                    total_deposited=deposited,
+                    total_withdrawn=withdrawn,
+                    closing_balance=balance,
+                ))
+            written += len(self.bulk_create(batch))
+            if wallet_ids is None:
+                wallet_cache.invalidate_all()
+            else:
+                wallet_cache.invalidate_wallets(wallet_ids)
+        return written
+
+
+class MonthlyBalance(models.Model):
+    """
+    Per-wallet, per-month rollup of the ledger. ``month`` is the first day
+    of the month and ``closing_balance`` is the ledger balance at its end.
+    """
+    wallet = models.ForeignKey(to='Wallet', on_delete=models.CASCADE,
+                               related_name='monthly_balances')
+    month = models.DateField()
+    total_deposited = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+    total_withdrawn = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+    closing_balance = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+
+    objects = MonthlyBalanceManager()
+
+    @property
+    def opening_balance(self):
+        return self.closing_balance - self.total_deposited + self.total_withdrawn
+
+    def __str__(self):
+        return f'{self.month:%Y-%m} for wallet {self.wallet_id}'
+
+    class Meta:
+        ordering = ['month']
+        unique_together = ['wallet', 'month']
+
+
+class WalletShardManager(models.Manager):
+    def deposit(self, wallet, amount):
+        """
+        Deposit into a random shard of a sharded wallet without reading or
+        locking the wallet row; concurrent deposits only contend when they
+        pick the same shard. The running totals and monthly rollups are
+        caught up when the shard is folded.
+
+        If ``shard_wallet`` has removed the shard since ``wallet`` was read,
+        or the deposit would take the wallet past ``MAX_AMOUNT``, the deposit
+        is made with the wallet row locked instead, and ``wallet`` is
+        refreshed. Raises ``BalanceLimitExceeded`` if it still does not fit.
+        """
+        index = random.randrange(wallet.shard_count)
+        try:
+            with transaction.atomic():
+                ledger_row = Transaction.objects.create(id=next_id(), wallet=wallet,
+                                                        type='D', value=amount)
+                month = month_of(ledger_row.created_at)
+                shard = self.filter(wallet=wallet, index=index,
+                                    balance__lte=MAX_AMOUNT - amount)
+                changes = {
+                    'balance': F('balance') + amount,
+                    'pending_deposited': F('pending_deposited') + amount,
+                    'pending_count': F('pending_count') + 1,
+                    'last_transaction_at': ledger_row.created_at,
+                }
+                if not shard.filter(month=month).update(**changes):
+                    # First deposit of the month on this shard: counters held
+                    # for an earlier month are folded before the shard moves on.
+                    self.fold(shard)
+                    if not shard.update(month=month, **changes):
+                        if self.filter(wallet=wallet, index=index).exists():
+                            raise BalanceLimitExceeded(wallet.pk)
+                        # Only shard_wallet creates shards, so the wallet has
+                        # been unsharded or resharded meanwhile.
+                        raise self.model.DoesNotExist
+                # Deposits racing on other shards are not seen here, so two
+                # of them can still pass the limit together; collect() then
+                # refuses to fold the excess into the wallet row.
+                balance, held = Wallet.objects.filter(pk=wallet.pk).annotate(
+                    held=Sum('shards__balance')).values_list('balance', 'held').get()
+                if balance + held > MAX_AMOUNT:
+                    raise BalanceLimitExceeded(wallet.pk)
+                wallet_cache.invalidate_wallets([wallet.pk])
+            return ledger_row
+        except self.model.DoesNotExist:
+            full = False
+        except BalanceLimitExceeded:
+            full = True
+
+        with transaction.atomic():
+            # shard_wallet holds this lock while it changes the shards.
+            locked = Wallet.objects.select_for_update().get(pk=wallet.pk)
+            if locked.shard_count and not full:
+                ledger_row = self.deposit(locked, amount)
+            else:
+                # With the shards folded into the locked row, post() checks
+                # the limit against the whole balance.
+                self.collect(locked)
+                ledger_row = locked.deposit(amount)
+        wallet.balance, wallet.shard_count = locked.balance, locked.shard_count
+        return ledger_row
+
+    def fold(self, shards):
+        """
+        Move the shards' pending deposit counters into the running totals
+        and monthly rollups. Balances stay in the shards. Rebuilds from the
+        ledger fold first, or they would count pending deposits twice.
+        """
+        pending = [shard for shard in
+                   shards.select_for_update().order_by('wallet_id', 'index')
+                   if shard.pending_count]
+        if not pending:
+            return
+        self.filter(pk__in=[shard.pk for shard in pending]).update(
+            pending_deposited=0, pending_count=0)
+
+        changes = {}
+        for shard in pending:
+            change = changes.setdefault(shard.wallet_id, {
+                'total_deposited': Decimal('0.00'),
+                'total_withdrawn': Decimal('0.00'),
+                'transaction_count': 0,
+                'last_transaction_at': shard.last_transaction_at,
+            })
+            change['total_deposited'] += shard.pending_deposited
+            change['transaction_count'] += shard.pending_count
+            change['last_transaction_at'] = max(change['last_transaction_at'],
+                                                shard.last_transaction_at)
+        WalletTotals.objects.apply(changes)
+        for shard in pending:
+            MonthlyBalance.objects.add_late(shard.wallet_id, shard.month,
+                                            shard.pending_deposited)
+
+    def collect(self, wallet):
+        """
+        Fold a sharded wallet's shards back into the wallet row so that it
+        can be debited. The caller must hold the wallet's row lock. Raises
+        ``BalanceLimitExceeded`` if the row cannot hold them.
+        """
+        if not wallet.shard_count:
+            return
+        shards = self.filter(wallet=wallet)
+        self.fold(shards)
+        held = shards.aggregate(total=Sum('balance'))['total']
+        if held:
+            shards.update(balance=0)
+            if not Wallet.objects.filter(pk=wallet.pk, balance__lte=MAX_AMOUNT - held).update(
+                    balance=F('balance') + held):
+                raise BalanceLimitExceeded(wallet.pk)
+            wallet.balance += held
+
+    def pending(self, wallet):
+        """
+        Return what the shards of ``wallet`` (a wallet or its id) hold:
+        their balance, the deposits not yet folded into totals and rollups
+        (overall and by month), and the latest deposit time. Reads of a
+        sharded wallet's totals and rollups add these in.
+        """
+        pending = {'balance': Decimal('0.00'), 'deposited': Decimal('0.00'),
+                   'count': 0, 'last_transaction_at': None, 'by_month': {}}
+        rows = self.filter(wallet=wallet).order_by().values('month').annotate(
+            balance=Sum('balance'),
+            deposited=Sum('pending_deposited'),
+            count=Sum('pending_count'),
+            last_transaction_at=Max('last_transaction_at'),
+        )
+        for row in rows:
+            pending['balance'] += row['balance']
+            pending['deposited'] += row['deposited']
+            pending['count'] += row['count']
+            if row['count']:
+                pending['by_month'][row['month']] = row['deposited']
+                if pending['last_transaction_at'] is None or \
+                        row['last_transaction_at'] > pending['last_transaction_at']:
+                    pending['last_transaction_at'] = row['last_transaction_at']
+        return pending
+
+
+class WalletShard(models.Model):
+    """
+    One of a sharded wallet's sub-balances. ``pending_*`` count deposits
+    made during ``month`` that have not been folded into the wallet's
+    running totals and monthly rollups yet.
+    """
+    wallet = models.ForeignKey(to='Wallet', on_delete=models.CASCADE,
+                               related_name='shards')
+    index = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(decimal_places=2, default=0, max_digits=20)
+    month = models.DateField()
+    pending_deposited = models.DecimalField(decimal_places=2, default=0,
+                                            max_digits=20)
+    pending_count = models.PositiveIntegerField(default=0)
+    last_transaction_at = models.DateTimeField(null=True, blank=True)
+
+    objects = WalletShardManager()
+
+    def __str__(self):
+        return f'Shard {self.index} of wallet {self.wallet_id}'
+
+    class Meta:
+        unique_together = ['wallet', 'index']
+
+
+class LedgerArchiveManager(models.Manager):
+    def archive(self, before, wallet_ids=None, batch_size=1000):
+        """
+        Move ledger rows created before ``before`` into
+        ``ArchivedTransaction``, ``batch_size`` rows per database
+        transaction, and carry their totals forward. Rows go in ledger
+        order, so a wallet's archived rows always precede its live ones.
+        Running totals and monthly rollups are unaffected: the rows only
+        move. Returns the number of rows archived.
+        """
+        ledger = Transaction.objects.filter(created_at__lt=before)
+        if wallet_ids is not None:
+            ledger = ledger.filter(wallet_id__in=wallet_ids)
+        ledger = ledger.order_by('wallet_id', 'created_at', 'id')
+
+        archived = 0
+        while True:
+            with transaction.atomic():
+                rows = list(ledger[:batch_size])
+                if not rows:
+                    return archived
+                ArchivedTransaction.objects.bulk_create([
+                    ArchivedTransaction(id=row.id, wallet_id=row.wallet_id,
+                                        type=row.type, value=row.value,
+                                        created_at=row.created_at)
+                    for row in rows
+                ])
+                Transaction.objects.filter(pk__in=[row.pk for row in rows]).delete()
+                self.carry_forward(rows, before)
+            archived += len(rows)
+
+    def carry_forward(self, ledger_rows, before):
+        """
+        Add archived ledger rows to their wallets' carried-forward totals,
+        one UPDATE (or INSERT) per wallet.
+        """
+        changes = {}
+        for row in ledger_rows:
+            change = changes.setdefault(row.wallet_id, {
+                'total_deposited': Decimal('0.00'),
+                'total_withdrawn': Decimal('0.00'),
+                'transaction_count': 0,
+                'last_transaction_at': row.created_at,
+            })
+            field = 'total_deposited' if row.type == 'D' else 'total_withdrawn'
+            change[field] += row.value
+            change['transaction_count'] += 1
+            change['last_transaction_at'] = max(change['last_transaction_at'],
+                                                row.created_at)
+
+        cutoff = Value(before, output_field=models.DateTimeField())
+        for wallet_id, change in changes.items():
+            updated = self.filter(wallet_id=wallet_id).update(
+                archived_before=Greatest('archived_before', cutoff),
+                total_deposited=F('total_deposited') + change['total_deposited'],
+                total_withdrawn=F('total_withdrawn') + change['total_withdrawn'],
+                transaction_count=F('transaction_count') + change['transaction_count'],
+                # Later batches only ever archive newer rows.
+                last_transaction_at=change['last_transaction_at'],
+            )
+            if not updated:
+                self.create(wallet_id=wallet_id, archived_before=before, **change)
+
+
+class LedgerArchive(models.Model):
+    """
+    What has been moved out of a wallet's live ledger: its rows created
+    before ``archived_before`` are in ``ArchivedTransaction``, and their
+    totals are carried forward here.
+    """
+    wallet = models.OneToOneField(to='Wallet', on_delete=models.CASCADE,
+                                  primary_key=True, related_name='archive')
+    archived_before = models.DateTimeField()
+    total_deposited = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+    total_withdrawn = models.DecimalField(decimal_places=2, default=0,
+                                          max_digits=20)
+    transaction_count = models.PositiveIntegerField(default=0)
+    last_transaction_at = models.DateTimeField(null=True, blank=True)
+
+    objects = LedgerArchiveManager()
+
+    @property
+    def balance(self):
+        """The balance carried forward into the live ledger."""
+        return self.total_deposited - self.total_withdrawn
+
+    def __str__(self):
+        return f'Archive of wallet {self.wallet_id} before {self.archived_before}'
+
+
+class ReconciliationRun(models.Model):
+    """
+    A run of the ``reconcile`` command and its checkpoint. Wallets are
+    checked in id order; those up to ``checked_through`` are done, so an
+    interrupted run resumes after it. ``since`` limits the run to wallets
+    with ledger activity from then on (``None``: every wallet).
+    ``mismatches`` holds ``[wallet_id, stored, derived]`` entries.
+    """
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    since = models.DateTimeField(null=True, blank=True)
+    checked_through = models.CharField(max_length=20, blank=True, default='')
+    wallets_checked = models.PositiveIntegerField(default=0)
+    mismatches = models.JSONField(default=list)
+
+    def __str__(self):
+        return f'Reconciliation run {self.pk} started {self.started_at}'
+
+    class Meta:
+        get_latest_by = 'started_at'
+
+
+def month_of(moment):
+    """Return the first day of the month ``moment`` falls in (local time)."""
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def next_month(month):
+    """Return the first day of the month after ``month``."""
+    return (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def start_of(day):
+    """Return the moment ``day`` starts (local time)."""
+    return timezone.make_aware(datetime.combine(day, time.min))
@@ -0,0 +1,176 @@
+"""
+Reconciling stored wallet balances against the ledger.
+
+A wallet's derived balance is the balance carried forward by its archive
+plus the net of its live ledger rows; its stored balance is
+``Wallet.balance`` plus what its shards hold. ``check`` compares the two
+for a chunk of wallets, a range of ids, with one grouped query per table
+however many wallets the chunk holds. Each ``ReconciliationRun`` records
+its progress after every chunk, and once a run has finished the next one
+only checks wallets with ledger activity since it started.
+"""
+import multiprocessing
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from app.ledger import ZERO
+from app.locking import with_retries
+from app.models import (LedgerArchive, ReconciliationRun, Transaction, Wallet,
+                        WalletShard, WalletTotals)
+
+# Wallets per chunk. Incremental runs list a chunk's ids in each query,
+# and older SQLite builds allow 999 parameters in all.
+CHUNK_SIZE = 500
+
+# A posting commits a little after its ``created_at``, so incremental runs
+# look back this far before the previous run started.
+OVERLAP = timedelta(minutes=5)
+
+
+def start(full=False, restart=False, overlap=OVERLAP):
+    """
+    Return the run to work on: the latest one if it never finished
+    (unless ``full`` or ``restart``), otherwise a new run. A new run checks
+    the wallets with activity since the last finished run started, less
+    ``overlap``, or every wallet when ``full`` or there is no such run.
+    """
+    latest = ReconciliationRun.objects.order_by('-started_at', '-pk').first()
+    if latest is not None and latest.finished_at is None and not (full or restart):
+        return latest
+    since = None
+    if not full:
+        previous = ReconciliationRun.objects.filter(
+            finished_at__isnull=False).order_by('-started_at', '-pk').first()
+        if previous is not None:
+            since = previous.started_at - overlap
+    return ReconciliationRun.objects.create(since=since)
+
+
+def active_since(since):
+    """
+    Ids of the wallets whose ledger may have changed since ``since``: those
+    whose running totals or shards record a later posting. Every posting
+    updates one or the other, seeding the totals if need be.
+    """
+    active = set(WalletTotals.objects.filter(
+        last_transaction_at__gte=since).values_list('wallet_id', flat=True))
+    active.update(WalletShard.objects.filter(
+        last_transaction_at__gte=since).values_list('wallet_id', flat=True))
+    return active
+
+
+def chunks(since=None, after='', size=CHUNK_SIZE):
+    """
+    Split the wallets to check, those with ids after ``after``, into
+    ``(first, last, wallet_ids)`` chunks in id order. ``wallet_ids`` lists
+    the chunk's wallets with activity since ``since``, or is ``None`` when
+    every wallet from ``first`` to ``last`` is checked.
+    """
+    if since is not None:
+        ids = sorted(wallet_id for wallet_id in active_since(since) if wallet_id > after)
+        for start in range(0, len(ids), size):
+            chunk = ids[start:start + size]
+            yield chunk[0], chunk[-1], chunk
+        return
+
+    # Keyset pages rather than iterator(), which needs a server-side cursor
+    # to keep memory flat (see ledger.chunked).
+    ids = Wallet.objects.order_by('id').values_list('id', flat=True)
+    while True:
+        chunk = list(ids.filter(id__gt=after)[:size])
+        if chunk:
+            yield chunk[0], chunk[-1], None
+        if len(chunk) < size:
+            return
+        after = chunk[-1]
+
+
+def check(chunk):
+    """
+    Compare the stored and derived balances of a ``chunks()`` chunk.
+    Returns ``(last, checked, mismatches)`` with ``(wallet_id, stored,
+    derived)`` mismatches. Wallets that look off are checked again with
+    their rows locked, so a posting that lands between the queries is not
+    reported.
+    """
+    first, last, wallet_ids = chunk
+    lookups = {'gte': first, 'lte': last}
+    if wallet_ids is not None:
+        lookups['in'] = wallet_ids
+    stored, derived = _balances(lookups)
+    suspects = [wallet_id for wallet_id, balance in stored.items()
+                if balance != derived[wallet_id]]
+    mismatches = with_retries(lambda: _recheck(suspects)) if suspects else []
+    return last, len(stored), mismatches
+
+
+def _recheck(wallet_ids):
+    with transaction.atomic():
+        Wallet.objects.lock(wallet_ids)
+        list(WalletShard.objects.select_for_update().filter(
+            wallet_id__in=wallet_ids).order_by('wallet_id', 'index'))
+        stored, derived = _balances({'in': wallet_ids})
+    return [(wallet_id, stored[wallet_id], derived[wallet_id])
+            for wallet_id in sorted(stored) if stored[wallet_id] != derived[wallet_id]]
+
+
+def _balances(lookups):
+    """
+    ``({wallet_id: stored}, {wallet_id: derived})`` for the wallets whose
+    ids match ``lookups`` (``{'in': [...]}`` and the like).
+    """
+    def scoped(rows, field):
+        return rows.filter(**{f'{field}__{lookup}': value
+                              for lookup, value in lookups.items()})
+
+    stored = dict(scoped(Wallet.objects, 'id').values_list('id', 'balance'))
+    held = scoped(WalletShard.objects, 'wallet_id').order_by().values(
+        'wallet_id').annotate(held=Sum('balance')).values_list('wallet_id', 'held')
+    derived = dict.fromkeys(stored, ZERO)
+    carried = scoped(LedgerArchive.objects, 'wallet_id').values_list(
+        'wallet_id', 'total_deposited', 'total_withdrawn')
+    nets = scoped(Transaction.objects, 'wallet_id').net_by_wallet()
+
+    # Wallets created after the first query are left for the next run.
+    for wallet_id, amount in held:
+        if wallet_id in stored:
+            stored[wallet_id] += amount
+    for wallet_id, deposited, withdrawn in carried:
+        if wallet_id in derived:
+            derived[wallet_id] += deposited - withdrawn
+    for wallet_id, net in nets.items():
+        if wallet_id in derived:
+            derived[wallet_id] += net
+    return stored, derived
+
+
+def run(reconciliation, processes=1, size=CHUNK_SIZE):
+    """
+    Check the wallets ``reconciliation`` has left, in ``processes`` worker
+    processes when more than one, saving its checkpoint after each chunk
+    in id order. Returns the finished run.
+    """
+    pieces = list(chunks(reconciliation.since, reconciliation.checked_through, size))
+    if processes > 1 and len(pieces) > 1:
+        # Forked workers must open their own connections.
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            _record(reconciliation, pool.imap(check, pieces))
+    else:
+        _record(reconciliation, map(check, pieces))
+    reconciliation.finished_at = timezone.now()
+    reconciliation.save(update_fields=['finished_at'])
+    return reconciliation
+
+
+def _record(reconciliation, results):
+    for last, checked, mismatches in results:
+        reconciliation.checked_through = last
+        reconciliation.wallets_checked += checked
+        reconciliation.mismatches += [[wallet_id, str(stored), str(derived)]
+                                      for wallet_id, stored, derived in mismatches]
+        reconciliation.save(update_fields=['checked_through', 'wallets_checked',
+                                           'mismatches'])
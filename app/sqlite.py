@@ -0,0 +1,49 @@
+"""
+SQLite tuning for single-node installs, applied to every new connection.
+
+The default rollback journal makes each write block every reader until it
+commits. In WAL mode (WALLET_SQLITE_WAL) readers keep reading the last
+committed state while a write is in progress. synchronous=NORMAL, which
+comes with it, is still crash-safe in WAL mode; a power loss may only lose
+the last few commits. The journal mode is stored in the database file, so
+it is left alone unless asked for.
+
+Django opens transactions with a plain (deferred) BEGIN, so two postings
+that both read their wallet before writing can each hold a read lock that
+the other needs to upgrade; SQLite fails one of them at once with
+"database is locked" instead of waiting out the busy timeout. With
+WALLET_SQLITE_BEGIN = 'IMMEDIATE' every atomic block takes the write lock
+up front, and concurrent writers queue instead.
+"""
+
+from django.conf import settings
+
+
+def apply_pragmas(connection, pragmas):
+    """
+    Run ``PRAGMA name = value`` for each item of ``pragmas`` on ``connection``.
+    """
+    # Straight on the driver connection: nothing here needs to show up in
+    # query logs or pass through execute wrappers.
+    for name, value in pragmas.items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+def set_begin(connection, mode):
+    """
+    Make ``connection`` start transactions with ``BEGIN <mode>``, or with
+    Django's plain ``BEGIN`` when ``mode`` is empty.
+    """
+    if not mode:
+        connection.__dict__.pop('_start_transaction_under_autocommit', None)
+        return
+
+    def start_transaction():
+        connection.cursor().execute(f'BEGIN {mode}')
+    connection._start_transaction_under_autocommit = start_transaction
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        apply_pragmas(connection, settings.WALLET_SQLITE_PRAGMAS)
+        set_begin(connection, settings.WALLET_SQLITE_BEGIN)
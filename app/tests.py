@@ -1,3 +1,1526 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import re
+import runpy
+import tempfile
+import threading
+from concurrent.futures import Future
+from datetime import date, datetime, timezone
+from decimal import Decimal, InvalidOperation
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import (AsyncClient, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as django_timezone
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+
+from app import cache as wallet_cache
+from app import group_commit, ids, locking
+from app import ledger as wallet_ledger
+from app.authentication import token_cache
+from app.idempotency import idempotent, response_cache
+from app.models import (MAX_AMOUNT, ArchivedTransaction, AuthToken, IdempotencyKey,
+                        LedgerArchive, MonthlyBalance, ReconciliationRun, Transaction,
+                        User, Wallet, WalletShard, WalletTotals, hash_token)
+
+
+# The read cache is off by default; tests of it use a local one.
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                           'LOCATION': 'wallet-tests'}}
+
+
+class WalletTestCase(TestCase):
+    def setUp(self):
+        # The read cache outlives each test's database rollback.
+        wallet_cache.get_cache().clear()
+
+
+class TransactionHistoryTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        wallet = Wallet.objects.create(id='1', name='History')
+        for n in range(5):
+            wallet.deposit(Decimal(n + 1))
+        # Rows posted in the same instant are ordered by id.
+        Transaction.objects.update(created_at=datetime(2024, 1, 1, tzinfo=timezone.utc))
+        self.ids = sorted(Transaction.objects.values_list('id', flat=True))
+        self.client = APIClient()
+
+    def test_pages_cover_every_row_once_in_order(self):
+        seen, cursor, pages = [], '', 0
+        while cursor is not None:
+            response = self.client.get('/api/wallet/1/transactions/',
+                                       {'limit': 2, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            seen += [row['transaction_id'] for row in response.data['transactions']]
+            cursor = response.data['next_cursor']
+            pages += 1
+        self.assertEqual(seen, self.ids)
+        self.assertEqual(pages, 3)
+
+        last = self.client.get('/api/wallet/1/transactions/', {'limit': 5}).data
+        self.assertEqual(len(last['transactions']), 5)
+        self.assertIsNone(last['next_cursor'])
+
+    def test_stream_returns_every_row_in_order(self):
+        # Read two rows at a time, resuming after rows of the same instant.
+        with mock.patch('app.views.HISTORY_STREAM_CHUNK_SIZE', 2), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/wallet/1/transactions/?stream=true')
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            rows = [json.loads(line) for line in
+                    b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len([query for query in queries
+                              if query['sql'].endswith('LIMIT 2')]), 3)
+        self.assertEqual([row['transaction_id'] for row in rows], self.ids)
+        self.assertEqual([row['amount'] for row in rows],
+                         ['1.00', '2.00', '3.00', '4.00', '5.00'])
+
+    def test_rejects_bad_cursors_and_limits(self):
+        naive = base64.urlsafe_b64encode(f'2024-01-01T00:00:00|{self.ids[0]}'.encode()).decode()
+        for params in ({'cursor': 'not-a-cursor'}, {'cursor': naive},
+                       {'limit': 0}, {'limit': 1001}, {'limit': 'ten'}):
+            response = self.client.get('/api/wallet/1/transactions/', params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class WalletTotalsTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        Wallet.objects.create(id='1', name='Payer')
+        Wallet.objects.create(id='2', name='Payee')
+        self.client = APIClient()
+
+    def post(self, path, data):
+        response = self.client.post(f'/api/wallet/{path}/', data, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def stored(self, wallet_id):
+        totals = WalletTotals.objects.get(wallet_id=wallet_id)
+        return (totals.total_deposited, totals.total_withdrawn,
+                totals.transaction_count, totals.last_transaction_at)
+
+    def computed(self, wallet_id):
+        totals = WalletTotals.objects.from_ledger([wallet_id])[wallet_id]
+        return (totals.total_deposited, totals.total_withdrawn,
+                totals.transaction_count, totals.last_transaction_at)
+
+    def test_postings_keep_totals_in_step_with_the_ledger(self):
+        self.post('add', {'wallet_id': '1', 'amount': '10.00'})
+        self.post('spend', {'wallet_id': '1', 'amount': '3.00'})
+        self.post('transfer', {'from_wallet': '1', 'to_wallet': '2', 'amount': '2.50'})
+
+        self.assertEqual(self.stored('1')[:3], (Decimal('10.00'), Decimal('5.50'), 3))
+        self.assertEqual(self.stored('2')[:3], (Decimal('2.50'), Decimal('0.00'), 1))
+        for wallet_id in ('1', '2'):
+            self.assertEqual(self.stored(wallet_id), self.computed(wallet_id))
+        self.assertEqual(self.client.get('/api/wallet/1/summary/').data, {
+            'wallet_id': '1', 'current_balance': '4.50',
+            'total_added': '10.00', 'total_spent': '5.50'})
+
+    def test_legacy_wallets_are_seeded_from_the_ledger(self):
+        self.post('add', {'wallet_id': '1', 'amount': '10.00'})
+        self.post('add', {'wallet_id': '2', 'amount': '1.00'})
+        WalletTotals.objects.all().delete()
+
+        # A posting seeds the totals, counting the rows already in the ledger.
+        self.post('spend', {'wallet_id': '1', 'amount': '4.00'})
+        self.assertEqual(self.stored('1')[:3], (Decimal('10.00'), Decimal('4.00'), 2))
+        # So does the first summary.
+        self.assertEqual(self.client.get('/api/wallet/2/summary/').data['total_added'], '1.00')
+        self.assertEqual(self.stored('2'), self.computed('2'))
+
+    def test_verify_reports_mismatches_and_rebuild_fixes_them(self):
+        self.post('add', {'wallet_id': '1', 'amount': '10.00'})
+        self.post('add', {'wallet_id': '2', 'amount': '1.00'})
+        WalletTotals.objects.filter(wallet_id='1').update(total_deposited=Decimal('12.00'))
+        WalletTotals.objects.filter(wallet_id='2').delete()
+
+        out = StringIO()
+        call_command('rebuild_wallet_totals', verify=True, stdout=out)
+        self.assertIn('1: total_deposited is 12.00, ledger says 10.00', out.getvalue())
+        self.assertIn('2: totals missing', out.getvalue())
+        self.assertIn('2 mismatch(es).', out.getvalue())
+        self.assertEqual(self.stored('1')[0], Decimal('12.00'))
+
+        call_command('rebuild_wallet_totals', stdout=StringIO())
+        out = StringIO()
+        call_command('rebuild_wallet_totals', verify=True, stdout=out)
+        self.assertIn('All wallet totals match the ledger.', out.getvalue())
+
+
+class MonthlyBalanceTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wallet = Wallet.objects.create(id='1', name='Monthly')
+        self.other = Wallet.objects.create(id='2', name='Other')
+        self.client = APIClient()
+
+    def post(self, month, post, *args):
+        with mock.patch('django.utils.timezone.now',
+                        return_value=datetime(2024, month, 15, tzinfo=timezone.utc)):
+            post(*args)
+
+    def rollups(self):
+        return list(MonthlyBalance.objects.order_by('wallet_id', 'month').values_list(
+            'wallet_id', 'month', 'total_deposited', 'total_withdrawn', 'closing_balance'))
+
+    def test_new_months_open_at_the_last_closing_balance(self):
+        self.post(1, self.wallet.deposit, Decimal('100.00'))
+        self.post(3, self.wallet.withdraw, Decimal('30.00'))
+        self.assertEqual(self.rollups(), [
+            ('1', date(2024, 1, 1), Decimal('100.00'), Decimal('0.00'), Decimal('100.00')),
+            ('1', date(2024, 3, 1), Decimal('0.00'), Decimal('30.00'), Decimal('70.00')),
+        ])
+
+        report = self.client.get('/api/wallet/1/monthly-report/2024/').data['monthly_report']
+        # February had no activity and carries January's balance.
+        self.assertEqual([(month['opening_balance'], month['closing_balance'])
+                          for month in report[:4]],
+                         [('0.00', '100.00'), ('100.00', '100.00'),
+                          ('100.00', '70.00'), ('70.00', '70.00')])
+
+    def test_legacy_wallets_are_rebuilt_on_their_next_posting(self):
+        self.post(1, self.wallet.deposit, Decimal('100.00'))
+        self.post(2, self.wallet.withdraw, Decimal('10.00'))
+        MonthlyBalance.objects.all().delete()
+
+        self.post(4, self.wallet.deposit, Decimal('5.00'))
+        self.assertEqual(self.rollups(), [
+            ('1', date(2024, 1, 1), Decimal('100.00'), Decimal('0.00'), Decimal('100.00')),
+            ('1', date(2024, 2, 1), Decimal('0.00'), Decimal('10.00'), Decimal('90.00')),
+            ('1', date(2024, 4, 1), Decimal('5.00'), Decimal('0.00'), Decimal('95.00')),
+        ])
+
+    def test_back_fill_matches_the_incremental_rollups(self):
+        self.post(1, self.wallet.deposit, Decimal('100.00'))
+        self.post(1, self.wallet.transfer_to, self.other, Decimal('40.00'))
+        self.post(5, self.other.withdraw, Decimal('15.50'))
+        self.post(5, self.wallet.deposit, Decimal('0.25'))
+        self.post(11, self.other.transfer_to, self.wallet, Decimal('4.50'))
+        incremental = self.rollups()
+
+        out = StringIO()
+        call_command('rebuild_monthly_balances', stdout=out)
+        self.assertIn(f'Wrote {len(incremental)} monthly balance row(s).', out.getvalue())
+        self.assertEqual(self.rollups(), incremental)
+
+
+class FakeClock:
+    """Stands in for the ``time`` module in ``app.ids``; sleeping moves on 1 ms."""
+
+    def __init__(self, ms):
+        self.ms = ms
+        self.sleeps = 0
+
+    def time(self):
+        # Half-way through the millisecond, so float rounding cannot move it.
+        return (self.ms + 0.5) / 1000
+
+    def sleep(self, seconds):
+        self.sleeps += 1
+        self.ms += 1
+
+
+class IdGeneratorTests(SimpleTestCase):
+    def tearDown(self):
+        ids.set_worker_slot(0)
+
+    def decode(self, value):
+        value = int(value)
+        return (value >> (ids.WORKER_ID_BITS + ids.SEQUENCE_BITS),
+                (value >> ids.SEQUENCE_BITS) & ids.MAX_WORKER_ID,
+                value & ids.MAX_SEQUENCE)
+
+    def test_ids_are_unique_and_increasing(self):
+        generator = ids.SnowflakeGenerator(5)
+        values = [generator.next_int() for _ in range(20000)]
+        self.assertEqual(values, sorted(set(values)))
+        self.assertEqual({self.decode(value)[1] for value in values}, {5})
+
+    def test_an_exhausted_sequence_waits_for_the_next_millisecond(self):
+        clock = FakeClock(ids.EPOCH_MS + 1000)
+        with mock.patch('app.ids.time', clock):
+            generator = ids.SnowflakeGenerator(1)
+            first = [self.decode(generator.next_int()) for _ in range(ids.MAX_SEQUENCE + 1)]
+            self.assertEqual(clock.sleeps, 0)
+            after = self.decode(generator.next_int())
+        self.assertEqual({(ms, seq - n) for n, (ms, _, seq) in enumerate(first)}, {(1000, 0)})
+        self.assertEqual(after, (1001, 1, 0))
+        self.assertEqual(clock.sleeps, 1)
+
+    def test_ids_keep_increasing_when_the_clock_goes_back(self):
+        clock = FakeClock(ids.EPOCH_MS + 5000)
+        with mock.patch('app.ids.time', clock):
+            generator = ids.SnowflakeGenerator(1)
+            before = generator.next_int()
+            clock.ms -= 1000
+            self.assertGreater(generator.next_int(), before)
+
+    @override_settings(WALLET_WORKER_ID=40)
+    def test_worker_ids_are_the_base_plus_the_process_slot(self):
+        ids.set_worker_slot(3)
+        self.assertEqual(ids.get_generator().worker_id, 43)
+        self.assertEqual(self.decode(ids.next_id())[1], 43)
+        with self.assertRaises(ImproperlyConfigured):
+            ids.set_worker_slot(ids.MAX_WORKER_ID)
+
+    @skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_forked_workers_start_their_own_generator(self):
+        parent = ids.get_generator()
+        parent_ids = [ids.next_id() for _ in range(100)]
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover - child
+            try:
+                os.close(read_end)
+                # What gunicorn.conf.py's post_fork hook does.
+                ids.set_worker_slot(1)
+                child = ids.get_generator()
+                payload = {'same': child is parent, 'worker_id': child.worker_id,
+                           'ids': [ids.next_id() for _ in range(100)]}
+                os.write(write_end, json.dumps(payload).encode())
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as pipe:
+            payload = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+
+        self.assertFalse(payload['same'])
+        self.assertEqual(payload['worker_id'], parent.worker_id + 1)
+        self.assertFalse(set(payload['ids']) & set(parent_ids))
+
+
+class LedgerQueryPlanTests(WalletTestCase):
+    """
+    Every read path must reach ledger rows through an index, never by
+    scanning the whole transaction table.
+    """
+    TABLE = Transaction._meta.db_table
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.wallet = Wallet.objects.create(id='1', name='Plan')
+        other = Wallet.objects.create(id='2', name='Other')
+        rows = []
+        for n in range(200):
+            rows.append(Transaction(
+                id=str(n), wallet=cls.wallet if n % 4 else other,
+                type='D' if n % 3 else 'W', value=Decimal('1.00')))
+        Transaction.objects.bulk_create(rows)
+        for year, ids in ((2023, range(0, 100)), (2024, range(100, 200))):
+            Transaction.objects.filter(id__in=[str(n) for n in ids]).update(
+                created_at=datetime(year, 6, 1, tzinfo=timezone.utc))
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return '\n'.join(row[-1] for row in cursor.fetchall())
+            if connection.vendor == 'postgresql':
+                # The test tables are tiny, so ask the planner whether an
+                # index path exists at all rather than which one is cheaper.
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+                return '\n'.join(row[0] for row in cursor.fetchall())
+        self.skipTest(f'No plan assertions for {connection.vendor}')
+
+    def assertNoLedgerScan(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+
+        ledger_queries = [query['sql'] for query in queries
+                          if self.TABLE in query['sql']]
+        for sql in ledger_queries:
+            plan = self.explain(sql)
+            if connection.vendor == 'sqlite':
+                full_scan = re.search(
+                    rf'\bSCAN (TABLE )?"?{self.TABLE}\b', plan)
+            else:
+                full_scan = re.search(rf'Seq Scan on "?{self.TABLE}\b', plan)
+            self.assertIsNone(full_scan, f'{sql}\n{plan}')
+        return ledger_queries
+
+    def test_history_page_uses_index(self):
+        queries = self.assertNoLedgerScan('/api/wallet/1/transactions/?limit=10')
+        self.assertTrue(queries)
+
+        cursor = self.client.get(
+            '/api/wallet/1/transactions/?limit=10').data['next_cursor']
+        self.assertNoLedgerScan(
+            f'/api/wallet/1/transactions/?limit=10&cursor={cursor}')
+
+    def test_summary_uses_index(self):
+        # First read seeds the running totals from the ledger.
+        WalletTotals.objects.all().delete()
+        self.assertTrue(self.assertNoLedgerScan('/api/wallet/1/summary/'))
+        self.assertFalse(self.assertNoLedgerScan('/api/wallet/1/summary/'))
+
+    def test_monthly_report_uses_index(self):
+        # First report seeds the monthly rollups from the ledger.
+        self.assertTrue(self.assertNoLedgerScan('/api/wallet/1/monthly-report/2024/'))
+        self.assertFalse(self.assertNoLedgerScan('/api/wallet/1/monthly-report/2024/'))
+
+
+class BatchPostingTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        Wallet.objects.create(id='1', name='Busy').deposit(Decimal('10.00'))
+        Wallet.objects.create(id='2', name='Empty')
+        Wallet.objects.create(id='3', name='Hot')
+        call_command('shard_wallet', '3', '2', stdout=StringIO())
+        Wallet.objects.get(id='3').deposit(Decimal('10.00'))
+        self.client = APIClient()
+
+    def batch(self, *operations):
+        return self.client.post('/api/wallet/batch/', {'operations': [
+            {'wallet_id': wallet_id, 'type': tx_type, 'amount': amount}
+            for wallet_id, tx_type, amount in operations
+        ]}, format='json')
+
+    def test_operations_succeed_or_fail_one_by_one(self):
+        response = self.batch(
+            ('1', 'add', '5.00'),
+            ('2', 'spend', '1.00'),       # empty wallet
+            ('1', 'spend', '12.00'),      # covered by the add before it
+            ('1', 'spend', '4.00'),       # only 3.00 left by now
+            ('missing', 'add', '1.00'),
+            ('1', 'withdraw', '1.00'),
+            ('2', 'add', 7.25),
+            ('3', 'add', '2.50'),         # sharded: its shards are collected first
+            ('3', 'spend', '12.00'),
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual((response.data['applied'], response.data['failed']), (5, 4))
+        self.assertEqual([result.get('balance', result.get('error')) for result in results], [
+            '15.00', 'Insufficient balance', '3.00', 'Insufficient balance',
+            'Wallet not found', 'Invalid operation type', '7.25', '12.50', '0.50'])
+        self.assertEqual([result['index'] for result in results], list(range(9)))
+
+        balances = {wallet.id: wallet.available_balance() for wallet in Wallet.objects.all()}
+        self.assertEqual(balances, {'1': Decimal('3.00'), '2': Decimal('7.25'),
+                                    '3': Decimal('0.50')})
+        self.assertEqual(Transaction.objects.count(), 2 + 5)
+        for wallet_id, balance in balances.items():
+            self.assertEqual(WalletTotals.objects.get(wallet_id=wallet_id).net, balance)
+
+    def test_amounts_must_be_whole_cents_that_fit_the_ledger(self):
+        response = self.batch(('1', 'add', '1e30'), ('1', 'add', '0.005'), ('1', 'add', '-1'),
+                              ('1', 'add', 'NaN'), ('1', 'add', None), ('1', 'add', '1.50'),
+                              ('1', 'add', str(MAX_AMOUNT)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result.get('error') for result in response.data['results']],
+                         ['Invalid amount'] * 5 + [None, 'Balance limit exceeded'])
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('11.50'))
+
+    def test_rejects_malformed_batches(self):
+        self.assertEqual(self.client.post('/api/wallet/batch/', {}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/wallet/batch/', {
+            'operations': {'wallet_id': '1'}}, format='json').status_code, 400)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class TokenAuthenticationTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        token_cache.clear()
+        self.user = User.objects.create_user('token@example.com', 'secret-pw')
+        Wallet.objects.create(id='1', name='Token').deposit(Decimal('1.00'))
+        self.client = APIClient()
+
+    def login(self):
+        response = self.client.post('/api/login/', {
+            'email': 'token@example.com', 'password': 'secret-pw'
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['token']
+
+    def test_login_issues_token_that_authenticates(self):
+        token = self.login()
+        self.assertFalse(AuthToken.objects.filter(key=token).exists())
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        response = client.get('/api/wallet/1/summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+        # The validated token, the ETag validators and the summary are all
+        # served from memory.
+        with self.assertNumQueries(0):
+            client.get('/api/wallet/1/summary/')
+
+    def test_invalid_and_expired_tokens_are_rejected(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token not-a-token')
+        self.assertEqual(client.get('/api/wallet/1/summary/').status_code, 401)
+
+        token = self.login()
+        AuthToken.objects.update(expires_at=django_timezone.now())
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(client.get('/api/wallet/1/summary/').status_code, 401)
+
+    def test_unknown_users_and_expired_tokens(self):
+        response = self.client.post('/api/login/', {
+            'email': 'nobody@example.com', 'password': 'secret-pw'
+        }, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': 'User nobody@example.com not found.'})
+
+        self.login()
+        AuthToken.objects.update(expires_at=django_timezone.now())
+        live = self.login()
+        call_command('purge_auth_tokens', stdout=StringIO())
+        self.assertEqual(AuthToken.objects.count(), 1)
+        self.assertTrue(AuthToken.objects.filter(key=hash_token(live)).exists())
+
+
+class PostingQueryCountTests(WalletTestCase):
+    """
+    Each posting writes one INSERT for its ledger rows and one UPDATE per
+    affected wallet, plus one UPDATE for the running totals and one for the
+    monthly rollups of all the wallets touched.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.source = Wallet.objects.create(id='1', name='Source')
+        self.target = Wallet.objects.create(id='2', name='Target')
+        # Seed the totals and this month's rollups.
+        self.source.deposit(Decimal('100.00'))
+        self.target.deposit(Decimal('1.00'))
+
+    def test_deposit(self):
+        with self.assertNumQueries(4):
+            self.source.deposit(Decimal('5.00'))
+        self.source.refresh_from_db()
+        self.assertEqual(self.source.balance, Decimal('105.00'))
+
+    def test_withdraw(self):
+        with self.assertNumQueries(4):
+            self.source.withdraw(Decimal('5.00'))
+        self.source.refresh_from_db()
+        self.assertEqual(self.source.balance, Decimal('95.00'))
+
+    def test_transfer(self):
+        with self.assertNumQueries(5):
+            self.source.transfer_to(self.target, Decimal('5.00'))
+        self.assertEqual(self.source.balance, Decimal('95.00'))
+        self.assertEqual(self.target.balance, Decimal('6.00'))
+        self.source.refresh_from_db()
+        self.target.refresh_from_db()
+        self.assertEqual(self.source.balance, Decimal('95.00'))
+        self.assertEqual(self.target.balance, Decimal('6.00'))
+        self.assertEqual(Transaction.objects.count(), 4)
+
+    def test_transfer_request_locks_both_wallets_in_one_ordered_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().post('/api/wallet/transfer/', {
+                'from_wallet': '2', 'to_wallet': '1', 'amount': '1.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        reads = [query['sql'] for query in queries
+                 if query['sql'].startswith('SELECT') and '"app_wallet"."balance"' in query['sql']]
+        self.assertEqual(len(reads), 1)
+        self.assertIn('ORDER BY "app_wallet"."id" ASC', reads[0])
+        # The lock, then the posting itself.
+        self.assertEqual(len([query for query in queries
+                              if not query['sql'].startswith(('BEGIN', 'SAVEPOINT', 'RELEASE'))]), 6)
+
+    def test_credits_cannot_pass_the_balance_limit(self):
+        client = APIClient()
+        response = client.post('/api/wallet/add/', {
+            'wallet_id': '2', 'amount': str(MAX_AMOUNT)}, format='json')
+        self.assertEqual((response.status_code, response.data),
+                         (400, {'error': 'Balance limit exceeded'}))
+        Wallet.objects.filter(id='2').update(balance=MAX_AMOUNT)
+        response = client.post('/api/wallet/transfer/', {
+            'from_wallet': '1', 'to_wallet': '2', 'amount': '0.01'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('100.00'))
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual(client.get('/api/wallet/1/summary/').status_code, 200)
+
+
+@override_settings(WALLET_POSTING_MODE='conditional')
+class ConditionalPostingTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        Wallet.objects.create(id='1', name='Source', balance=Decimal('10.00'))
+        Wallet.objects.create(id='2', name='Target')
+        self.client = APIClient()
+
+    def test_spend_and_transfer(self):
+        response = self.client.post('/api/wallet/spend/', {
+            'wallet_id': '1', 'amount': '4.00'}, format='json')
+        self.assertEqual(response.data['remaining_balance'], '6.00')
+
+        response = self.client.post('/api/wallet/transfer/', {
+            'from_wallet': '1', 'to_wallet': '2', 'amount': '6.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['transfer_details']['to_wallet']['available_balance'], '6.00')
+
+    def test_failed_condition_changes_nothing(self):
+        response = self.client.post('/api/wallet/transfer/', {
+            'from_wallet': '1', 'to_wallet': '2', 'amount': '11.00'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/wallet/add/', {
+            'wallet_id': 'missing', 'amount': '1.00'}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('10.00'))
+        self.assertEqual(Wallet.objects.get(id='2').balance, Decimal('0.00'))
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_credits_cannot_pass_the_balance_limit(self):
+        response = self.client.post('/api/wallet/add/', {
+            'wallet_id': '1', 'amount': str(MAX_AMOUNT)}, format='json')
+        self.assertEqual((response.status_code, response.data),
+                         (400, {'error': 'Balance limit exceeded'}))
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('10.00'))
+        self.assertEqual(self.client.get('/api/wallet/1/summary/').status_code, 200)
+        self.assertFalse(Transaction.objects.exists())
+
+
+class ShardedWalletTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wallet = Wallet.objects.create(id='1', name='Hot')
+        self.wallet.deposit(Decimal('5.00'))
+        call_command('shard_wallet', '1', '4', stdout=StringIO())
+        self.client = APIClient()
+
+    def test_deposits_go_to_shards_and_reads_include_them(self):
+        for _ in range(8):
+            self.client.post('/api/wallet/add/', {
+                'wallet_id': '1', 'amount': '2.00'}, format='json')
+
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('5.00'))
+        summary = self.client.get('/api/wallet/1/summary/').data
+        self.assertEqual(summary['current_balance'], '21.00')
+        self.assertEqual(summary['total_added'], '21.00')
+
+    def test_spend_collects_shards(self):
+        for _ in range(4):
+            self.client.post('/api/wallet/add/', {
+                'wallet_id': '1', 'amount': '2.00'}, format='json')
+
+        response = self.client.post('/api/wallet/spend/', {
+            'wallet_id': '1', 'amount': '13.00'}, format='json')
+        self.assertEqual(response.data['remaining_balance'], '0.00')
+        self.assertFalse(WalletShard.objects.exclude(balance=0).exists())
+
+        totals = WalletTotals.objects.get(wallet_id='1')
+        self.assertEqual(totals.total_deposited, Decimal('13.00'))
+        self.assertEqual(totals.transaction_count, 6)
+
+    def test_deposits_racing_an_unshard_land_on_the_wallet(self):
+        stale = Wallet.objects.get(id='1')
+        call_command('shard_wallet', '1', '0', stdout=StringIO())
+
+        WalletShard.objects.deposit(stale, Decimal('2.00'))
+        self.assertFalse(WalletShard.objects.exists())
+        self.assertEqual((stale.shard_count, stale.balance), (0, Decimal('7.00')))
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('7.00'))
+        self.assertEqual(Transaction.objects.filter(wallet_id='1').count(), 2)
+        self.assertEqual(WalletTotals.objects.get(wallet_id='1').net, Decimal('7.00'))
+
+    def test_deposits_racing_a_reshard_land_on_a_live_shard(self):
+        stale = Wallet.objects.get(id='1')
+        call_command('shard_wallet', '1', '2', stdout=StringIO())
+
+        with mock.patch('app.models.random.randrange', side_effect=[3, 1]):
+            WalletShard.objects.deposit(stale, Decimal('2.00'))
+        self.assertEqual(list(WalletShard.objects.order_by('index').values_list('index', 'balance')),
+                         [(0, Decimal('0.00')), (1, Decimal('2.00'))])
+        self.assertEqual(stale.available_balance(), Decimal('7.00'))
+
+    def test_deposits_cannot_pass_the_balance_limit(self):
+        self.client.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '2.00'}, format='json')
+        response = self.client.post('/api/wallet/add/', {
+            'wallet_id': '1', 'amount': str(MAX_AMOUNT - 5)}, format='json')
+        self.assertEqual((response.status_code, response.data),
+                         (400, {'error': 'Balance limit exceeded'}))
+
+        # What fits is still accepted, with the shards folded into the row.
+        response = self.client.post('/api/wallet/add/', {
+            'wallet_id': '1', 'amount': str(MAX_AMOUNT - 7)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Wallet.objects.get(id='1').available_balance(), MAX_AMOUNT)
+        self.assertEqual(self.client.get('/api/wallet/1/summary/').data['current_balance'],
+                         str(MAX_AMOUNT))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class WalletReadCacheTests(TransactionTestCase):
+    # on_commit callbacks, which bump wallet versions, only run when the
+    # test's writes really commit.
+
+    def setUp(self):
+        wallet_cache.get_cache().clear()
+        wallet_cache.reset_stats()
+        self.wallet = Wallet.objects.create(id='1', name='Cached')
+        self.wallet.deposit(Decimal('1.00'))
+        self.client = APIClient()
+
+    def test_reads_are_cached_until_a_write_commits(self):
+        self.assertEqual(self.client.get('/api/wallet/1/summary/').data['current_balance'], '1.00')
+        with self.assertNumQueries(0):
+            self.client.get('/api/wallet/1/summary/')
+        # One validator entry and one response entry per read.
+        self.assertEqual(wallet_cache.stats(), {'hits': 2, 'misses': 2})
+
+        self.client.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '3.00'}, format='json')
+        self.assertEqual(self.client.get('/api/wallet/1/summary/').data['current_balance'], '4.00')
+        report = self.client.get(f'/api/wallet/1/monthly-report/{django_timezone.now().year}/').data
+        self.assertEqual(report['monthly_report'][-1]['closing_balance'], '4.00')
+
+        self.wallet.withdraw(Decimal('1.00'))
+        page = self.client.get('/api/wallet/1/transactions/').data
+        self.assertEqual(len(page['transactions']), 3)
+        self.assertEqual(page['stored_balance'], '3.00')
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_nothing_is_cached_without_a_shared_backend(self):
+        self.client.get('/api/wallet/1/summary/')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/wallet/1/summary/')
+        self.assertTrue(queries)
+        self.assertEqual(wallet_cache.stats(), {'hits': 0, 'misses': 0})
+
+    def test_gunicorn_refuses_several_workers_with_a_per_process_cache(self):
+        config = runpy.run_path(os.path.join(settings.BASE_DIR, 'gunicorn.conf.py'))
+        server = mock.Mock()
+        server.cfg.workers = 3
+        with self.assertRaises(RuntimeError):
+            config['on_starting'](server)
+        server.cfg.workers = 1
+        config['on_starting'](server)
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+            server.cfg.workers = 3
+            config['on_starting'](server)
+
+
+class ConditionalGetTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wallet = Wallet.objects.create(id='1', name='Polled')
+        self.wallet.deposit(Decimal('2.00'))
+        self.client = APIClient()
+
+    def test_unchanged_wallet_answers_304(self):
+        for path in ('/api/wallet/1/summary/', '/api/wallet/1/transactions/'):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Last-Modified', response)
+
+            # Without the read cache the check is a single wallet lookup.
+            wallet_cache.get_cache().clear()
+            etag, last_modified = response['ETag'], response['Last-Modified']
+            with self.assertNumQueries(1):
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+            self.assertEqual((response['ETag'], response['Last-Modified']), (etag, last_modified))
+
+    def test_write_changes_etag(self):
+        etag = self.client.get('/api/wallet/1/summary/')['ETag']
+        self.wallet.deposit(Decimal('1.00'))
+        wallet_cache.get_cache().clear()
+
+        response = self.client.get('/api/wallet/1/summary/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['current_balance'], '3.00')
+
+
+@override_settings(ROOT_URLCONF='WalletAPI.asgi_urls')
+class AsyncViewTests(TransactionTestCase):
+    # The async views run in pool threads with their own connections, which
+    # only see committed rows.
+
+    def setUp(self):
+        wallet_cache.get_cache().clear()
+        Wallet.objects.create(id='1', name='Async').deposit(Decimal('5.00'))
+        self.client = AsyncClient()
+
+    async def test_reads_and_writes(self):
+        response = await self.client.post(
+            '/api/wallet/add/', {'wallet_id': '1', 'amount': '2.50'},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+        response = await self.client.get('/api/wallet/1/summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['current_balance'], '7.50')
+
+        response = await self.client.post(
+            '/api/wallet/spend/', {'wallet_id': '1', 'amount': '100.00'},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_streamed_history(self):
+        response = await self.client.get('/api/wallet/1/transactions/?stream=true')
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['amount'] for line in lines], ['5.00'])
+
+
+@override_settings(WALLET_GROUP_COMMIT=True, WALLET_GROUP_COMMIT_MAX_DELAY_MS=50)
+class GroupCommitTests(TransactionTestCase):
+    # Deposits are posted by the queue's own thread and connection, which
+    # only see committed rows.
+
+    def setUp(self):
+        wallet_cache.get_cache().clear()
+        response_cache.clear()
+        group_commit.shutdown_queue()
+        self.addCleanup(group_commit.shutdown_queue)
+        Wallet.objects.create(id='1', name='Busy')
+
+    def deposit(self, results, wallet_id='1', **headers):
+        try:
+            results.append(APIClient().post('/api/wallet/add/', {
+                'wallet_id': wallet_id, 'amount': '1.00'}, format='json', **headers))
+        finally:
+            connections.close_all()
+
+    def test_concurrent_deposits_share_commits(self):
+        results = []
+        threads = [threading.Thread(target=self.deposit, args=(results,)) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual([response.status_code for response in results], [200] * 20)
+        self.assertEqual(sorted(response.data['new_balance'] for response in results),
+                         sorted(f'{n}.00' for n in range(1, 21)))
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('20.00'))
+        self.assertEqual(WalletTotals.objects.get(wallet_id='1').transaction_count, 20)
+        stats = group_commit.get_queue().stats
+        self.assertEqual(stats['deposits'], 20)
+        self.assertLess(stats['batches'], 20)
+
+    def test_unknown_wallets_and_idempotent_deposits(self):
+        results = []
+        self.deposit(results, wallet_id='missing')
+        self.assertEqual(results[0].status_code, 404)
+        queued = group_commit.get_queue().stats['deposits']
+
+        # Posted directly, inside the idempotency key's transaction.
+        self.deposit(results, HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.deposit(results, HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(results[2].data, results[1].data)
+        self.assertEqual(group_commit.get_queue().stats['deposits'], queued)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('1.00'))
+
+    def test_invalid_amounts_are_rejected_before_queueing(self):
+        client = APIClient()
+        for amount in ('0.001', '1e30', 'NaN', 'Infinity', '0', [1]):
+            response = client.post('/api/wallet/add/', {'wallet_id': '1', 'amount': amount},
+                                   format='json')
+            self.assertEqual(response.status_code, 400, amount)
+        self.assertEqual(group_commit.get_queue().stats['deposits'], 0)
+
+        Wallet.objects.filter(id='1').update(balance=MAX_AMOUNT)
+        response = client.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '1.00'},
+                               format='json')
+        self.assertEqual((response.status_code, response.data),
+                         (400, {'error': 'Balance limit exceeded'}))
+
+    def test_sharded_wallets_keep_their_shards(self):
+        call_command('shard_wallet', '1', '4', stdout=StringIO())
+        results = []
+        threads = [threading.Thread(target=self.deposit, args=(results,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual([response.status_code for response in results], [200] * 5)
+        self.assertIn('5.00', [response.data['new_balance'] for response in results])
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('0.00'))
+        self.assertEqual(sum(WalletShard.objects.values_list('balance', flat=True)),
+                         Decimal('5.00'))
+
+    def test_a_failing_deposit_only_fails_its_own_request(self):
+        queue = group_commit.DepositQueue(10, 0.2)
+        self.addCleanup(queue.stop)
+        good = queue.submit('1', Decimal('1.00'))
+        bad = queue.submit('1', Decimal('NaN'))
+        other = queue.submit('1', Decimal('2.00'))
+
+        self.assertEqual(good.result(5)['balance'], Decimal('1.00'))
+        self.assertEqual(other.result(5)['balance'], Decimal('3.00'))
+        with self.assertRaises(InvalidOperation):
+            bad.result(5)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('3.00'))
+
+    @override_settings(WALLET_GROUP_COMMIT_TIMEOUT_MS=50)
+    def test_requests_stop_waiting_for_a_stuck_queue(self):
+        future = Future()
+        stuck = mock.Mock(**{'submit.return_value': future})
+        with mock.patch('app.group_commit.get_queue', return_value=stuck):
+            response = APIClient().post('/api/wallet/add/', {'wallet_id': '1', 'amount': '1.00'},
+                                        format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(future.cancelled())
+
+        # A deposit its caller gave up on is never posted.
+        queue = group_commit.DepositQueue(10, 0.2)
+        queue.submit('1', Decimal('1.00')).cancel()
+        queue.stop()
+        self.assertEqual(queue.stats['deposits'], 0)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('0.00'))
+
+
+class LedgerArchiveTests(WalletTestCase):
+    POSTINGS = [
+        (datetime(2023, 3, 10, tzinfo=timezone.utc), 'D', '10.00'),
+        (datetime(2023, 11, 5, tzinfo=timezone.utc), 'W', '3.00'),
+        (datetime(2024, 5, 20, tzinfo=timezone.utc), 'D', '7.00'),
+        (datetime(2024, 5, 25, tzinfo=timezone.utc), 'W', '2.00'),
+        (datetime(2024, 5, 28, tzinfo=timezone.utc), 'D', '1.00'),
+        (None, 'D', '4.00'),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.wallet = Wallet.objects.create(id='1', name='Old')
+        for created_at, tx_type, amount in self.POSTINGS:
+            post = self.wallet.deposit if tx_type == 'D' else self.wallet.withdraw
+            row = post(Decimal(amount))
+            if created_at is not None:
+                Transaction.objects.filter(pk=row.pk).update(created_at=created_at)
+        WalletTotals.objects.rebuild(['1'])
+        MonthlyBalance.objects.rebuild(['1'])
+        self.client = APIClient()
+
+    def history(self):
+        ids, cursor = [], ''
+        while cursor is not None:
+            data = self.client.get(f'/api/wallet/1/transactions/?limit=2&cursor={cursor}').data
+            ids += [row['transaction_id'] for row in data['transactions']]
+            cursor = data['next_cursor']
+        return ids
+
+    def snapshot(self):
+        totals = WalletTotals.objects.from_ledger(['1'])['1']
+        MonthlyBalance.objects.rebuild(['1'])
+        return {
+            'history': self.history(),
+            'stream': b''.join(self.client.get(
+                '/api/wallet/1/transactions/?stream=true').streaming_content),
+            'totals': (totals.total_deposited, totals.total_withdrawn,
+                       totals.transaction_count, totals.last_transaction_at),
+            'rollups': list(MonthlyBalance.objects.filter(wallet_id='1').values_list(
+                'month', 'total_deposited', 'total_withdrawn', 'closing_balance')),
+        }
+
+    def test_archiving_moves_rows_without_changing_history_or_rebuilds(self):
+        before = self.snapshot()
+        out = StringIO()
+        call_command('archive_ledger', before='2024-05-22', stdout=out)
+        self.assertIn('Archived 3', out.getvalue())
+        wallet_cache.get_cache().clear()
+
+        self.assertEqual(Transaction.objects.filter(wallet_id='1').count(), 3)
+        archive = LedgerArchive.objects.get(wallet_id='1')
+        self.assertEqual(archive.balance, Decimal('14.00'))
+        self.assertEqual(archive.transaction_count, 3)
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(len(before['history']), 6)
+        # The May 2024 rollup combines archived and live rows.
+        self.assertIn((date(2024, 5, 1), Decimal('8.00'), Decimal('2.00'), Decimal('13.00')),
+                      before['rollups'])
+
+    def test_later_pages_skip_the_archive(self):
+        call_command('archive_ledger', before='2024-05-22', stdout=StringIO())
+        first = self.client.get('/api/wallet/1/transactions/?limit=4').data
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f"/api/wallet/1/transactions/?limit=4&cursor={first['next_cursor']}")
+        self.assertFalse([query for query in queries
+                          if ArchivedTransaction._meta.db_table in query['sql']])
+
+
+class LedgerTotalsTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        wallet = Wallet.objects.create(id='1', name='Old')
+        for created_at, tx_type, amount in LedgerArchiveTests.POSTINGS:
+            row = (wallet.deposit if tx_type == 'D' else wallet.withdraw)(Decimal(amount))
+            if created_at is not None:
+                Transaction.objects.filter(pk=row.pk).update(created_at=created_at)
+        MonthlyBalance.objects.rebuild(['1'])
+        self.client = APIClient()
+
+    def test_totals_are_one_conditional_aggregate(self):
+        with self.assertNumQueries(1):
+            totals = Transaction.objects.filter(wallet_id='1').totals()
+        self.assertEqual((totals['total_deposited'], totals['total_withdrawn'],
+                          totals['transaction_count'], totals['net']),
+                         (Decimal('22.00'), Decimal('5.00'), 6, Decimal('17.00')))
+        self.assertEqual(Transaction.objects.none().totals()['net'], Decimal('0.00'))
+
+    def test_totals_span_the_archive_with_one_query_per_table(self):
+        call_command('archive_ledger', before='2024-05-22', stdout=StringIO())
+        wallet = Wallet.objects.select_related('archive').get(id='1')
+        start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+        end = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+        with self.assertNumQueries(2):
+            totals = wallet_ledger.totals_between(wallet, start, end)
+        self.assertEqual((totals['total_deposited'], totals['total_withdrawn'],
+                          totals['transaction_count']),
+                         (Decimal('8.00'), Decimal('2.00'), 3))
+        with self.assertNumQueries(2):
+            days = wallet_ledger.totals_between(wallet, start, end, 'day')
+        self.assertEqual({day.day: totals['net'] for day, totals in days.items()},
+                         {20: Decimal('7.00'), 25: Decimal('-2.00'), 28: Decimal('1.00')})
+
+    def test_range_report_reads_each_ledger_table_once_per_sum(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/wallet/1/report/', {
+                'from': '2024-05-15', 'to': '2024-05-31', 'granularity': 'week'})
+        self.assertEqual(response.status_code, 200)
+        ledger_queries = [query['sql'] for query in queries
+                          if Transaction._meta.db_table in query['sql']]
+        # The opening balance's partial month, then the weekly totals.
+        self.assertEqual(len(ledger_queries), 2)
+        self.assertEqual(response.data['opening_balance'], '7.00')
+        self.assertEqual(response.data['closing_balance'], '13.00')
+
+
+class WalletSummariesTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        for n in range(1, 6):
+            wallet = Wallet.objects.create(id=str(n), name=f'Desk {n}' if n < 5 else 'Payroll')
+            wallet.deposit(Decimal(n))
+            wallet.withdraw(Decimal('0.50'))
+        # A wallet whose running totals were never seeded.
+        WalletTotals.objects.filter(wallet_id='5').delete()
+        call_command('shard_wallet', '4', '2', stdout=StringIO())
+        Wallet.objects.get(id='4').deposit(Decimal('10.00'))
+        self.client = APIClient()
+
+    def test_summaries_match_per_wallet_summaries(self):
+        response = self.client.post('/api/wallet/summaries/', {
+            'wallet_ids': ['4', '1', 'missing', '5']}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual([s['wallet_id'] for s in response.data['wallets']], ['1', '4', '5'])
+        self.assertEqual(response.data['not_found'], ['missing'])
+        for summary in response.data['wallets']:
+            self.assertEqual(
+                summary,
+                self.client.get(f"/api/wallet/{summary['wallet_id']}/summary/").data)
+
+    def test_one_page_is_a_fixed_number_of_queries(self):
+        self.client.get('/api/wallet/summaries/')  # seed wallet 5's totals
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/wallet/summaries/', {'name': 'desk'})
+        # The wallets joined to their totals, and the sharded wallet's shards.
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(len(response.data['wallets']), 4)
+        self.assertEqual(response.data['wallets'][3]['current_balance'], '13.50')
+
+    def test_pages_and_stream_cover_every_wallet(self):
+        seen, cursor = [], ''
+        while cursor is not None:
+            data = self.client.get('/api/wallet/summaries/',
+                                   {'limit': 2, 'cursor': cursor}).data
+            seen += data['wallets']
+            cursor = data['next_cursor']
+        self.assertEqual([s['wallet_id'] for s in seen], ['1', '2', '3', '4', '5'])
+
+        response = self.client.get('/api/wallet/summaries/?stream=true&ids=5,2,3')
+        streamed = [json.loads(line) for line in
+                    b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(streamed, [s for s in seen if s['wallet_id'] in ('2', '3', '5')])
+
+    def test_rejects_bad_input(self):
+        self.assertEqual(self.client.post('/api/wallet/summaries/', {
+            'wallet_ids': '1'}, format='json').status_code, 400)
+        self.assertEqual(self.client.get('/api/wallet/summaries/', {
+            'limit': 0}).status_code, 400)
+
+
+class RangeReportTests(WalletTestCase):
+    POSTINGS = [
+        (datetime(2022, 12, 31, 12, tzinfo=timezone.utc), 'D', '100.00'),
+        (datetime(2023, 1, 2, tzinfo=timezone.utc), 'W', '10.00'),
+        (datetime(2023, 1, 3, tzinfo=timezone.utc), 'D', '5.00'),
+        (datetime(2023, 1, 10, tzinfo=timezone.utc), 'W', '20.00'),
+        (datetime(2024, 2, 29, tzinfo=timezone.utc), 'D', '1.00'),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        wallet = Wallet.objects.create(id='1', name='Reported')
+        for created_at, tx_type, amount in self.POSTINGS:
+            row = (wallet.deposit if tx_type == 'D' else wallet.withdraw)(Decimal(amount))
+            Transaction.objects.filter(pk=row.pk).update(created_at=created_at)
+        MonthlyBalance.objects.rebuild(['1'])
+        self.client = APIClient()
+
+    def report(self, **params):
+        response = self.client.get('/api/wallet/1/report/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_whole_years_come_from_the_rollups(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.report(**{'from': '2023-01-01', 'to': '2024-12-31', 'granularity': 'year'})
+        self.assertFalse([query for query in queries
+                          if Transaction._meta.db_table in query['sql']])
+        self.assertEqual(data['opening_balance'], '100.00')
+        self.assertEqual([(p['start'], p['total_added'], p['total_spent'], p['closing_balance'])
+                          for p in data['periods']],
+                         [('2023-01-01', '5.00', '30.00', '75.00'),
+                          ('2024-01-01', '1.00', '0.00', '76.00')])
+
+        monthly = self.report(**{'from': '2023-01-01', 'to': '2024-12-31'})['periods']
+        self.assertEqual(len(monthly), 24)
+        report_2024 = self.client.get('/api/wallet/1/monthly-report/2024/').data['monthly_report']
+        self.assertEqual([p['closing_balance'] for p in monthly[12:]],
+                         [m['closing_balance'] for m in report_2024])
+
+    def test_days_and_weeks_in_a_partial_range(self):
+        data = self.report(**{'from': '2023-01-03', 'to': '2023-01-09', 'granularity': 'day'})
+        self.assertEqual(data['opening_balance'], '90.00')
+        self.assertEqual(len(data['periods']), 7)
+        self.assertEqual(data['periods'][0]['total_added'], '5.00')
+        self.assertEqual(data['closing_balance'], '95.00')
+
+        data = self.report(**{'from': '2023-01-04', 'to': '2023-01-15', 'granularity': 'week'})
+        self.assertEqual([(p['start'], p['end'], p['opening_balance'], p['closing_balance'])
+                          for p in data['periods']],
+                         [('2023-01-04', '2023-01-08', '95.00', '95.00'),
+                          ('2023-01-09', '2023-01-15', '95.00', '75.00')])
+
+    def test_invalid_ranges(self):
+        for params in ({'from': '2023-01-01'}, {'from': '2023-02-01', 'to': '2023-01-01'},
+                       {'from': '2023-01-01', 'to': '2023-02-30'},
+                       {'from': '2023-01-01', 'to': '2023-01-31', 'granularity': 'hour'},
+                       {'from': '2000-01-01', 'to': '2023-01-01', 'granularity': 'day'},
+                       {'from': '9999-12-01', 'to': '9999-12-31', 'granularity': 'day'},
+                       {'from': '9999-12-01', 'to': '9999-12-31', 'granularity': 'week'}):
+            self.assertEqual(self.client.get('/api/wallet/1/report/', params).status_code, 400)
+
+
+class MultiTransferTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        Wallet.objects.create(id='0', name='Payroll').deposit(Decimal('100.00'))
+        for n in range(1, 51):
+            Wallet.objects.create(id=str(n), name=f'Employee {n}')
+        self.client = APIClient()
+
+    def pay(self, legs, source='0'):
+        return self.client.post('/api/wallet/transfer/multi/', {
+            'from_wallet': source,
+            'transfers': [{'to_wallet': to, 'amount': amount} for to, amount in legs]
+        }, format='json')
+
+    def test_one_debit_many_credits_in_bulk(self):
+        legs = [(str(n), '1.50') for n in range(1, 51)] + [('1', '0.50')]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.pay(legs)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['from_wallet']['amount_debited'], '75.50')
+        self.assertEqual(response.data['from_wallet']['remaining_balance'], '24.50')
+        self.assertEqual(response.data['balances']['1'], '2.00')
+        self.assertEqual(len(response.data['transfers']), 51)
+
+        wallet_reads = [q for q in queries if q['sql'].startswith('SELECT')
+                        and '"app_wallet"."balance"' in q['sql']]
+        ledger_inserts = [q for q in queries
+                          if q['sql'].startswith('INSERT INTO "app_transaction"')]
+        self.assertEqual((len(wallet_reads), len(ledger_inserts)), (1, 1))
+
+        self.assertEqual(Transaction.objects.filter(wallet_id='0', type='W').count(), 1)
+        self.assertEqual(Wallet.objects.get(id='7').balance, Decimal('1.50'))
+        self.assertEqual(WalletTotals.objects.get(wallet_id='1').total_deposited, Decimal('2.00'))
+        self.assertEqual(sum(Wallet.objects.values_list('balance', flat=True)), Decimal('100.00'))
+
+    def test_all_or_nothing(self):
+        self.assertEqual(self.pay([('1', '60.00'), ('2', '60.00')]).status_code, 400)
+        self.assertEqual(self.pay([('1', '1.00'), ('missing', '1.00')]).status_code, 404)
+        self.assertEqual(self.pay([('1', '1.00'), ('0', '1.00')]).status_code, 400)
+        self.assertEqual(self.pay([('1', '-1.00')]).data['index'], 0)
+        self.assertEqual(Wallet.objects.get(id='0').balance, Decimal('100.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_amounts_must_fit_the_ledger(self):
+        self.assertEqual(self.pay([('1', '1.00'), ('2', '0.001')]).data['index'], 1)
+        self.assertEqual(self.pay([('1', '1e30')]).data['index'], 0)
+        largest = str(MAX_AMOUNT)
+        response = self.pay([('1', largest), ('2', largest)])
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('index', response.data)
+        self.assertEqual(Wallet.objects.get(id='0').balance, Decimal('100.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_recipients_cannot_pass_the_balance_limit(self):
+        Wallet.objects.filter(id='2').update(balance=MAX_AMOUNT - 1)
+        response = self.pay([('1', '1.00'), ('2', '0.60'), ('2', '0.60')])
+        self.assertEqual((response.status_code, response.data),
+                         (400, {'error': 'Balance limit exceeded', 'wallet_id': '2'}))
+        self.assertEqual(Wallet.objects.get(id='0').balance, Decimal('100.00'))
+        self.assertEqual(Wallet.objects.get(id='2').balance, MAX_AMOUNT - 1)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(self.pay([('2', '1.00')]).status_code, 200)
+
+
+class IdempotencyKeyTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        response_cache.clear()
+        Wallet.objects.create(id='1', name='Payer').deposit(Decimal('10.00'))
+        Wallet.objects.create(id='2', name='Payee')
+        self.client = APIClient()
+
+    def post(self, path, data, key='retry-1'):
+        return self.client.post(path, data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retries_replay_the_first_response_without_posting(self):
+        first = self.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '5.00'})
+        self.assertEqual(first.status_code, 200)
+
+        with self.assertNumQueries(0):
+            retry = self.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '5.00'})
+        self.assertEqual((retry.status_code, retry.data), (200, first.data))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+        # Another process, or after eviction: one lookup, still no posting.
+        response_cache.clear()
+        with self.assertNumQueries(1):
+            retry = self.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '5.00'})
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Transaction.objects.filter(wallet_id='1').count(), 2)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('15.00'))
+
+    def test_transfers_and_errors_are_replayed(self):
+        transfer = {'from_wallet': '1', 'to_wallet': '2', 'amount': '4.00'}
+        first = self.post('/api/wallet/transfer/', transfer)
+        self.assertEqual(self.post('/api/wallet/transfer/', transfer).data, first.data)
+        self.assertEqual(Wallet.objects.get(id='2').balance, Decimal('4.00'))
+
+        refused = self.post('/api/wallet/spend/', {'wallet_id': '2', 'amount': '9.00'}, 'spend-1')
+        self.client.post('/api/wallet/add/', {'wallet_id': '2', 'amount': '9.00'}, format='json')
+        retry = self.post('/api/wallet/spend/', {'wallet_id': '2', 'amount': '9.00'}, 'spend-1')
+        self.assertEqual((retry.status_code, retry.data), (400, refused.data))
+
+    def test_keys_are_per_request_and_per_user(self):
+        self.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '5.00'})
+        reused = self.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '6.00'})
+        self.assertEqual(reused.status_code, 422)
+
+        user = User.objects.create_user('idempotent@example.com', 'secret-pw')
+        self.client.force_authenticate(user)
+        other = self.post('/api/wallet/add/', {'wallet_id': '1', 'amount': '6.00'})
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('21.00'))
+        self.assertEqual(IdempotencyKey.objects.count(), 2)
+
+        call_command('purge_idempotency_keys', older_than_seconds=0, stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_server_errors_are_neither_stored_nor_committed(self):
+        @api_view(['POST'])
+        @idempotent
+        def failing(request):
+            Wallet.objects.get(id='1').deposit(Decimal('1.00'))
+            return Response({'error': 'Broken'}, status=500)
+
+        request = APIRequestFactory().post('/api/wallet/add/', {}, format='json',
+                                           HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(failing(request).status_code, 500)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('10.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class ReconcileTests(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        for n in range(1, 7):
+            wallet = Wallet.objects.create(id=str(n), name=f'Wallet {n}')
+            wallet.deposit(Decimal(n))
+        old = Wallet.objects.get(id='5').withdraw(Decimal('1.00'))
+        Transaction.objects.filter(pk=old.pk).update(
+            created_at=datetime(2023, 1, 1, tzinfo=timezone.utc))
+        call_command('archive_ledger', '5', before='2024-01-01', stdout=StringIO())
+        call_command('shard_wallet', '4', '2', stdout=StringIO())
+        Wallet.objects.get(id='4').deposit(Decimal('10.00'))
+
+    def reconcile(self, *args, **options):
+        out = StringIO()
+        call_command('reconcile', *args, overlap_seconds=0, stdout=out, **options)
+        return out.getvalue()
+
+    def test_reports_wallets_whose_balance_disagrees_with_the_ledger(self):
+        Wallet.objects.filter(id='2').update(balance=Decimal('7.00'))
+        with CaptureQueriesContext(connection) as queries:
+            out = self.reconcile(chunk_size=2)
+        self.assertIn('2: stored balance is 7.00, ledger says 2.00', out)
+        self.assertIn('1 mismatch(es) in 6 wallet(s) checked', out)
+
+        # One grouped ledger query per chunk, and one to recheck wallet 2.
+        ledger_sums = [query for query in queries if query['sql'].startswith('SELECT')
+                       and 'FROM "app_transaction"' in query['sql']]
+        self.assertEqual(len(ledger_sums), 4)
+        run = ReconciliationRun.objects.get()
+        self.assertEqual((run.wallets_checked, run.checked_through), (6, '6'))
+        self.assertEqual(run.mismatches, [['2', '7.00', '2.00']])
+        self.assertIsNotNone(run.finished_at)
+
+    def test_later_runs_only_check_wallets_with_new_activity(self):
+        self.reconcile()
+        Wallet.objects.get(id='1').deposit(Decimal('1.00'))
+        Wallet.objects.get(id='4').deposit(Decimal('1.00'))
+        Wallet.objects.filter(id='3').update(balance=Decimal('0.00'))
+
+        self.assertIn('All 2 wallet(s) checked match the ledger', self.reconcile())
+        self.assertIn('3: stored balance is 0.00', self.reconcile(full=True))
+
+    def test_interrupted_runs_resume_after_their_checkpoint(self):
+        ReconciliationRun.objects.create(checked_through='3', wallets_checked=3)
+        Wallet.objects.filter(id='1').update(balance=Decimal('0.00'))
+        output = tempfile.NamedTemporaryFile(suffix='.csv')
+        self.addCleanup(output.close)
+
+        out = self.reconcile(output=output.name)
+        self.assertIn('resuming after wallet 3', out)
+        self.assertIn('All 6 wallet(s) checked match the ledger', out)
+        with open(output.name) as report:
+            self.assertEqual(report.read().splitlines(),
+                             ['wallet_id,stored_balance,derived_balance,difference'])
+        self.assertIn('1: stored balance is 0.00', self.reconcile(full=True))
+
+
+@override_settings(WALLET_LOCK_RETRY_BACKOFF_MS=0)
+class LockRetryTests(TransactionTestCase):
+    # Not a TestCase: nothing is retried inside its per-test transaction.
+
+    def setUp(self):
+        locking.reset_stats()
+
+    def flaky(self, failures, message='database is locked'):
+        calls = []
+
+        def post():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError(message)
+            return 'posted'
+        return post, calls
+
+    def test_lock_conflicts_are_retried(self):
+        post, calls = self.flaky(2)
+        self.assertEqual(locking.with_retries(post), 'posted')
+        self.assertEqual((len(calls), locking.stats()['retries']), (3, 2))
+
+        post, calls = self.flaky(10)
+        with self.assertRaises(OperationalError):
+            locking.with_retries(post)
+        self.assertEqual(len(calls), 4)
+
+    def test_other_errors_and_outer_transactions_are_not_retried(self):
+        post, calls = self.flaky(1, 'no such table')
+        with self.assertRaises(OperationalError):
+            locking.with_retries(post)
+        post, more_calls = self.flaky(1)
+        with self.assertRaises(OperationalError), transaction.atomic():
+            locking.with_retries(post)
+        self.assertEqual((len(calls), len(more_calls)), (1, 1))
+
+    def test_idempotent_postings_are_retried_with_their_key(self):
+        response_cache.clear()
+        Wallet.objects.create(id='1', name='Retried')
+        create = IdempotencyKey.objects.create
+        calls = []
+
+        def store(**kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return create(**kwargs)
+
+        with mock.patch.object(IdempotencyKey.objects, 'create', side_effect=store):
+            response = APIClient().post('/api/wallet/add/', {'wallet_id': '1', 'amount': '5.00'},
+                                        format='json', HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual((response.status_code, response.data['new_balance']), (200, '5.00'))
+        self.assertEqual((len(calls), locking.stats()['retries']), (2, 1))
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'row-level locking needs PostgreSQL')
+class RowLockingTests(TransactionTestCase):
+    """
+    Money movements lock only the wallet rows they touch. Run against
+    PostgreSQL with DATABASE_URL=postgres://... python manage.py test; SQLite
+    locks the whole database instead.
+    """
+
+    def setUp(self):
+        wallet_cache.get_cache().clear()
+        for wallet_id in '123':
+            Wallet.objects.create(id=wallet_id, name=f'Wallet {wallet_id}').deposit(Decimal('10.00'))
+
+    def in_thread(self, func):
+        result = {}
+
+        def run():
+            try:
+                result['value'] = func()
+            except Exception as e:
+                result['error'] = e
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, result
+
+    def hold_lock(self, wallet_id, release):
+        # Keep wallet_id locked, in another connection, until release is set.
+        locked = threading.Event()
+
+        def hold():
+            with transaction.atomic():
+                Wallet.objects.select_for_update().get(id=wallet_id)
+                locked.set()
+                release.wait(10)
+
+        thread, _ = self.in_thread(hold)
+        self.assertTrue(locked.wait(10))
+        return thread
+
+    def post(self, path, data):
+        return APIClient().post(path, data, format='json')
+
+    def test_independent_wallets_do_not_wait(self):
+        release = threading.Event()
+        holder = self.hold_lock('1', release)
+        try:
+            thread, result = self.in_thread(lambda: self.post('/api/wallet/transfer/', {
+                'from_wallet': '2', 'to_wallet': '3', 'amount': '1.00'}))
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), 'transfer between 2 and 3 waited on wallet 1')
+            self.assertEqual(result['value'].status_code, 200, result)
+        finally:
+            release.set()
+            holder.join()
+
+    def test_same_wallet_waits_for_the_lock(self):
+        release = threading.Event()
+        holder = self.hold_lock('1', release)
+        thread, result = self.in_thread(lambda: self.post('/api/wallet/spend/', {
+            'wallet_id': '1', 'amount': '1.00'}))
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive(), 'spend did not wait for the lock on wallet 1')
+
+        release.set()
+        holder.join()
+        thread.join(5)
+        self.assertEqual(result['value'].status_code, 200, result)
+
+    def test_concurrent_spends_never_overdraw(self):
+        spends = [self.in_thread(lambda: self.post('/api/wallet/spend/', {
+            'wallet_id': '1', 'amount': '3.00'})) for _ in range(8)]
+        for thread, _ in spends:
+            thread.join(10)
+
+        statuses = sorted(result['value'].status_code for _, result in spends)
+        self.assertEqual(statuses, [200] * 3 + [400] * 5)
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('1.00'))
+        self.assertEqual(WalletTotals.objects.get(wallet_id='1').total_withdrawn, Decimal('9.00'))
+
+    def test_criss_cross_transfers_do_not_deadlock(self):
+        locking.reset_stats()
+        pairs = [('1', '2'), ('2', '1'), ('2', '3'), ('3', '2'), ('3', '1'), ('1', '3')]
+
+        def transfers(from_wallet, to_wallet):
+            client = APIClient()
+            return [client.post('/api/wallet/transfer/', {
+                'from_wallet': from_wallet, 'to_wallet': to_wallet, 'amount': '1.00'},
+                format='json').status_code for _ in range(400)]
+
+        workers = [self.in_thread(lambda pair=pair: transfers(*pair)) for pair in pairs]
+        for thread, _ in workers:
+            thread.join(120)
+
+        statuses = [status for _, result in workers for status in result['value']]
+        self.assertEqual(len(statuses), 2400)
+        self.assertEqual(set(statuses) - {200, 400}, set())
+        self.assertEqual(locking.stats()['retries'], 0)
+        self.assertEqual(sum(Wallet.objects.values_list('balance', flat=True)), Decimal('30.00'))
+        for wallet in Wallet.objects.all():
+            totals = WalletTotals.objects.get(wallet=wallet)
+            self.assertEqual(totals.total_deposited - totals.total_withdrawn, wallet.balance)
+
+    def test_concurrent_retries_post_once(self):
+        release = threading.Event()
+        holder = self.hold_lock('1', release)
+        retries = [self.in_thread(lambda: APIClient().post(
+            '/api/wallet/spend/', {'wallet_id': '1', 'amount': '3.00'},
+            format='json', HTTP_IDEMPOTENCY_KEY='retry-1')) for _ in range(4)]
+        release.set()
+        holder.join()
+        for thread, _ in retries:
+            thread.join(10)
+
+        responses = [result['value'] for _, result in retries]
+        self.assertEqual({(response.status_code, response.data['remaining_balance'])
+                          for response in responses}, {(200, '7.00')})
+        self.assertEqual(Wallet.objects.get(id='1').balance, Decimal('7.00'))
+
+
+@override_settings(WALLET_POSTING_MODE='conditional')
+class ConditionalRowLockingTests(RowLockingTests):
+    pass
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite tuning')
+class SQLiteTuningTests(TransactionTestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_connections_are_tuned(self):
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('temp_store'), 2)  # MEMORY
+
+    def test_the_journal_mode_is_left_alone_by_default(self):
+        # It is stored in the database file and would outlive the setting.
+        self.assertNotIn('journal_mode', settings.WALLET_SQLITE_PRAGMAS)
+        self.assertEqual(self.pragma('synchronous'), 2)  # FULL
+
+    def test_transactions_take_the_write_lock_up_front(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                Wallet.objects.count()
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
@@ -26,7 +26,11 @@ urlpatterns = [
     path('wallet/add/', views.add_money),
     path('wallet/spend/', views.spend_money),
     path('wallet/transfer/', views.transfer_money),
+    path('wallet/transfer/multi/', views.multi_transfer_money),
+    path('wallet/batch/', views.batch_money),
+    path('wallet/summaries/', views.wallet_summaries, name='wallet_summaries'),
     path('wallet/<str:wallet_id>/transactions/', views.wallet_transactions),
     path('wallet/<str:wallet_id>/summary/', views.wallet_summary, name='wallet_summary'),
     path('wallet/<str:wallet_id>/monthly-report/<int:year>/', views.wallet_monthly_report, name='wallet_monthly_report'),
+    path('wallet/<str:wallet_id>/report/', views.wallet_range_report, name='wallet_range_report'),
 ]
@@ -1,24 +1,113 @@
 import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from django.db.models import Sum
 from decimal import Decimal
 from calendar import monthrange
 from datetime import datetime
-from datetime import datetime, timedelta
+from datetime import MAXYEAR, datetime, timedelta
 from collections import OrderedDict
-from django.db.models.functions import TruncMonth
+from functools import wraps
+from hashlib import sha1
 from decimal import Decimal, InvalidOperation
+from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework.authentication import BasicAuthentication
 from rest_framework.decorators import api_view, authentication_classes
 from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from django.db import transaction
-from app.models import User
+from app import cache as wallet_cache
+from app import group_commit
+from app import ledger as wallet_ledger
+from app.authentication import TokenAuthentication
+from app.idempotency import idempotent
+from app.ids import next_id
+from app.locking import with_retries
+from app.models import (MAX_AMOUNT, AuthToken, BalanceLimitExceeded, InsufficientBalance,
+                        MonthlyBalance, User, WalletShard, WalletTotals, month_of,
+                        next_month, start_of)
 from app.serializers import *
 
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+HISTORY_STREAM_CHUNK_SIZE = 2000
+
+SUMMARIES_PAGE_SIZE = 500
+SUMMARIES_MAX_PAGE_SIZE = 5000
+SUMMARIES_MAX_WALLET_IDS = 10000
+SUMMARIES_STREAM_CHUNK_SIZE = 2000
+
+REPORT_GRANULARITIES = ('day', 'week', 'month', 'year')
+REPORT_MAX_PERIODS = 5000
+
+BATCH_MAX_OPERATIONS = 5000
+MULTI_TRANSFER_MAX_LEGS = 5000
+BATCH_OPERATION_TYPES = {'add': 'D', 'spend': 'W'}
+
+CENT = Decimal('0.01')
+
+
+def wallet_conditional(view):
+    """
+    Answer GETs with 304 Not Modified while the client's ETag or
+    Last-Modified still matches the wallet's state, and stamp fresh
+    responses with both. The validators come from the wallet row and its
+    running totals (and are cached like the responses themselves), so
+    checking them never touches the ledger.
+    """
+    @wraps(view)
+    def wrapped(request, wallet_id, *args, **kwargs):
+        validators = wallet_cache.cached(wallet_id, 'validators',
+                                         lambda: _wallet_validators(wallet_id))
+        if validators is None:
+            return view(request, wallet_id, *args, **kwargs)
+
+        etag, last_modified = validators
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view(request, wallet_id, *args, **kwargs)
+        # A 304 must repeat the validators (RFC 7232, section 4.1).
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+    return wrapped
+
+
+def _wallet_validators(wallet_id):
+    state = Wallet.objects.filter(id=wallet_id).values_list(
+        'balance', 'shard_count',
+        'totals__transaction_count', 'totals__last_transaction_at'
+    ).first()
+    if state is None or state[2] is None:
+        # Unknown wallet, or totals not seeded yet: let the view handle it.
+        return None
+
+    balance, shard_count, count, last_transaction_at = state
+    if shard_count:
+        pending = WalletShard.objects.pending(wallet_id)
+        balance += pending['balance']
+        count += pending['count']
+        if pending['last_transaction_at'] and (
+                last_transaction_at is None or
+                pending['last_transaction_at'] > last_transaction_at):
+            last_transaction_at = pending['last_transaction_at']
+
+    tag = f'{wallet_id}:{balance}:{count}:{last_transaction_at}'
+    etag = quote_etag(sha1(tag.encode()).hexdigest())
+    last_modified = int(last_transaction_at.timestamp()) if last_transaction_at else None
+    return etag, last_modified
+
 
 @api_view(['POST'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
 def api_create_account(request):
     """
     post: Create user account with specified details.
@@ -53,10 +142,13 @@ def api_create_account(request):
 
 
 @api_view(('POST',))
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
 def api_login(request):
     """
     post: Log in user with specified details.
+
+    The response carries an API token; send it as ``Authorization: Token
+    <token>`` instead of Basic credentials on subsequent requests.
     """
     data = JSONParser().parse(request)
     email = data['email']
@@ -65,21 +157,23 @@ def api_login(request):
     if user is not None:
         login(request, user)
         return Response(status=200,
-                        data={'success', f'User {email} logged in.'})
+                        data={'success': f'User {email} logged in.',
+                              'token': AuthToken.objects.issue(user),
+                              'expires_in': settings.WALLET_TOKEN_TTL})
     else:
         return Response(status=404,
-                        data={'error', f'User {email} not found.'})
+                        data={'error': f'User {email} not found.'})
 
 
 @api_view(('POST',))
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
 def api_create_wallet(request):
     """
     post: Create a wallet with the given name and return the new wallet's ID.
     """
     data = JSONParser().parse(request)
     name = data['name']
-    wallet_id = str(int(datetime.utcnow().timestamp()))
+    wallet_id = next_id()
     wallet = Wallet.objects.create(name=name, id=wallet_id)
     wallet.save()
     return Response(status=201, data={'success': f'Wallet created ({name}). '
@@ -89,122 +183,238 @@ def api_create_wallet(request):
 
 
 @api_view(['GET'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@wallet_conditional
 def wallet_transactions(request, wallet_id):
     """
     get: Show wallet transaction history and balance derivation
+
+    History is keyset-paginated on (created_at, id): pass ``limit`` and the
+    ``next_cursor`` of the previous page as ``cursor``. With ``stream=true``
+    the whole history (from ``cursor`` onwards) is streamed as NDJSON.
     """
     try:
-        wallet = Wallet.objects.get(id=wallet_id)
+        limit = _parse_limit(request.query_params.get('limit'))
+        cursor = request.query_params.get('cursor') or ''
+        after = _decode_cursor(cursor)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
 
-        transactions = Transaction.objects.filter(wallet=wallet).order_by('created_at')
+    try:
+        if request.query_params.get('stream', '').lower() in ('1', 'true', 'yes'):
+            wallet = Wallet.objects.select_related('archive').get(id=wallet_id)
+            return StreamingHttpResponse(
+                _stream_transactions(wallet_ledger.history(wallet, after)),
+                content_type='application/x-ndjson'
+            )
 
-        deposits = transactions.filter(type='D').aggregate(
-            total=Sum('value')
-        )['total'] or 0
+        data = wallet_cache.cached(
+            wallet_id, f'transactions:{limit}:{cursor}',
+            lambda: _transactions_page(wallet_id, limit, after)
+        )
+        return Response(data, status=200)
 
-        withdrawals = transactions.filter(type='W').aggregate(
-            total=Sum('value')
-        )['total'] or 0
+    except Wallet.DoesNotExist:
+        return Response({"error": "Wallet not found"}, status=404)
 
-        derived_balance = deposits - withdrawals
 
-        data = {
-            "wallet_id": wallet_id,
-            "derived_balance": str(derived_balance),
-            "stored_balance": str(wallet.balance),
-            "transactions": [
-                {
-                    "transaction_id": tx.id,
-                    "type": "Deposit" if tx.type == "D" else "Withdraw",
-                    "amount": str(tx.value),
-                    "created_at": tx.created_at
-                }
-                for tx in transactions
-            ]
-        }
+def _transactions_page(wallet_id, limit, after):
+    wallet = Wallet.objects.select_related('totals', 'archive').get(id=wallet_id)
+    derived_balance = WalletTotals.objects.for_wallet(wallet).net
+
+    # Fetch one extra row to find out whether another page exists.
+    rows = []
+    for ledger in wallet_ledger.history(wallet, after):
+        rows += ledger[:limit + 1 - len(rows)]
+        if len(rows) > limit:
+            break
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1][3], rows[-1][0])
+
+    return {
+        "wallet_id": wallet_id,
+        "derived_balance": str(derived_balance),
+        "stored_balance": str(wallet.available_balance()),
+        "transactions": [_transaction_row(row) for row in rows],
+        "next_cursor": next_cursor
+    }
+
+
+def _parse_limit(value, default=HISTORY_PAGE_SIZE, maximum=HISTORY_MAX_PAGE_SIZE):
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if not 1 <= limit <= maximum:
+        raise ValueError(f'Limit must be between 1 and {maximum}')
+    return limit
 
-        return Response(data, status=200)
 
-    except Wallet.DoesNotExist:
-        return Response({"error": "Wallet not found"}, status=404)
+def _encode_cursor(created_at, tx_id):
+    raw = f'{created_at.isoformat()}|{tx_id}'
+    return urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = urlsafe_b64decode(cursor.encode()).decode()
+        created_at, tx_id = raw.split('|', 1)
+        created_at = parse_datetime(created_at)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if created_at is None or created_at.tzinfo is None:
+        raise ValueError('Invalid cursor')
+    return created_at, tx_id
+
+
+def _transaction_row(row):
+    tx_id, tx_type, value, created_at = row
+    return {
+        "transaction_id": tx_id,
+        "type": "Deposit" if tx_type == "D" else "Withdraw",
+        "amount": str(value),
+        "created_at": created_at
+    }
+
+
+def _stream_transactions(history):
+    encoder = JSONEncoder()
+    for rows in history:
+        for chunk in wallet_ledger.chunked(rows, HISTORY_STREAM_CHUNK_SIZE):
+            for row in chunk:
+                yield encoder.encode(_transaction_row(row)) + '\n'
 
 
 @api_view(['POST'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@idempotent
 def add_money(request):
     """
     post: Add money to wallet (recorded as immutable transaction)
     """
     try:
         wallet_id = request.data.get('wallet_id')
-        amount = Decimal(request.data.get('amount'))
+        amount = request.data.get('amount')
 
-        if amount <= 0:
+        if Decimal(amount) <= 0:
             return Response({"error": "Amount must be greater than zero"}, status=400)
+        amount = _parse_amount(amount)
 
-        with transaction.atomic():
-            wallet = Wallet.objects.select_for_update().get(id=wallet_id)
-            wallet.deposit(amount)
+        new_balance = with_retries(lambda: _deposit(wallet_id, amount))
 
         return Response(
             {
                 "message": "Deposit successful",
                 "wallet_id": wallet_id,
-                "new_balance": str(wallet.balance)
+                "new_balance": str(new_balance)
             },
             status=200
         )
 
+    except BalanceLimitExceeded:
+        return Response({"error": "Balance limit exceeded"}, status=400)
+
     except Wallet.DoesNotExist:
         return Response({"error": "Wallet not found"}, status=404)
 
-    except (InvalidOperation, TypeError):
+    except (InvalidOperation, TypeError, ValueError):
         return Response({"error": "Invalid amount"}, status=400)
 
+    except group_commit.DepositTimeout:
+        return Response({"error": "Deposit timed out"}, status=503)
+
+
+def _deposit(wallet_id, amount):
+    # Deposits made inside a transaction (e.g. with an Idempotency-Key) must
+    # commit or roll back with it, so they never go through group commit.
+    if settings.WALLET_GROUP_COMMIT and not transaction.get_connection().in_atomic_block:
+        outcome = group_commit.deposit(wallet_id, amount)
+        # The errors post_batch reports for a deposit.
+        if outcome.get('error') == 'Balance limit exceeded':
+            raise BalanceLimitExceeded(wallet_id)
+        if 'error' in outcome:
+            raise Wallet.DoesNotExist(outcome['error'])
+        return outcome['balance']
+
+    sharded = Wallet.objects.filter(id=wallet_id, shard_count__gt=0).first()
+    if sharded is not None:
+        WalletShard.objects.deposit(sharded, amount)
+        return sharded.available_balance()
+    if settings.WALLET_POSTING_MODE == 'conditional':
+        _, balances = Wallet.objects.post_conditional([(wallet_id, 'D', amount)])
+        return balances[str(wallet_id)]
+    with transaction.atomic():
+        wallet = Wallet.objects.select_for_update().get(id=wallet_id)
+        wallet.deposit(amount)
+    return wallet.balance
+
 @api_view(['POST'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@idempotent
 def spend_money(request):
     """
     post: Spend money from wallet (recorded as immutable transaction)
     """
     try:
         wallet_id = request.data.get('wallet_id')
-        amount = Decimal(request.data.get('amount'))
+        amount = request.data.get('amount')
 
-        if amount <= 0:
+        if Decimal(amount) <= 0:
             return Response({"error": "Amount must be greater than zero"}, status=400)
+        amount = _parse_amount(amount)
 
-        with transaction.atomic():
-            wallet = Wallet.objects.select_for_update().get(id=wallet_id)
-
-            if wallet.balance < amount:
-                return Response(
-                    {
-                        "error": "Insufficient balance",
-                        "current_balance": str(wallet.balance)
-                    },
-                    status=400
-                )
-
-            wallet.withdraw(amount)
+        remaining_balance = with_retries(lambda: _spend(wallet_id, amount))
 
         return Response(
             {
                 "message": "Spend successful",
-                "remaining_balance": str(wallet.balance)
+                "remaining_balance": str(remaining_balance)
             },
             status=200
         )
 
+    except InsufficientBalance as e:
+        return Response(
+            {
+                "error": "Insufficient balance",
+                "current_balance": str(e.balance)
+            },
+            status=400
+        )
+
+    except BalanceLimitExceeded:
+        return Response({"error": "Balance limit exceeded"}, status=400)
+
     except Wallet.DoesNotExist:
         return Response({"error": "Wallet not found"}, status=404)
 
-    except (InvalidOperation, TypeError):
+    except (InvalidOperation, TypeError, ValueError):
         return Response({"error": "Invalid amount"}, status=400)
 
+
+def _spend(wallet_id, amount):
+    if settings.WALLET_POSTING_MODE == 'conditional':
+        _, balances = Wallet.objects.post_conditional([(wallet_id, 'W', amount)])
+        return balances[str(wallet_id)]
+    with transaction.atomic():
+        wallet = Wallet.objects.select_for_update().get(id=wallet_id)
+        WalletShard.objects.collect(wallet)
+
+        if wallet.balance < amount:
+            raise InsufficientBalance(wallet.id, wallet.balance)
+
+        wallet.withdraw(amount)
+    return wallet.balance
+
 @api_view(['POST'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@idempotent
 def transfer_money(request):
     """
     post: Atomic transfer with immutable transaction logs
@@ -212,35 +422,14 @@ def transfer_money(request):
     try:
         from_wallet_id = request.data.get('from_wallet')
         to_wallet_id = request.data.get('to_wallet')
-        amount = Decimal(request.data.get('amount'))
-
-        if amount <= 0:
-            return Response({"error": "Invalid amount"}, status=400)
-
-        with transaction.atomic():
-            wallets = (
-                Wallet.objects
-                .select_for_update()
-                .filter(id__in=[from_wallet_id, to_wallet_id])
-            )
-
-            if wallets.count() != 2:
-                return Response({"error": "Wallet not found"}, status=404)
-
-            from_wallet = next(w for w in wallets if w.id == from_wallet_id)
-            to_wallet = next(w for w in wallets if w.id == to_wallet_id)
+        amount = _parse_amount(request.data.get('amount'))
 
-            if from_wallet.balance < amount:
-                return Response(
-                    {"error": "Insufficient balance"},
-                    status=400
-                )
+        if from_wallet_id == to_wallet_id:
+            return Response({"error": "Wallet not found"}, status=404)
 
-          
-            from_wallet.withdraw(amount)
-            to_wallet.deposit(amount)
+        from_balance, to_balance = with_retries(
+            lambda: _transfer(from_wallet_id, to_wallet_id, amount))
 
-      
         return Response(
             {
                 "message": "Transfer successful",
@@ -248,119 +437,549 @@ def transfer_money(request):
                     "amount_transferred": str(amount),
                     "from_wallet": {
                         "id": from_wallet_id,
-                        "remaining_balance": str(from_wallet.balance)
+                        "remaining_balance": str(from_balance)
                     },
                     "to_wallet": {
                         "id": to_wallet_id,
                         "credited_amount": str(amount),
-                        "available_balance": str(to_wallet.balance)
+                        "available_balance": str(to_balance)
                     }
                 }
             },
             status=200
         )
 
-    except (InvalidOperation, TypeError):
+    except InsufficientBalance:
+        return Response({"error": "Insufficient balance"}, status=400)
+
+    except BalanceLimitExceeded:
+        return Response({"error": "Balance limit exceeded"}, status=400)
+
+    except Wallet.DoesNotExist:
+        return Response({"error": "Wallet not found"}, status=404)
+
+    except (InvalidOperation, TypeError, ValueError):
         return Response({"error": "Invalid amount"}, status=400)
 
+
+def _transfer(from_wallet_id, to_wallet_id, amount):
+    if settings.WALLET_POSTING_MODE == 'conditional':
+        _, balances = Wallet.objects.post_conditional([
+            (from_wallet_id, 'W', amount),
+            (to_wallet_id, 'D', amount),
+        ])
+        return balances[str(from_wallet_id)], balances[str(to_wallet_id)]
+    with transaction.atomic():
+        wallets = Wallet.objects.lock([from_wallet_id, to_wallet_id])
+        if len(wallets) != 2:
+            raise Wallet.DoesNotExist('Wallet not found')
+
+        from_wallet = wallets[str(from_wallet_id)]
+        to_wallet = wallets[str(to_wallet_id)]
+        WalletShard.objects.collect(from_wallet)
+
+        if from_wallet.balance < amount:
+            raise InsufficientBalance(from_wallet.id, from_wallet.balance)
+
+        from_wallet.transfer_to(to_wallet, amount)
+    return from_wallet.balance, to_wallet.balance
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@idempotent
+def multi_transfer_money(request):
+    """
+    post: Debit one wallet once and credit many, all in one transaction
+
+    Body: ``{"from_wallet": ..., "transfers": [{"to_wallet": ...,
+    "amount": ...}, ...]}``. Either every transfer is applied or none is.
+    """
+    from_wallet_id = request.data.get('from_wallet')
+    transfers = request.data.get('transfers')
+    if not isinstance(transfers, list) or not transfers:
+        return Response({"error": "A non-empty list of transfers is required"}, status=400)
+    if len(transfers) > MULTI_TRANSFER_MAX_LEGS:
+        return Response(
+            {"error": f"At most {MULTI_TRANSFER_MAX_LEGS} transfers per request"},
+            status=400
+        )
+
+    credits = []
+    for index, leg in enumerate(transfers):
+        try:
+            to_wallet_id = str(leg['to_wallet'])
+            amount = _parse_amount(leg['amount'])
+        except (InvalidOperation, KeyError, TypeError, ValueError):
+            return Response({"error": "Invalid transfer", "index": index}, status=400)
+        if to_wallet_id == str(from_wallet_id):
+            return Response({"error": "Cannot transfer to the source wallet", "index": index},
+                            status=400)
+        credits.append((to_wallet_id, amount))
+    # The debit is a single ledger row, so the total must fit its column too.
+    if sum(amount for _, amount in credits) > MAX_AMOUNT:
+        return Response({"error": "Total amount is too large"}, status=400)
+
+    try:
+        ledger_rows, wallets = with_retries(
+            lambda: Wallet.objects.fan_out(from_wallet_id, credits))
+    except InsufficientBalance as e:
+        return Response(
+            {
+                "error": "Insufficient balance",
+                "current_balance": str(e.balance)
+            },
+            status=400
+        )
+    except BalanceLimitExceeded as e:
+        return Response({"error": "Balance limit exceeded", "wallet_id": e.wallet_id},
+                        status=400)
+    except Wallet.DoesNotExist:
+        return Response({"error": "Wallet not found"}, status=404)
+
+    debit, credit_rows = ledger_rows[0], ledger_rows[1:]
+    return Response(
+        {
+            "message": "Transfer successful",
+            "from_wallet": {
+                "id": debit.wallet_id,
+                "amount_debited": str(debit.value),
+                "remaining_balance": str(debit.wallet.balance),
+                "transaction_id": debit.id
+            },
+            "transfers": [
+                {
+                    "to_wallet": row.wallet_id,
+                    "credited_amount": str(row.value),
+                    "transaction_id": row.id
+                }
+                for row in credit_rows
+            ],
+            "balances": {
+                wallet_id: str(wallet.balance) for wallet_id, wallet in wallets.items()
+                if wallet_id != debit.wallet_id
+            }
+        },
+        status=200
+    )
+
+
+def _parse_amount(value):
+    """
+    Parse a positive amount of whole cents that fits the ledger's
+    ``max_digits=20, decimal_places=2`` columns, returned with exactly two
+    decimal places. Raises ``InvalidOperation`` for anything else.
+    """
+    # JSON numbers arrive as floats: 5.1 means '5.1', not its binary value.
+    amount = Decimal(str(value) if isinstance(value, float) else value)
+    if not amount.is_finite() or amount <= 0 or amount > MAX_AMOUNT or \
+            amount != amount.quantize(CENT):
+        raise InvalidOperation
+    return amount.quantize(CENT)
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+def batch_money(request):
+    """
+    post: Apply many add/spend operations across wallets in one transaction
+
+    Body: ``{"operations": [{"wallet_id": ..., "type": "add" | "spend",
+    "amount": ...}, ...]}``. Operations are applied in order; each one
+    succeeds or fails on its own and gets an entry in ``results``.
+    """
+    operations = request.data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return Response({"error": "A non-empty list of operations is required"}, status=400)
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return Response(
+            {"error": f"At most {BATCH_MAX_OPERATIONS} operations per batch"},
+            status=400
+        )
+
+    results = [None] * len(operations)
+    valid, positions = [], []
+    for index, operation in enumerate(operations):
+        try:
+            tx_type = BATCH_OPERATION_TYPES[operation.get('type')]
+            amount = _parse_amount(operation.get('amount'))
+        except (AttributeError, KeyError):
+            results[index] = {"index": index, "error": "Invalid operation type"}
+            continue
+        except (InvalidOperation, TypeError, ValueError):
+            results[index] = {"index": index, "error": "Invalid amount"}
+            continue
+        valid.append((str(operation.get('wallet_id')), tx_type, amount))
+        positions.append(index)
+
+    outcomes = with_retries(lambda: Wallet.objects.post_batch(valid))
+    for index, (wallet_id, _, _), outcome in zip(positions, valid, outcomes):
+        if 'error' in outcome:
+            results[index] = {"index": index, "wallet_id": wallet_id,
+                              "error": outcome['error']}
+        else:
+            results[index] = {
+                "index": index,
+                "wallet_id": wallet_id,
+                "transaction_id": outcome['transaction'].id,
+                "balance": str(outcome['balance'])
+            }
+
+    return Response({
+        "applied": sum(1 for result in results if 'error' not in result),
+        "failed": sum(1 for result in results if 'error' in result),
+        "results": results
+    }, status=200)
+
 @api_view(['GET'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@wallet_conditional
 def wallet_summary(request, wallet_id):
     """
     get: Return current balance, total money added, and total money spent
     """
     try:
-        wallet = Wallet.objects.get(id=wallet_id)
+        data = wallet_cache.cached(wallet_id, 'summary',
+                                   lambda: _summary(wallet_id))
+        return Response(data, status=200)
 
-        transactions = Transaction.objects.filter(wallet=wallet)
+    except Wallet.DoesNotExist:
+        return Response({"error": "Wallet not found"}, status=404)
+
+
+def _summary(wallet_id):
+    wallet = Wallet.objects.select_related('totals').get(id=wallet_id)
+    totals = WalletTotals.objects.for_wallet(wallet)
+
+    return {
+        "wallet_id": wallet_id,
+        "current_balance": str(wallet.available_balance()),
+        "total_added": str(totals.total_deposited),
+        "total_spent": str(totals.total_withdrawn)
+    }
 
-        total_added = transactions.filter(type='D').aggregate(total=Sum('value'))['total'] or Decimal('0.00')
-        total_spent = transactions.filter(type='W').aggregate(total=Sum('value'))['total'] or Decimal('0.00')
 
-        return Response({
+@api_view(['GET', 'POST'])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+def wallet_summaries(request):
+    """
+    get: Summaries (balance, total added, total spent) for many wallets
+    post: Same, for the wallet ids in the body
+
+    Wallets are picked by ``wallet_ids`` (a JSON list in a POST body, or a
+    comma-separated ``ids`` query parameter) and/or a ``name`` substring;
+    with neither, every wallet is summarised. Results are keyset-paginated
+    on wallet id: pass ``limit`` and the previous page's ``next_cursor`` as
+    ``cursor``. With ``stream=true`` all matching summaries (from
+    ``cursor`` onwards) are streamed as NDJSON.
+    """
+    try:
+        limit = _parse_limit(request.query_params.get('limit'),
+                             SUMMARIES_PAGE_SIZE, SUMMARIES_MAX_PAGE_SIZE)
+        cursor = request.query_params.get('cursor') or ''
+        after = _decode_wallet_cursor(cursor)
+        wallet_ids = _parse_wallet_ids(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    wallets = Wallet.objects.order_by('id')
+    if wallet_ids is not None:
+        wallets = wallets.filter(id__in=wallet_ids)
+    name = request.query_params.get('name')
+    if name:
+        wallets = wallets.filter(name__icontains=name)
+    if after is not None:
+        wallets = wallets.filter(id__gt=after)
+
+    if request.query_params.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return StreamingHttpResponse(_stream_summaries(wallets),
+                                     content_type='application/x-ndjson')
+
+    # Fetch one extra wallet to find out whether another page exists.
+    summaries = _wallet_summaries(wallets[:limit + 1])
+    next_cursor = None
+    if len(summaries) > limit:
+        summaries = summaries[:limit]
+        next_cursor = _encode_wallet_cursor(summaries[-1]['wallet_id'])
+
+    data = {"wallets": summaries, "next_cursor": next_cursor}
+    if wallet_ids is not None and after is None:
+        found = set(Wallet.objects.filter(id__in=wallet_ids).values_list('id', flat=True))
+        data["not_found"] = [wallet_id for wallet_id in wallet_ids if wallet_id not in found]
+    return Response(data, status=200)
+
+
+def _wallet_summaries(wallets):
+    """
+    Summaries for the ``wallets`` queryset, read from the wallet rows and
+    their running totals in one joined query (plus one grouped query over
+    the shards of any sharded wallets) rather than three queries per wallet.
+    """
+    columns = ('id', 'balance', 'shard_count',
+               'totals__total_deposited', 'totals__total_withdrawn')
+    rows = list(wallets.values_list(*columns))
+    unseeded = [row[0] for row in rows if row[3] is None]
+    if unseeded:
+        # Seed missing totals from the ledger once, then read them back.
+        WalletTotals.objects.rebuild(unseeded)
+        rows = list(Wallet.objects.filter(id__in=[row[0] for row in rows])
+                    .order_by('id').values_list(*columns))
+
+    sharded = [row[0] for row in rows if row[2]]
+    pending = {
+        row['wallet_id']: row
+        for row in WalletShard.objects.filter(wallet_id__in=sharded)
+        .order_by().values('wallet_id').annotate(
+            balance=Sum('balance'), deposited=Sum('pending_deposited'))
+    } if sharded else {}
+
+    summaries = []
+    for wallet_id, balance, _, deposited, withdrawn in rows:
+        if wallet_id in pending:
+            balance += pending[wallet_id]['balance']
+            deposited += pending[wallet_id]['deposited']
+        summaries.append({
             "wallet_id": wallet_id,
-            "current_balance": str(wallet.balance),
-            "total_added": str(total_added),
-            "total_spent": str(total_spent)
-        }, status=200)
+            "current_balance": str(balance),
+            "total_added": str(deposited),
+            "total_spent": str(withdrawn)
+        })
+    return summaries
+
+
+def _stream_summaries(wallets):
+    encoder = JSONEncoder()
+    after = None
+    while True:
+        chunk = wallets if after is None else wallets.filter(id__gt=after)
+        summaries = _wallet_summaries(chunk[:SUMMARIES_STREAM_CHUNK_SIZE])
+        for summary in summaries:
+            yield encoder.encode(summary) + '\n'
+        if len(summaries) < SUMMARIES_STREAM_CHUNK_SIZE:
+            return
+        after = summaries[-1]['wallet_id']
+
+
+def _parse_wallet_ids(request):
+    if request.method == 'POST':
+        wallet_ids = request.data.get('wallet_ids')
+        if wallet_ids is None:
+            return None
+        if not isinstance(wallet_ids, list):
+            raise ValueError('wallet_ids must be a list')
+    else:
+        ids = request.query_params.get('ids')
+        if not ids:
+            return None
+        wallet_ids = ids.split(',')
+    if len(wallet_ids) > SUMMARIES_MAX_WALLET_IDS:
+        raise ValueError(f'At most {SUMMARIES_MAX_WALLET_IDS} wallet ids per request')
+    # Keep the caller's order for not_found, without repeats.
+    return list(OrderedDict.fromkeys(str(wallet_id).strip() for wallet_id in wallet_ids))
+
+
+def _encode_wallet_cursor(wallet_id):
+    return urlsafe_b64encode(wallet_id.encode()).decode()
+
+
+def _decode_wallet_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
 
-    except Wallet.DoesNotExist:
-        return Response({"error": "Wallet not found"}, status=404)
 
 @api_view(['GET'])
-@authentication_classes([BasicAuthentication])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@wallet_conditional
 def wallet_monthly_report(request, wallet_id, year: int):
     """
     get: Generate month-wise financial report for a wallet
     """
     try:
-        wallet = Wallet.objects.get(id=wallet_id)
+        data = wallet_cache.cached(wallet_id, f'monthly-report:{year}',
+                                   lambda: _monthly_report(wallet_id, year))
+        return Response(data, status=200)
 
-        # Get all transactions of this wallet for the year
-        transactions = Transaction.objects.filter(
-            wallet=wallet,
-            created_at__year=year
-        )
+    except Wallet.DoesNotExist:
+        return Response({"error": "Wallet not found"}, status=404)
 
-        # Aggregate deposits and withdrawals per month
-        monthly_data = transactions.annotate(month=TruncMonth('created_at')) \
-            .values('month', 'type') \
-            .annotate(total=Sum('value')) \
-            .order_by('month')
-
-        # Initialize month-wise report dictionary (Jan → Dec)
-        report = OrderedDict()
-        for m in range(1, 13):
-            report[m] = {
-                "month": m,
-                "month_name": datetime(year, m, 1).strftime("%B"),
-                "opening_balance": Decimal('0.00'),
-                "total_added": Decimal('0.00'),
-                "total_spent": Decimal('0.00'),
-                "closing_balance": Decimal('0.00')
-            }
 
-        # Fill month-wise totals from transaction aggregation
-        for entry in monthly_data:
-            month_number = entry['month'].month
-            if entry['type'] == 'D':
-                report[month_number]["total_added"] = entry['total'] or Decimal('0.00')
-            elif entry['type'] == 'W':
-                report[month_number]["total_spent"] = entry['total'] or Decimal('0.00')
-
-        # Compute opening and closing balances
-        # Opening balance for Jan = previous year balance (or 0)
-        # We'll calculate previous balance by summing all transactions before this year
-        prev_transactions = Transaction.objects.filter(
-            wallet=wallet,
-            created_at__lt=datetime(year, 1, 1)
-        )
+def _monthly_report(wallet_id, year):
+    wallet = Wallet.objects.get(id=wallet_id)
+
+    # Opening balance for Jan = closing balance of the latest month
+    # before this year (or 0); month totals come from the rollups.
+    prev_balance, rollups = MonthlyBalance.objects.for_year(wallet, year)
+
+    # Initialize month-wise report dictionary (Jan → Dec)
+    report = OrderedDict()
+    for m in range(1, 13):
+        rollup = rollups.get(m)
+        report[m] = {
+            "month": m,
+            "month_name": datetime(year, m, 1).strftime("%B"),
+            "opening_balance": Decimal('0.00'),
+            "total_added": rollup.total_deposited if rollup else Decimal('0.00'),
+            "total_spent": rollup.total_withdrawn if rollup else Decimal('0.00'),
+            "closing_balance": Decimal('0.00')
+        }
 
-        prev_balance = (
-            prev_transactions.filter(type='D').aggregate(total=Sum('value'))['total'] or Decimal('0.00')
-        ) - (
-            prev_transactions.filter(type='W').aggregate(total=Sum('value'))['total'] or Decimal('0.00')
-        )
+    # Fill balances month by month
+    running_balance = prev_balance
+    for m in range(1, 13):
+        month_entry = report[m]
+        month_entry["opening_balance"] = running_balance
+        month_entry["closing_balance"] = running_balance + month_entry["total_added"] - month_entry["total_spent"]
+        running_balance = month_entry["closing_balance"]
 
-        # Fill balances month by month
-        running_balance = prev_balance
-        for m in range(1, 13):
-            month_entry = report[m]
-            month_entry["opening_balance"] = running_balance
-            month_entry["closing_balance"] = running_balance + month_entry["total_added"] - month_entry["total_spent"]
-            running_balance = month_entry["closing_balance"]
-
-            # Convert all Decimals to string for JSON
-            month_entry["opening_balance"] = str(month_entry["opening_balance"])
-            month_entry["closing_balance"] = str(month_entry["closing_balance"])
-            month_entry["total_added"] = str(month_entry["total_added"])
-            month_entry["total_spent"] = str(month_entry["total_spent"])
-
-        return Response({
-            "wallet_id": wallet_id,
-            "year": year,
-            "monthly_report": list(report.values())
-        }, status=200)
+        # Convert all Decimals to string for JSON
+        month_entry["opening_balance"] = str(month_entry["opening_balance"])
+        month_entry["closing_balance"] = str(month_entry["closing_balance"])
+        month_entry["total_added"] = str(month_entry["total_added"])
+        month_entry["total_spent"] = str(month_entry["total_spent"])
+
+    return {
+        "wallet_id": wallet_id,
+        "year": year,
+        "monthly_report": list(report.values())
+    }
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, BasicAuthentication])
+@wallet_conditional
+def wallet_range_report(request, wallet_id):
+    """
+    get: Generate a financial report for a wallet over a date range
+
+    ``from`` and ``to`` are inclusive dates (YYYY-MM-DD); ``granularity``
+    is ``day``, ``week`` (starting on Monday), ``month`` (default) or
+    ``year``. Every period in the range is listed, with its opening and
+    closing balance.
+    """
+    try:
+        first_day, last_day, granularity = _parse_range(request.query_params)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    try:
+        data = wallet_cache.cached(
+            wallet_id, f'range-report:{first_day}:{last_day}:{granularity}',
+            lambda: _range_report(wallet_id, first_day, last_day, granularity)
+        )
+        return Response(data, status=200)
 
     except Wallet.DoesNotExist:
         return Response({"error": "Wallet not found"}, status=404)
+
+
+def _parse_range(params):
+    try:
+        first_day = parse_date(params.get('from') or '')
+        last_day = parse_date(params.get('to') or '')
+    except ValueError:
+        first_day = last_day = None
+    if first_day is None or last_day is None:
+        raise ValueError("'from' and 'to' must be dates (YYYY-MM-DD)")
+    if first_day > last_day:
+        raise ValueError("'from' must not be after 'to'")
+    # The period after the last one has to be representable too.
+    if last_day.year == MAXYEAR:
+        raise ValueError(f"'to' must be before {MAXYEAR}-01-01")
+
+    granularity = params.get('granularity') or 'month'
+    if granularity not in REPORT_GRANULARITIES:
+        raise ValueError(f"Granularity must be one of {', '.join(REPORT_GRANULARITIES)}")
+    if len(_period_starts(first_day, last_day, granularity)) > REPORT_MAX_PERIODS:
+        raise ValueError(f'A report can have at most {REPORT_MAX_PERIODS} periods')
+    return first_day, last_day, granularity
+
+
+def _period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def _next_period(start, granularity):
+    if granularity == 'week':
+        return start + timedelta(days=7)
+    if granularity == 'month':
+        return next_month(start)
+    if granularity == 'year':
+        return start.replace(year=start.year + 1)
+    return start + timedelta(days=1)
+
+
+def _period_starts(first_day, last_day, granularity):
+    starts = []
+    start = _period_start(first_day, granularity)
+    while start <= last_day and len(starts) <= REPORT_MAX_PERIODS:
+        starts.append(start)
+        start = _next_period(start, granularity)
+    return starts
+
+
+def _range_report(wallet_id, first_day, last_day, granularity):
+    wallet = Wallet.objects.select_related('archive').get(id=wallet_id)
+    day_after = last_day + timedelta(days=1)
+
+    if granularity in ('month', 'year') and first_day.day == 1 and day_after.day == 1:
+        # Whole months: the monthly rollups have everything.
+        opening, rollups = MonthlyBalance.objects.for_range(
+            wallet, first_day, last_day.replace(day=1))
+        periods = {}
+        for month, rollup in rollups.items():
+            totals = periods.setdefault(_period_start(month, granularity),
+                                        [Decimal('0.00'), Decimal('0.00')])
+            totals[0] += rollup.total_deposited
+            totals[1] += rollup.total_withdrawn
+    else:
+        start = start_of(first_day)
+        opening = _balance_at(wallet, start)
+        periods = {
+            period: (totals['total_deposited'], totals['total_withdrawn'])
+            for period, totals in wallet_ledger.totals_between(
+                wallet, start, start_of(day_after), granularity).items()
+        }
+
+    report = []
+    running_balance = opening
+    for start in _period_starts(first_day, last_day, granularity):
+        added, spent = periods.get(start, (Decimal('0.00'), Decimal('0.00')))
+        closing_balance = running_balance + added - spent
+        report.append({
+            "start": max(start, first_day).isoformat(),
+            "end": min(_next_period(start, granularity) - timedelta(days=1), last_day).isoformat(),
+            "opening_balance": str(running_balance),
+            "total_added": str(added),
+            "total_spent": str(spent),
+            "closing_balance": str(closing_balance)
+        })
+        running_balance = closing_balance
+
+    return {
+        "wallet_id": wallet_id,
+        "from": first_day.isoformat(),
+        "to": last_day.isoformat(),
+        "granularity": granularity,
+        "opening_balance": str(opening),
+        "closing_balance": str(running_balance),
+        "periods": report
+    }
+
+
+def _balance_at(wallet, moment):
+    # The closing balance of the month before, from the rollups, plus the
+    # ledger from the start of the month up to ``moment``.
+    month = month_of(moment)
+    balance, _ = MonthlyBalance.objects.for_range(wallet, month, month)
+    if moment > start_of(month):
+        balance += wallet_ledger.totals_between(wallet, start_of(month), moment)['net']
+    return balance
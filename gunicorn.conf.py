@@ -0,0 +1,68 @@
+"""
+Gunicorn settings for production:
+
+    gunicorn -c gunicorn.conf.py WalletAPI.wsgi:application
+
+or, to serve the async views (needs uvicorn):
+
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \
+        gunicorn -c gunicorn.conf.py WalletAPI.asgi:application
+
+Worker and thread counts can be overridden with WEB_CONCURRENCY and
+GUNICORN_THREADS. Each worker generates ids with worker id WALLET_WORKER_ID
+plus its slot (see pre_fork below); give every host or container sharing
+the database its own WALLET_WORKER_ID, more than twice its worker count
+apart.
+"""
+
+import itertools
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Requests mostly wait on the database, so run a couple of workers per core,
+# each with a few threads.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Import Django once in the master; workers fork with it already loaded.
+preload_app = True
+
+# Keep client connections open between requests (behind a load balancer,
+# keep this above the balancer's idle timeout).
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Recycle workers now and then to bound memory growth.
+max_requests = 10000
+max_requests_jitter = 1000
+
+errorlog = '-'
+
+
+def on_starting(server):
+    # The read cache is invalidated by whichever worker serves a write, so
+    # workers cannot each keep their own.
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'WalletAPI.settings')
+    from django.conf import settings
+    backend = settings.CACHES[settings.WALLET_CACHE_ALIAS]['BACKEND']
+    if server.cfg.workers > 1 and backend.endswith('.LocMemCache'):
+        raise RuntimeError(
+            'WALLET_CACHE_BACKEND is per process (LocMemCache); use a shared cache '
+            'or a single worker (WEB_CONCURRENCY=1).')
+
+
+def pre_fork(server, worker):
+    # Give the new worker the lowest slot no live worker holds. Recycled
+    # workers hand their slot on; during a reload old and new workers both
+    # run, so slots go up to twice the worker count.
+    taken = {getattr(other, 'wallet_slot', None) for other in server.WORKERS.values()}
+    worker.wallet_slot = next(slot for slot in itertools.count(1) if slot not in taken)
+
+
+def post_fork(server, worker):
+    from app import ids
+    ids.set_worker_slot(worker.wallet_slot)